@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+#
+# dbaccess.py -- database access layer shared by tournament.py and forumdb.py
+#
+# Every connection opened here uses InstrumentedCursor.  When
+# instrumentation is on, each statement's time and row count is recorded
+# under the function that ran it (for instance 'tournament.countPlayers'),
+# together with the time that function spent acquiring its connection.
+# When it is off the cursors cost one flag check per statement.
+#
+# Statement runs a hot query as a server-side prepared statement, prepared
+# once per connection.  ReplicaSet decides which reads may go to a read
+# replica.
+#
+
+import logging
+import sys
+import threading
+import time
+import timeit
+
+import psycopg2
+import psycopg2.extensions
+
+
+log = logging.getLogger('dbaccess')
+
+_enabled = False
+_slowQueryMs = None
+_stats = {}
+_queryCount = [0]
+_statsLock = threading.Lock()
+_helperCodes = set()
+
+
+def helper(function):
+    """Marks a function as plumbing: its statements are recorded under the
+    function that called it instead."""
+    code = getattr(function, '__code__', None)
+    if code is not None:
+        _helperCodes.add(code)
+    return function
+
+
+def enableInstrumentation(slow_query_ms=None):
+    """Starts recording query statistics.
+
+    Args:
+      slow_query_ms: if set, every statement that takes at least this many
+        milliseconds is logged (logger 'dbaccess', level WARNING).
+    """
+    global _enabled, _slowQueryMs
+    _slowQueryMs = slow_query_ms
+    _enabled = True
+
+
+def disableInstrumentation():
+    """Stops recording; the statistics gathered so far are kept."""
+    global _enabled
+    _enabled = False
+
+
+def resetStats():
+    """Forgets every statistic recorded so far."""
+    with _statsLock:
+        _stats.clear()
+        _queryCount[0] = 0
+
+
+def queryStats():
+    """Returns the statistics recorded, grouped by calling function.
+
+    Returns:
+      A dict mapping 'module.function' to a dict with the keys queries,
+      rows, total_ms, mean_ms, max_ms, slow (statements over the slow
+      query threshold), acquires, acquire_total_ms and acquire_max_ms.
+    """
+    with _statsLock:
+        stats = dict((name, dict(s)) for name, s in _stats.items())
+    for s in stats.values():
+        s['mean_ms'] = s['total_ms'] / s['queries'] if s['queries'] else 0.0
+    return stats
+
+
+def queryCount():
+    """Returns the number of statements recorded so far, in total."""
+    return _queryCount[0]
+
+
+def timer():
+    """Returns a start time if instrumentation is on, None otherwise."""
+    if _enabled:
+        return timeit.default_timer()
+    return None
+
+
+def _caller():
+    """Returns 'module.function' of the code that issued a statement."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if (module != __name__ and not module.startswith('psycopg2') and
+                frame.f_code not in _helperCodes and
+                module != 'contextlib'):
+            return '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+    return '?'
+
+
+def _entry(name):
+    """Returns the statistics of a function.  Must hold the lock."""
+    s = _stats.get(name)
+    if s is None:
+        s = _stats[name] = {'queries': 0, 'rows': 0, 'total_ms': 0.0,
+                            'max_ms': 0.0, 'slow': 0, 'acquires': 0,
+                            'acquire_total_ms': 0.0, 'acquire_max_ms': 0.0}
+    return s
+
+
+def recordAcquire(start):
+    """Records the time since start (see timer()) as an acquire time."""
+    if start is None or not _enabled:
+        return
+    elapsed = (timeit.default_timer() - start) * 1000.0
+    name = _caller()
+    with _statsLock:
+        s = _entry(name)
+        s['acquires'] += 1
+        s['acquire_total_ms'] += elapsed
+        if elapsed > s['acquire_max_ms']:
+            s['acquire_max_ms'] = elapsed
+
+
+def recordQuery(query, start, rows):
+    """Records a statement started at start (see timer()) that did not run
+    on an InstrumentedCursor, e.g. on an asynchronous connection."""
+    if start is None or not _enabled:
+        return
+    _recordQuery(query, start, rows)
+
+
+def _recordQuery(query, start, rows):
+    elapsed = (timeit.default_timer() - start) * 1000.0
+    name = _caller()
+    slow = _slowQueryMs is not None and elapsed >= _slowQueryMs
+    with _statsLock:
+        _queryCount[0] += 1
+        s = _entry(name)
+        s['queries'] += 1
+        s['rows'] += max(rows, 0)
+        s['total_ms'] += elapsed
+        if elapsed > s['max_ms']:
+            s['max_ms'] = elapsed
+        if slow:
+            s['slow'] += 1
+    if slow:
+        if not isinstance(query, (str, type(u''))):
+            query = repr(query)
+        log.warning("slow query (%.1f ms, %d rows) in %s: %s",
+                    elapsed, rows, name, ' '.join(query.split())[:500])
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor that records its statements when instrumentation is on."""
+
+    def execute(self, query, vars=None):
+        if not _enabled:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        start = timeit.default_timer()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            _recordQuery(query, start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        if not _enabled:
+            return super(InstrumentedCursor, self).executemany(query,
+                                                                vars_list)
+        start = timeit.default_timer()
+        try:
+            return super(InstrumentedCursor, self).executemany(query,
+                                                                vars_list)
+        finally:
+            _recordQuery(query, start, self.rowcount)
+
+
+class Connection(psycopg2.extensions.connection):
+    """A connection that remembers the statements prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def connect(dsn, cursor_factory=None):
+    """Opens a connection whose cursors are instrumented.
+
+    Args:
+      dsn: the libpq connection string.
+      cursor_factory: a subclass of InstrumentedCursor to use instead.
+    """
+    return psycopg2.connect(
+        dsn, connection_factory=Connection,
+        cursor_factory=cursor_factory or InstrumentedCursor)
+
+
+class Statement(object):
+    """A query run as a server-side prepared statement.
+
+    The first execute() on a connection sends PREPARE, so PostgreSQL parses
+    the query once per connection and can keep its plan; every call runs
+    EXECUTE with the arguments only.  PREPARE is not undone by a rollback,
+    so a pooled connection keeps its statements until it is closed.  Only
+    the EXECUTEs are recorded by the instrumentation.
+
+    Args:
+      name: the name of the prepared statement, unique per process.
+      query: the SQL, with one %s per argument (positional only).
+    """
+
+    _names = set()
+
+    def __init__(self, name, query):
+        if name in Statement._names:
+            raise ValueError("Statement %r is already defined." % name)
+        Statement._names.add(name)
+        self.name = name
+        self.query = query
+        parts = query.split('%s')
+        self.args = len(parts) - 1
+        self.prepareQuery = 'PREPARE %s AS %s' % (name, ''.join(
+            part + ('$%d' % (n + 1) if n < self.args else '')
+            for n, part in enumerate(parts)))
+        if self.args:
+            self.executeQuery = 'EXECUTE %s (%s)' % (
+                name, ', '.join(['%s'] * self.args))
+        else:
+            self.executeQuery = 'EXECUTE %s' % name
+
+    def execute(self, cursor, args=()):
+        """Runs the statement on cursor, preparing it first if its
+        connection has not seen it yet.  Connections not opened by
+        connect() run the plain query."""
+        prepared = getattr(cursor.connection, 'prepared', None)
+        if prepared is None:
+            return cursor.execute(self.query, args)
+        if self.name not in prepared:
+            # a plain cursor: PREPARE is not a query of the caller's
+            raw = cursor.connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor)
+            raw.execute(self.prepareQuery)
+            raw.close()
+            prepared.add(self.name)
+        return cursor.execute(self.executeQuery, args)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within the timeout."""
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of PostgreSQL connections.
+
+    Keeps between minconn and maxconn connections open.  getconn() blocks
+    while every connection is checked out; putconn() rolls back any open
+    transaction and drops connections that are broken.
+
+    Args:
+      dsn: the libpq connection string.
+      minconn: connections opened up front and kept idle.
+      maxconn: upper bound on open connections.
+      timeout: seconds getconn() waits for a free connection (None = forever).
+      cursor_factory: the default cursor class of the connections; it
+        should derive from InstrumentedCursor to keep the statistics.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=30,
+                 cursor_factory=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Pool size must satisfy 0 <= minconn <= maxconn"
+                             " and maxconn >= 1.")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.cursor_factory = cursor_factory
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        self._counters = {'opened': 0, 'closed': 0, 'checkouts': 0,
+                          'returns': 0, 'waits': 0, 'timeouts': 0,
+                          'discarded': 0, 'peak_in_use': 0}
+        with self._cond:
+            for _ in range(minconn):
+                self._idle.append(self._open())
+
+    def _open(self):
+        """Opens a new connection.  Must be called holding the lock."""
+        conn = connect(self.dsn, self.cursor_factory)
+        self._size += 1
+        self._counters['opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        """Closes a connection and forgets it.  Must hold the lock."""
+        try:
+            if not conn.closed:
+                conn.close()
+        except psycopg2.Error:
+            pass
+        self._size -= 1
+        self._counters['closed'] += 1
+
+    def getconn(self):
+        """Checks a connection out of the pool.
+
+        The time spent waiting for (or opening) the connection is recorded
+        as the caller's acquire time when instrumentation is on.
+        """
+        start = timer()
+        try:
+            return self._getconn()
+        finally:
+            recordAcquire(start)
+
+    def _getconn(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("The pool is closed.")
+                while self._idle:
+                    conn = self._idle.pop()
+                    if conn.closed:
+                        self._discard(conn)
+                        self._counters['discarded'] += 1
+                        continue
+                    return self._checkedOut(conn)
+                if self._size < self.maxconn:
+                    return self._checkedOut(self._open())
+                if not waited:
+                    self._counters['waits'] += 1
+                    waited = True
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(
+                            "No connection available after %ss." % self.timeout)
+                    self._cond.wait(remaining)
+
+    def _checkedOut(self, conn):
+        self._counters['checkouts'] += 1
+        inUse = self._size - len(self._idle)
+        if inUse > self._counters['peak_in_use']:
+            self._counters['peak_in_use'] = inUse
+        return conn
+
+    def putconn(self, conn):
+        """Returns a connection to the pool, resetting or dropping it."""
+        healthy = not conn.closed
+        if healthy and (conn.get_transaction_status() !=
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                healthy = False
+        with self._cond:
+            self._counters['returns'] += 1
+            if not healthy:
+                self._counters['discarded'] += 1
+                self._discard(conn)
+            elif self._closed or len(self._idle) >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        """Closes every idle connection and refuses further checkouts."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._cond.notify_all()
+
+    def stats(self):
+        """Returns a snapshot of the pool's health and usage counters."""
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({'minconn': self.minconn,
+                          'maxconn': self.maxconn,
+                          'size': self._size,
+                          'idle': len(self._idle),
+                          'in_use': self._size - len(self._idle)})
+        return stats
+
+
+class PooledConnection(object):
+    """A checked-out connection whose close() hands it back to the pool."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.putconn(self._conn)
+            self._conn = None
+
+
+class ReplicaSet(object):
+    """Read replicas of a database, with read-your-writes stickiness.
+
+    route() picks the replica of the next read, round robin.  After
+    markWrite(key) the reads of that key go to the primary for stickiness
+    seconds, long enough for the replicas to replay the write; markWrite()
+    without a key makes every read sticky.
+
+    Args:
+      replicas: what route() returns for each replica (a ConnectionPool,
+        a DSN...).
+      stickiness: seconds during which the reads of a written key keep
+        going to the primary.
+    """
+
+    def __init__(self, replicas, stickiness=5.0):
+        self.replicas = list(replicas)
+        self.stickiness = stickiness
+        self._next = 0
+        self._written = {}
+        self._allWritten = 0.0
+        self._lock = threading.Lock()
+        self._counters = {'replica_reads': 0, 'primary_reads': 0,
+                          'sticky_reads': 0, 'writes': 0}
+
+    def markWrite(self, key=None):
+        """Sends the reads of key (or every read) to the primary for a
+        while."""
+        until = time.time() + self.stickiness
+        with self._lock:
+            self._counters['writes'] += 1
+            if key is None:
+                self._allWritten = until
+                self._written.clear()
+                return
+            self._written[key] = until
+            if len(self._written) > 1000:
+                now = time.time()
+                for k, t in list(self._written.items()):
+                    if t <= now:
+                        del self._written[k]
+
+    def route(self, key=None):
+        """Returns the replica that should serve a read of key, or None if
+        it must go to the primary (no replicas, or key written recently)."""
+        now = time.time()
+        with self._lock:
+            if not self.replicas:
+                self._counters['primary_reads'] += 1
+                return None
+            if now < self._allWritten or now < self._written.get(key, 0):
+                self._counters['sticky_reads'] += 1
+                self._counters['primary_reads'] += 1
+                return None
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            self._counters['replica_reads'] += 1
+            return replica
+
+    def stats(self):
+        """Returns the routing counters and the number of replicas."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['replicas'] = len(self.replicas)
+        return stats
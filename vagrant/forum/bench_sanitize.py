@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# bench_sanitize.py -- throughput of bleach.clean with and without the
+# forumdb.SanitizeCache memo
+#
+# The workload mimics a spam flood: --posts submissions drawn from only
+# --distinct different bodies.  No database is needed.
+#
+# Usage: python bench_sanitize.py [--posts 20000] [--distinct 200]
+#            [--length 2000] [--cache-size 10000]
+#
+
+import argparse
+import random
+import timeit
+
+import bleach
+
+import forumdb
+
+
+def Workload(posts, distinct, length):
+    '''Returns posts bodies drawn from distinct random ones.'''
+    words = ['hello', '<b>buy</b>', 'now', '<script>alert(1)</script>',
+             'cheap', '<a href="http://spam.example">link</a>', '&', 'x']
+    bodies = []
+    for _ in range(distinct):
+        body = []
+        while sum(len(w) + 1 for w in body) < length:
+            body.append(random.choice(words))
+        bodies.append(' '.join(body))
+    return [random.choice(bodies) for _ in range(posts)]
+
+def Measure(clean, workload):
+    '''Returns the posts per second clean() sanitizes.'''
+    start = timeit.default_timer()
+    for content in workload:
+        clean(content)
+    return len(workload) / (timeit.default_timer() - start)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks post sanitization with and without a memo.')
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--distinct', type=int, default=200)
+    parser.add_argument('--length', type=int, default=2000)
+    parser.add_argument('--cache-size', type=int,
+                        default=forumdb.SANITIZE_CACHE_SIZE)
+    args = parser.parse_args()
+
+    workload = Workload(args.posts, args.distinct, args.length)
+    plain = Measure(bleach.clean, workload)
+    cache = forumdb.SanitizeCache(args.cache_size)
+    cached = Measure(cache.sanitize, workload)
+    print "%d posts, %d distinct bodies of ~%d characters" % (
+        args.posts, args.distinct, args.length)
+    print "bleach.clean:        %10.0f posts/s" % plain
+    print "SanitizeCache:       %10.0f posts/s (%.1fx, %s)" % (
+        cached, cached / plain, cache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# bench_search.py -- latency of forumdb.SearchPosts on a large posts table,
+# with and without the posts_search_idx GIN index
+#
+# --posts synthetic posts (a million by default) are inserted inside a
+# transaction that is rolled back at the end, so the benchmark can run
+# against any forum database created from forum.sql without leaving
+# anything behind.  Their words are drawn from a --vocabulary of random
+# words with a skewed distribution, so the queries cover common words
+# (many matches to rank), rare words and multi-word queries.
+#
+# Usage: python bench_search.py [--dsn "dbname=forum"] [--posts 1000000]
+#            [--words 40] [--vocabulary 20000] [--repeat 20]
+#            [--skip-seqscan]
+#
+
+import argparse
+import random
+import string
+import timeit
+
+import psycopg2
+
+import forumdb
+
+
+def Vocabulary(size):
+    '''Returns size distinct random lowercase words.'''
+    words = set()
+    while len(words) < size:
+        words.add(''.join(random.choice(string.ascii_lowercase)
+                          for _ in range(random.randint(4, 10))))
+    return sorted(words)
+
+def Seed(c, posts, words, vocabulary):
+    '''Inserts posts of words words each; word n is drawn with a
+    probability that falls with n (the first words are the common ones).'''
+    c.execute("""INSERT INTO posts (content, content_html, time)
+                 SELECT body, body, now() - g * interval '1 second'
+                 FROM (SELECT g, array_to_string(ARRAY(
+                           SELECT (%(v)s::text[])[1 + floor(
+                               %(n)s * power(random(), 3))::int]
+                           FROM generate_series(1, %(w)s)
+                           WHERE g > 0), ' ') AS body
+                       FROM generate_series(1, %(p)s) g) bodies""",
+              {'v': vocabulary, 'n': len(vocabulary), 'w': words,
+               'p': posts})
+    c.execute("ANALYZE posts")
+
+def Queries(vocabulary):
+    '''Returns (label, query) pairs of increasing selectivity.'''
+    n = len(vocabulary)
+    common, middle, rare = vocabulary[0], vocabulary[n // 10], \
+        vocabulary[n - 1]
+    return [('common word', common),
+            ('mid word', middle),
+            ('rare word', rare),
+            ('two words', '%s %s' % (common, middle)),
+            ('phrase', '"%s %s"' % (common, vocabulary[1])),
+            ('or', '%s or %s' % (middle, rare))]
+
+def Measure(c, queries, repeat):
+    '''Returns {label: (matches, p50_ms, p95_ms, page2_p50_ms, plan)}.'''
+    results = {}
+    for label, terms in queries:
+        c.execute("SELECT count(*) FROM posts"
+                  " WHERE search @@ websearch_to_tsquery(%s, %s)",
+                  (forumdb.SEARCH_CONFIG, terms))
+        matches = c.fetchone()[0]
+        first, second = [], []
+        for _ in range(repeat):
+            sql, args = forumdb.SearchQuery(terms, None, forumdb.PAGE_SIZE)
+            start = timeit.default_timer()
+            c.execute(sql, args)
+            rows = c.fetchall()
+            first.append((timeit.default_timer() - start) * 1000.0)
+            if len(rows) == forumdb.PAGE_SIZE:
+                cursor = forumdb.MakeSearchCursor(
+                    {'rank': rows[-1][3], 'id': rows[-1][2]})
+                sql, args = forumdb.SearchQuery(terms, cursor,
+                                                forumdb.PAGE_SIZE)
+                start = timeit.default_timer()
+                c.execute(sql, args)
+                c.fetchall()
+                second.append((timeit.default_timer() - start) * 1000.0)
+        sql, args = forumdb.SearchQuery(terms, None, forumdb.PAGE_SIZE)
+        c.execute("EXPLAIN (ANALYZE, COSTS OFF) " + sql, args)
+        plan = '\n'.join(row[0] for row in c.fetchall())
+        first.sort()
+        second.sort()
+        results[label] = (matches, first[len(first) // 2],
+                          first[min(len(first) - 1, int(len(first) * 0.95))],
+                          second[len(second) // 2] if second else None,
+                          plan)
+    return results
+
+def Report(title, queries, results):
+    print "\n%s" % title
+    print "%-12s %10s %10s %10s %12s" % ('query', 'matches', 'p50',
+                                         'p95', 'page 2 p50')
+    for label, terms in queries:
+        matches, p50, p95, page2, plan = results[label]
+        print "%-12s %10d %8.2fms %8.2fms %12s" % (
+            label, matches, p50, p95,
+            '%.2fms' % page2 if page2 is not None else '-')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks forum full-text search on a large table.')
+    parser.add_argument('--dsn', default=forumdb.DSN)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--words', type=int, default=40,
+                        help='words per post')
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--skip-seqscan', action='store_true',
+                        help='do not measure without the GIN index')
+    args = parser.parse_args()
+
+    vocabulary = Vocabulary(args.vocabulary)
+    queries = Queries(vocabulary)
+    DB = psycopg2.connect(args.dsn)
+    try:
+        c = DB.cursor()
+        start = timeit.default_timer()
+        Seed(c, args.posts, args.words, vocabulary)
+        print "Seeded %d posts of %d words in %.1fs." % (
+            args.posts, args.words, timeit.default_timer() - start)
+        with_index = Measure(c, queries, args.repeat)
+        without_index = None
+        if not args.skip_seqscan:
+            c.execute("SAVEPOINT with_index")
+            c.execute("DROP INDEX posts_search_idx")
+            without_index = Measure(c, queries, max(1, args.repeat // 5))
+            c.execute("ROLLBACK TO SAVEPOINT with_index")
+    finally:
+        DB.rollback()
+        DB.close()
+
+    for label, terms in queries:
+        print "\n=== %s: %s ===" % (label, terms)
+        print with_index[label][4]
+    Report("With posts_search_idx:", queries, with_index)
+    if without_index is not None:
+        Report("Without posts_search_idx (sequential scan):", queries,
+               without_index)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,23 @@
 import forumdb
 
 # Other modules used to run a web server.
+import argparse
 import cgi
-from wsgiref.simple_server import make_server
+import collections
+import email.utils
+import hashlib
+import os
+import Queue
+import signal
+import sys
+import threading
+import urllib
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 from wsgiref import util
 
-# HTML template for the forum page
-HTML_WRAP = '''\
+# HTML template for the forum page, sent before the posts (%(q)s is the
+# search box text)
+HTML_HEAD = '''\
 <!DOCTYPE html>
 <html>
   <head>
@@ -28,12 +39,18 @@ HTML_WRAP = '''\
   </head>
   <body>
     <h1>DB Forum</h1>
+    <form method=get action="/search">
+      <div><input name="q" value="%(q)s"> <button type="submit">Search</button></div>
+    </form>
     <form method=post action="/post">
       <div><textarea id="content" name="content"></textarea></div>
       <div><button id="go" type="submit">Post message</button></div>
     </form>
     <!-- post content will go here -->
-%s
+'''
+
+# HTML template for the forum page, sent after the posts
+HTML_TAIL = '''\
   </body>
 </html>
 '''
@@ -43,18 +60,176 @@ POST = '''\
     <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
 '''
 
+# HTML template for the link to the next page of posts
+NEXT_PAGE = '''\
+    <div class=post><a href="/?before=%s">Older posts</a></div>
+'''
+
+# HTML template for the link to the next page of search results
+NEXT_RESULTS = '''\
+    <div class=post><a href="/search?q=%s&amp;after=%s">More results</a></div>
+'''
+
+# HTML template for a search without results
+NO_RESULTS = '''\
+    <div class=post>No posts match your search.</div>
+'''
+
+## Rendered-page cache: the most requested pages, as sent to the browser.
+PAGE_CACHE_SIZE = 5
+
+class PageCache(object):
+    '''Keeps the bytes, ETag and Last-Modified of recently rendered pages.
+
+    Entries are keyed by the ?before= cursor (None for the front page) and
+    tagged with forumdb.PostsVersion(); once a post is added the version
+    changes and every entry stops matching.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, before, version):
+        '''Returns (body, etag, last_modified) or None.'''
+        with self.lock:
+            entry = self.pages.pop(before, None)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.pages[before] = entry
+            self.hits += 1
+            return entry[1:]
+
+    def put(self, before, version, body):
+        '''Stores a page rendered while the posts were at version.
+
+        Returns the (body, etag, last_modified) that get() will return.
+        '''
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        lastModified = email.utils.formatdate(usegmt=True)
+        with self.lock:
+            self.pages.pop(before, None)
+            self.pages[before] = (version, body, etag, lastModified)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+        return body, etag, lastModified
+
+PAGE_CACHE = PageCache(PAGE_CACHE_SIZE)
+
+def ETagMatches(env, etag):
+    '''True if the request's If-None-Match lists etag.'''
+    header = env.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and one page of the previously posted
+    messages, newest first.  The ?before= parameter selects an older page.
+
+    The posts are read in batches from a server-side cursor and rendered
+    once (a page holds at most PAGE_SIZE posts); the page is then kept in
+    PAGE_CACHE until a post is added: while it is there no query is run.
+    Every 200 carries the page's ETag and Last-Modified, the first one
+    too, and a browser that already has it (If-None-Match) gets a 304.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    before = fields.get('before', [None])[0]
+    if before is not None:
+        try:
+            forumdb.ParseCursor(before)
+        except ValueError:
+            resp('400 Bad Request', [('Content-type', 'text/plain')])
+            return ['Bad cursor: ' + before]
+    version = forumdb.PostsVersion()
+    cached = PAGE_CACHE.get(before, version)
+    if cached is None:
+        # read one page of posts (plus one, to know if there is a next page)
+        batches = forumdb.IterPosts(before, forumdb.PAGE_SIZE + 1)
+        body = ''.join(StreamPage(batches, forumdb.PAGE_SIZE))
+        cached = PAGE_CACHE.put(before, version, body)
     # send results
+    body, etag, lastModified = cached
+    headers = [('ETag', etag), ('Last-Modified', lastModified)]
+    if ETagMatches(env, etag):
+        resp('304 Not Modified', headers)
+        return []
+    headers += [('Content-type', 'text/html'),
+                ('Content-Length', str(len(body)))]
+    resp('200 OK', headers)
+    return [body]
+
+## Request handler for the search page
+def Search(env, resp):
+    '''Search shows the posts matching ?q=, best match first.
+
+    Results come from forumdb.IterSearch one page at a time and are
+    streamed: the header goes out at once and the posts follow batch by
+    batch; ?after= selects the next page.  They are not cached.
+    '''
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    q = fields.get('q', [''])[0].strip()
+    after = fields.get('after', [None])[0]
+    if after is not None:
+        try:
+            forumdb.ParseSearchCursor(after)
+        except ValueError:
+            resp('400 Bad Request', [('Content-type', 'text/plain')])
+            return ['Bad cursor: ' + after]
     headers = [('Content-type', 'text/html')]
     resp('200 OK', headers)
-    return [HTML_WRAP % ''.join(POST % p for p in posts)]
+    head = HTML_HEAD % {'q': cgi.escape(q, True)}
+    if not q:
+        return [head, HTML_TAIL]
+    batches = forumdb.IterSearch(q, after, forumdb.PAGE_SIZE + 1)
+    nextPage = lambda last: NEXT_RESULTS % (
+        urllib.quote_plus(q), urllib.quote(forumdb.MakeSearchCursor(last)))
+    return StreamPage(batches, forumdb.PAGE_SIZE, head, nextPage, NO_RESULTS)
+
+def StreamPage(batches, page_size, head=None, nextPage=None, empty=''):
+    '''Yields the forum page: header, batches of posts, footer.
+
+    Args:
+      batches: an iterator of lists of posts (see forumdb.IterPosts) that
+        may hold one post more than page_size.
+      page_size: the number of posts shown on the page.
+      head: the page header, by default the main page's.
+      nextPage: a function returning the link to the page after the given
+        post, by default the main page's "Older posts".
+      empty: what to show if there are no posts.
+    '''
+    if head is None:
+        head = HTML_HEAD % {'q': ''}
+    if nextPage is None:
+        nextPage = lambda last: NEXT_PAGE % urllib.quote(
+            forumdb.MakeCursor(last))
+    try:
+        yield head
+        shown = 0
+        last = None
+        for batch in batches:
+            posts = batch[:page_size - shown]
+            if posts:
+                shown += len(posts)
+                last = posts[-1]
+                yield ''.join(POST % p for p in posts)
+            if len(posts) < len(batch):
+                # there are more posts than fit on this page
+                yield nextPage(last)
+                break
+        if not shown:
+            yield empty
+        yield HTML_TAIL
+    finally:
+        batches.close()
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
@@ -75,7 +250,11 @@ def Post(env, resp):
         content = content.strip()
         if content:
             # Save it in the database
-            forumdb.AddPost(content)
+            try:
+                forumdb.AddPost(content)
+            except ValueError as e:
+                resp('400 Bad Request', [('Content-type', 'text/plain')])
+                return ['Cannot post this: %s' % e]
     # 302 redirect back to the main page
     headers = [('Location', '/'),
                ('Content-type', 'text/plain')]
@@ -85,6 +264,7 @@ def Post(env, resp):
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -100,8 +280,138 @@ def Dispatcher(env, resp):
         return ['Not Found: ' + page]
 
 
-# Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
+## Thread-pool server: a fixed number of threads serve the connections.
+class ThreadPoolWSGIServer(WSGIServer):
+    '''A WSGIServer that hands every connection to a pool of threads.
+
+    The accept loop only queues connections; when the queue is full it
+    stops accepting until a worker frees up.
+    '''
+
+    def __init__(self, server_address, handler_class, workers):
+        WSGIServer.__init__(self, server_address, handler_class)
+        self.requests = Queue.Queue(workers * 4)
+        for _ in range(workers):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+## SIGTERM ends the server like Ctrl-C does.
+def ExitOnSigterm():
+    '''Turns SIGTERM into SystemExit, so that the finally blocks and the
+    atexit hooks (which write out the queued posts) run before exiting.'''
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+## Pre-fork server: worker processes share the listening socket.
+def ServePrefork(httpd, workers, write_behind=None):
+    '''Forks the workers, restarts the ones that die.
+
+    Ctrl-C or SIGTERM on the parent stops the workers too; each worker
+    writes out its queued posts before exiting.
+
+    Args:
+      httpd: the server, already bound to its port.
+      workers: the number of worker processes.
+      write_behind: None, or the (max_batch, max_delay) of the post writer
+        every worker starts (threads do not survive the fork).
+    '''
+    children = set()
+    ExitOnSigterm()
+    try:
+        while True:
+            while len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        if write_behind:
+                            forumdb.EnableWriteBehind(*write_behind)
+                        httpd.serve_forever()
+                    except (KeyboardInterrupt, SystemExit):
+                        pass
+                    finally:
+                        forumdb.StopWriteBehind()
+                        os._exit(0)
+                children.add(pid)
+            pid, status = os.wait()
+            children.discard(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+def main(argv=None):
+    '''Runs the forum server.
+
+    --mode single serves one request at a time, --mode threads uses a pool
+    of --workers threads and --mode prefork uses --workers processes.  Each
+    worker keeps its own database connection (see forumdb.Connect), plus
+    one per --replica (see forumdb.ConnectRead).  In every mode Ctrl-C or
+    SIGTERM writes out the queued posts before the server exits.
+    '''
+    parser = argparse.ArgumentParser(description='Runs the DB Forum server.')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=('single', 'threads', 'prefork'),
+                        default='single')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--write-behind', action='store_true',
+                        help='queue new posts and insert them in batches')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batch-delay', type=float, default=0.5,
+                        help='seconds a queued post waits at most')
+    parser.add_argument('--dsn', default=forumdb.DSN,
+                        help='the primary database')
+    parser.add_argument('--replica', action='append', default=[],
+                        metavar='DSN',
+                        help='a read replica (repeat for several)')
+    parser.add_argument('--stickiness', type=float, default=5,
+                        help='seconds reads stay on the primary after a post')
+    args = parser.parse_args(argv)
+    forumdb.DSN = args.dsn
+    forumdb.ConfigureReplicas(args.replica, args.stickiness)
+
+    # Run this bad server only on localhost!
+    if args.mode == 'threads':
+        httpd = ThreadPoolWSGIServer((args.host, args.port),
+                                     WSGIRequestHandler, args.workers)
+        httpd.set_app(Dispatcher)
+    else:
+        httpd = make_server(args.host, args.port, Dispatcher)
+    ExitOnSigterm()
+    print "Serving HTTP on port %d (%s)..." % (args.port, args.mode)
+    sys.stdout.flush()
+    write_behind = None
+    if args.write_behind:
+        write_behind = (args.batch_size, args.batch_delay)
+    if args.mode == 'prefork':
+        ServePrefork(httpd, args.workers, write_behind)
+    else:
+        if write_behind:
+            forumdb.EnableWriteBehind(*write_behind)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            forumdb.StopWriteBehind()
+
 
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,28 @@
 
+-- content is the text as it was submitted; content_html is the same text
+-- sanitized by bleach once, when it is inserted, and is what gets shown.
+-- search is the text search vector of content, kept up to date by the
+-- database itself (PostgreSQL 12 or later).
 CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     id SERIAL );
+                     id SERIAL,
+                     content_html TEXT,
+                     search TSVECTOR GENERATED ALWAYS AS
+                       (to_tsvector('english', coalesce(content, ''))) STORED );
 
+-- To upgrade a forum database created before content_html existed (its
+-- content column was already sanitized):
+--   ALTER TABLE posts ADD COLUMN content_html TEXT;
+--   UPDATE posts SET content_html = content;
+-- and to add search to one created before it existed:
+--   ALTER TABLE posts ADD COLUMN search TSVECTOR GENERATED ALWAYS AS
+--     (to_tsvector('english', coalesce(content, ''))) STORED;
+--   CREATE INDEX posts_search_idx ON posts USING GIN (search);
+
+-- The front page reads the posts newest first, one page at a time, starting
+-- after a (time, id) cursor: this index serves every page with a range scan.
+CREATE INDEX posts_time_id_idx ON posts (time DESC, id DESC);
+
+-- /search finds the posts whose search vector matches the query through
+-- this index, then ranks only those.
+CREATE INDEX posts_search_idx ON posts USING GIN (search);
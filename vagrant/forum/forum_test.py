@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Test cases for forum.py and forumdb.py
+# They need the forum database (see forum.sql) and start the server on
+# TEST_PORT.
+
+import datetime
+import httplib
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib
+import uuid
+
+import forumdb
+
+TEST_PORT = 8765
+
+FORUM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forum.py')
+
+
+def startServer(*args):
+    """Starts forum.py on TEST_PORT and waits until it accepts requests."""
+    server = subprocess.Popen([sys.executable, FORUM, '--port',
+                               str(TEST_PORT), '--dsn', forumdb.DSN] +
+                              list(args))
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', TEST_PORT), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise ValueError("The forum server did not start.")
+
+
+def get(path):
+    """Requests a page and returns the HTTP status."""
+    conn = httplib.HTTPConnection('localhost', TEST_PORT)
+    conn.request('GET', path)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def post(content):
+    """Posts a message and returns the HTTP status."""
+    conn = httplib.HTTPConnection('localhost', TEST_PORT)
+    conn.request('POST', '/post', urllib.urlencode({'content': content}),
+                 {'Content-type': 'application/x-www-form-urlencoded'})
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def countPosts(prefix):
+    """Returns the number of stored posts whose content starts with prefix."""
+    DB = forumdb.Connect()
+    try:
+        c = DB.cursor()
+        c.execute("SELECT count(*) FROM posts WHERE content LIKE %s",
+                  (prefix + '%',))
+        return c.fetchone()[0]
+    finally:
+        forumdb.Release(DB)
+
+
+def testSigtermWritesQueuedPosts():
+    """
+    Test that SIGTERM on a server without pre-forked workers writes the
+    posts still waiting in the write-behind queue.
+    """
+    for n, mode in enumerate(('single', 'threads'), 1):
+        marker = 'sigterm-%s-' % uuid.uuid4().hex
+        server = startServer('--mode', mode, '--write-behind',
+                             '--batch-delay', '5')
+        try:
+            for i in range(3):
+                if post(marker + str(i)) != 302:
+                    raise ValueError("A post should be answered with a 302.")
+            if countPosts(marker) != 0:
+                raise ValueError("The posts should still be queued.")
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        written = countPosts(marker)
+        if written != 3:
+            raise ValueError(
+                "SIGTERM should write the queued posts ({mode}). Got {n}".format(mode=mode, n=written))
+        print "%d. SIGTERM writes the queued posts (--mode %s)." % (n, mode)
+
+
+def testBadCursors():
+    """
+    Test that malformed pagination and search cursors are answered with a
+    400 before the page is sent.
+    """
+    posted = datetime.datetime(2016, 5, 1, 12, 30, 15, 250)
+    cursor = forumdb.MakeCursor({'time': str(posted), 'id': 7})
+    if forumdb.ParseCursor(cursor) != (posted, 7):
+        raise ValueError("ParseCursor should read back MakeCursor's cursor.")
+    for bad in ('foo,1', '2016-05-01,1', '2016-05-01 12:30:15,x', '1'):
+        try:
+            forumdb.ParseCursor(bad)
+            raise ValueError("ParseCursor should reject {c!r}.".format(c=bad))
+        except ValueError as e:
+            if 'Malformed' not in str(e):
+                raise
+    for bad in ('nan,1', 'inf,1', '-inf,1', '1e400,1'):
+        try:
+            forumdb.ParseSearchCursor(bad)
+            raise ValueError("ParseSearchCursor should reject {c!r}.".format(c=bad))
+        except ValueError as e:
+            if 'Malformed' not in str(e):
+                raise
+    server = startServer('--mode', 'threads')
+    try:
+        for path in ('/?before=foo,1', '/search?q=forum&after=nan,1'):
+            if get(path) != 400:
+                raise ValueError("{p} should get a 400.".format(p=path))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    print "3. Bad cursors get a 400."
+
+
+if __name__ == '__main__':
+    testSigtermWritesQueuedPosts()
+    testBadCursors()
+    print "Success!  All tests pass!"
@@ -2,50 +2,683 @@
 # Database access functions for the web forum.
 #
 
+import atexit
+import collections
+import datetime
+import hashlib
+import logging
+import math
+import os
+import Queue
+import socket
+import sys
+import threading
+
 import psycopg2
+import psycopg2.extras
 import time
 import bleach
 
+# dbaccess.py, shared with the tournament, lives in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import dbaccess
+
+log = logging.getLogger('forumdb')
+
+## Database connection string.
+DSN = "dbname=forum"
+
+## Each worker thread (or pre-forked process) keeps its own connection.
+_local = threading.local()
+
+@dbaccess.helper
+def Connect():
+    '''Returns this worker's database connection, opening it if needed.
+
+    The connection is reused by every request the worker serves.  It is
+    never shared between threads, nor inherited across a fork.  Its
+    cursors are instrumented (see dbaccess).
+    '''
+    start = dbaccess.timer()
+    DB = getattr(_local, 'db', None)
+    if DB is None or DB.closed or _local.pid != os.getpid():
+        DB = dbaccess.connect(DSN)
+        _local.db = DB
+        _local.pid = os.getpid()
+    dbaccess.recordAcquire(start)
+    return DB
+
+## Read replicas (see ConfigureReplicas); None reads from DSN only.
+_replicas = None
+
+def ConfigureReplicas(dsns, stickiness=5):
+    '''Sends the read-only queries (the front page and search) to replicas.
+
+    Each worker opens its own connection to each replica and picks one
+    round robin per request.  After a post is added, by this process or
+    any other (see PostsVersion), this process reads from the primary for
+    stickiness seconds, so a page is never rebuilt from a replica that has
+    not replayed the post yet.
+
+    Args:
+      dsns: the connection strings of the replicas; empty to stop using
+        replicas.
+      stickiness: seconds during which reads stay on the primary after a
+        new post.
+    '''
+    global _replicas
+    _replicas = dbaccess.ReplicaSet(dsns, stickiness) if dsns else None
+
+def ReplicaStats():
+    '''Returns the read routing counters, or None without replicas.'''
+    replicas = _replicas
+    if replicas is None:
+        return None
+    return replicas.stats()
+
+@dbaccess.helper
+def ConnectRead():
+    '''Returns a connection for a read-only request.
+
+    It goes to a replica when there is one and no post was added recently,
+    otherwise (or if the replica cannot be reached) to Connect().  Replica
+    connections are kept per worker, like the primary one.
+    '''
+    replicas = _replicas
+    dsn = replicas.route() if replicas is not None else None
+    if dsn is None:
+        return Connect()
+    start = dbaccess.timer()
+    if getattr(_local, 'replica_pid', None) != os.getpid():
+        _local.replicas = {}
+        _local.replica_pid = os.getpid()
+    DB = _local.replicas.get(dsn)
+    if DB is None or DB.closed:
+        try:
+            DB = dbaccess.connect(dsn)
+        except psycopg2.OperationalError:
+            return Connect()
+        _local.replicas[dsn] = DB
+    dbaccess.recordAcquire(start)
+    return DB
+
+@dbaccess.helper
+def Release(DB):
+    '''Ends whatever transaction a request left open on the connection.
+
+    A connection that cannot be rolled back is broken: it is closed and the
+    next Connect() opens a new one.
+    '''
+    try:
+        DB.rollback()
+    except psycopg2.Error:
+        DB.close()
+
+
+## Posts version: changes every time a post is added, by any worker.
+_version = [0]
+_versionLock = threading.Lock()
+
+## The process's LISTEN forum_posts connection (see PostsVersion).
+_listener = [None, None]
+_listenerLock = threading.Lock()
+
+def _BumpVersion():
+    with _versionLock:
+        _version[0] += 1
+    replicas = _replicas
+    if replicas is not None:
+        replicas.markWrite()
+
+def _NotifyToken():
+    '''The payload of the forum_posts notifications this process sends.'''
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def _NotifyPosts(c):
+    '''Tells the other processes, on commit, that posts were added.'''
+    c.execute("SELECT pg_notify('forum_posts', %s)", (_NotifyToken(),))
 
+def PostsVersion():
+    '''Returns a number that changes every time a post is added.
 
+    Posts added by this process bump it directly.  Posts added by other
+    processes send a forum_posts notification, which is picked up without
+    running any query from the one connection per process that listens;
+    the notifications this process sent itself are skipped.
+    '''
+    with _listenerLock:
+        DB, pid = _listener
+        if DB is None or DB.closed or pid != os.getpid():
+            DB = dbaccess.connect(DSN)
+            DB.autocommit = True
+            DB.cursor().execute("LISTEN forum_posts")
+            # a new process has nothing cached yet; after a lost
+            # connection (below) the version was already bumped
+            _listener[:] = [DB, os.getpid()]
+        try:
+            DB.poll()
+        except psycopg2.Error:
+            # posts added until the next connection would go unnoticed
+            DB.close()
+            _BumpVersion()
+        token = _NotifyToken()
+        notified = any(n.payload != token for n in DB.notifies)
+        del DB.notifies[:]
+    if notified:
+        _BumpVersion()
+    return _version[0]
+
+
+## Number of posts shown on each page of the forum.
+PAGE_SIZE = 50
+
+## Number of posts read per round-trip when streaming a page.
+BATCH_SIZE = 100
+
+
+## Pagination cursors: the (time, id) of the last post of a page.
+def MakeCursor(post):
+    '''Returns the cursor that points just after the given post.'''
+    return '%s,%d' % (post['time'], post['id'])
+
+## The formats str() gives a post's time in, with and without microseconds.
+CURSOR_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
 
+def ParseCursor(cursor):
+    '''Splits a cursor made by MakeCursor into (time, id).
+
+    Both parts are checked here, so a bad cursor is rejected before any
+    query runs.
+
+    Raises:
+      ValueError: if the cursor is malformed.
+    '''
+    posted, sep, post_id = cursor.rpartition(',')
+    if not sep or not posted:
+        raise ValueError("Malformed cursor: %r" % cursor)
+    for fmt in CURSOR_TIME_FORMATS:
+        try:
+            return (datetime.datetime.strptime(posted, fmt),
+                    int(post_id))
+        except ValueError:
+            pass
+    raise ValueError("Malformed cursor: %r" % cursor)
+
+
+## Query behind GetAllPosts and IterPosts.
+def PostsQuery(before, limit):
+    '''Returns the (query, args) reading posts newest first.'''
+    query = "SELECT time, content_html, id FROM posts"
+    args = []
+    if before is not None:
+        query += " WHERE (time, id) < (%s, %s)"
+        args.extend(ParseCursor(before))
+    query += " ORDER BY time DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT %s"
+        args.append(limit)
+    return query, args
 
 ## Get posts from database.
-def GetAllPosts():
+def GetAllPosts(before=None, limit=PAGE_SIZE):
+    '''Get a page of posts from the database, sorted with the newest first.
 
-    ## Database connection
-    DB = psycopg2.connect("dbname=forum")
-    c = DB.cursor()
-    c.execute("SELECT time, content FROM posts ORDER BY time DESC")
-    posts = ({'content': str(row[1]), 'time':str(row[0])}
-             for row in c.fetchall())
-    DB.close()
+    Pages are read with keyset pagination on the posts_time_id_idx index,
+    so every page costs the same no matter how old it is.
 
-    '''Get all the posts from the database, sorted with the newest first.
+    Args:
+      before: a cursor (see MakeCursor); only the posts older than it are
+        returned.  None starts from the newest post.
+      limit: the maximum number of posts returned; None returns them all.
 
     Returns:
       A list of dictionaries, where each dictionary has a 'content' key
-      pointing to the post content, and 'time' key pointing to the time
-      it was posted.
+      pointing to the sanitized post content, a 'time' key pointing to the
+      time it was posted and an 'id' key with the id of the post.
+    '''
+    query, args = PostsQuery(before, limit)
+
+    ## Database connection
+    DB = ConnectRead()
+    try:
+        c = DB.cursor()
+        c.execute(query, args)
+        posts = [_PostFromRow(row) for row in c.fetchall()]
+    finally:
+        Release(DB)
+    return posts
+
+## Stream posts from database.
+def IterPosts(before=None, limit=None, batch_size=BATCH_SIZE):
+    '''Yields the posts, newest first, in lists of at most batch_size.
+
+    The rows are fetched from a server-side (named) cursor, so only one
+    batch is held in memory at a time.  The cursor's transaction stays open
+    until the generator is exhausted or closed.
+
+    Args:
+      before: a cursor (see MakeCursor) to start after, or None.
+      limit: the maximum number of posts, or None for all of them.
+      batch_size: the number of posts fetched per round-trip.
+    '''
+    query, args = PostsQuery(before, limit)
+    return _IterRows(query, args, batch_size)
+
+def _PostFromRow(row):
+    '''Returns the dictionary of a (time, content_html, id[, rank]) row.'''
+    post = {'content': str(row[1]), 'time': str(row[0]), 'id': row[2]}
+    if len(row) > 3:
+        post['rank'] = row[3]
+    return post
+
+def _IterRows(query, args, batch_size):
+    '''Runs query on a server-side cursor and yields lists of posts.'''
+    DB = ConnectRead()
+    try:
+        c = DB.cursor(name='forum_posts')
+        c.execute(query, args)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [_PostFromRow(row) for row in rows]
+    finally:
+        Release(DB)
+
+
+## Text search configuration used for posts.search (see forum.sql).
+SEARCH_CONFIG = 'english'
+
+## Search cursors: the (rank, id) of the last result of a page.
+def MakeSearchCursor(post):
+    '''Returns the cursor that points just after the given search result.'''
+    return '%r,%d' % (post['rank'], post['id'])
+
+def ParseSearchCursor(cursor):
+    '''Splits a cursor made by MakeSearchCursor into (rank, id).
+
+    Raises:
+      ValueError: if the cursor is malformed.
+    '''
+    rank, sep, post_id = cursor.rpartition(',')
+    if not sep:
+        raise ValueError("Malformed cursor: %r" % cursor)
+    rank = float(rank)
+    if math.isnan(rank) or math.isinf(rank):
+        raise ValueError("Malformed cursor: %r" % cursor)
+    return rank, int(post_id)
+
+## Query behind SearchPosts and IterSearch.
+def SearchQuery(terms, cursor, limit):
+    '''Returns the (query, args) reading the posts that match, best first.
+
+    The matches are found through the GIN index on posts.search; only they
+    are ranked, and pages are cut with a (rank, id) keyset.
+    '''
+    query = """SELECT time, content_html, id, rank FROM
+                (SELECT time, content_html, id, ts_rank(search, q) AS rank
+                 FROM posts, websearch_to_tsquery(%s, %s) q
+                 WHERE search @@ q) matches"""
+    args = [SEARCH_CONFIG, terms]
+    if cursor is not None:
+        query += " WHERE (rank, id) < (%s::real, %s)"
+        args.extend(ParseSearchCursor(cursor))
+    query += " ORDER BY rank DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT %s"
+        args.append(limit)
+    return query, args
+
+## Search posts.
+def SearchPosts(query, limit=PAGE_SIZE, cursor=None):
+    '''Get a page of the posts matching a full-text query, best first.
+
+    Args:
+      query: the words to look for, in web search syntax ("a phrase",
+        or, -excluded).
+      limit: the maximum number of posts returned; None returns them all.
+      cursor: a cursor (see MakeSearchCursor); only the results ranked
+        after it are returned.  None starts from the best match.
+
+    Returns:
+      A list of dictionaries like those of GetAllPosts, with an extra
+      'rank' key.
     '''
-    #posts = [{'content': str(row[1]), 'time': str(row[0])} for row in DB]
-    #posts.sort(key=lambda row: row['time'], reverse=True)
+    sql, args = SearchQuery(query, cursor, limit)
+    DB = ConnectRead()
+    try:
+        c = DB.cursor()
+        c.execute(sql, args)
+        posts = [_PostFromRow(row) for row in c.fetchall()]
+    finally:
+        Release(DB)
     return posts
 
+## Stream search results.
+def IterSearch(query, cursor=None, limit=None, batch_size=BATCH_SIZE):
+    '''Yields the posts matching query, best first, in lists of at most
+    batch_size, like IterPosts does for the front page.
+    '''
+    sql, args = SearchQuery(query, cursor, limit)
+    return _IterRows(sql, args, batch_size)
+
+## Sanitizer: bleach.clean with a memo of the recent results.
+SANITIZE_CACHE_SIZE = 10000
+
+class SanitizeCache(object):
+    '''Remembers the sanitized form of recently seen post bodies.
+
+    Keys are the SHA-1 of the raw body, so a flood of identical posts is
+    cleaned once.  At most size results are kept (least recently used
+    first out).
+    '''
+
+    def __init__(self, size=SANITIZE_CACHE_SIZE, clean=bleach.clean):
+        self.size = size
+        self.clean = clean
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def sanitize(self, content):
+        '''Returns bleach.clean(content), from the memo when possible.'''
+        raw = content.encode('utf-8') if isinstance(content, unicode) \
+            else content
+        key = hashlib.sha1(raw).digest()
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is not None:
+                self.results[key] = result
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = self.clean(content)
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.results), 'maxsize': self.size}
+
+_sanitizer = SanitizeCache()
+
+def Sanitize(content):
+    '''Returns the HTML-safe form of a post body (see SanitizeCache).'''
+    return _sanitizer.sanitize(content)
+
+def SanitizeStats():
+    '''Returns the hit/miss counters of the sanitizer memo.'''
+    return _sanitizer.stats()
+
+## The row of a new post.
+def _CheckPost(content):
+    '''Rejects a post the database cannot store, without sanitizing it.
+
+    Raises:
+      ValueError: if the post holds a NUL character, or is not valid UTF-8
+        (UnicodeDecodeError).
+    '''
+    if '\x00' in content:
+        raise ValueError("Posts cannot contain NUL characters.")
+    if not isinstance(content, unicode):
+        content.decode('utf-8')
+
+def _PostRow(content):
+    '''Returns the (content, content_html) row that stores a post.
+
+    Raises:
+      ValueError: if the post cannot be stored (see _CheckPost).
+    '''
+    _CheckPost(content)
+    return content, Sanitize(content)
+
+## The INSERT of new posts.
+INSERT_POSTS = "INSERT INTO posts (content, content_html) VALUES %s"
+
 ## Add a post to the database.
 def AddPost(content):
     '''Add a new post to the database.
 
+    The body is sanitized once (here, or by the PostWriter's thread when
+    write-behind is on) and stored in content_html next to the raw text,
+    so reading the posts never cleans or escapes them again.  Every worker
+    is told (see PostsVersion) so cached pages are dropped.
+
     Args:
       content: The text content of the new post.
+
+    Raises:
+      ValueError: if the post cannot be stored (see _CheckPost), also when
+        write-behind is on.
     '''
     #t = time.strftime('%c', time.localtime())
     #DB.append((t, content))
 
-    DB = psycopg2.connect("dbname=forum")
-    c = DB.cursor()
-    content = bleach.clean(content)
-    c.execute("INSERT INTO posts (content) VALUES (%s)", (content,))
-    DB.commit()
-    DB.close()
+    writer = _writer
+    if writer is not None:
+        writer.add(content)
+        return
+    row = _PostRow(content)
+    DB = Connect()
+    try:
+        c = DB.cursor()
+        c.execute(INSERT_POSTS % "(%s, %s)", row)
+        _NotifyPosts(c)
+        DB.commit()
+    finally:
+        Release(DB)
+    _BumpVersion()
+
+## Write-behind queue: AddPost only queues, a thread writes in batches.
+class PostWriter(object):
+    '''Sanitizes and inserts queued posts in batches from one thread.
+
+    add() only checks that a post can be stored: the sanitizing is done by
+    the writer's thread, off the request.
+
+    A batch is written when it holds max_batch posts or when its oldest
+    post has waited max_delay seconds, with one multi-row INSERT.  The
+    queue holds at most max_queue posts: when it is full add() blocks, so a
+    slow database slows the posters down instead of eating memory.  A batch
+    that fails to insert is retried until it succeeds or the writer stops;
+    a post the database rejects is logged and dropped, the rest of its
+    batch is still written.
+    '''
+
+    def __init__(self, max_batch=100, max_delay=0.5, max_queue=10000):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.counters = {'queued': 0, 'written': 0, 'dropped': 0,
+                         'batches': 0, 'errors': 0, 'flush_ms_total': 0.0,
+                         'flush_ms_last': 0.0, 'flush_ms_max': 0.0}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, content):
+        '''Queues a post; it is sanitized and written later.
+
+        Raises:
+          ValueError: if the post cannot be stored (see _CheckPost).
+        '''
+        if self.stopping.is_set():
+            raise RuntimeError("The post writer is stopped.")
+        _CheckPost(content)
+        self.queue.put(content)
+        with self.lock:
+            self.counters['queued'] += 1
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            stopping = self.stopping.is_set()
+            drained = False
+            if len(batch) < self.max_batch:
+                try:
+                    if stopping:
+                        content = self.queue.get_nowait()
+                    elif batch:
+                        content = self.queue.get(
+                            timeout=max(0, deadline - time.time()))
+                    else:
+                        # wake up now and then to notice stop()
+                        content = self.queue.get(timeout=self.max_delay)
+                except Queue.Empty:
+                    drained = True
+                else:
+                    row = self._row(content)
+                    if row is not None:
+                        batch.append(row)
+                        if deadline is None:
+                            deadline = time.time() + self.max_delay
+            if not batch:
+                if stopping and drained:
+                    return
+                continue
+            if (len(batch) >= self.max_batch or time.time() >= deadline or
+                    (stopping and drained)):
+                try:
+                    flushed = self.flush(batch)
+                except Exception:
+                    # never lose the thread (and the queue) to a bug
+                    log.exception("Post writer: cannot write a batch")
+                    with self.lock:
+                        self.counters['errors'] += 1
+                    flushed = False
+                if flushed:
+                    batch = []
+                    deadline = None
+                elif stopping:
+                    return
+                else:
+                    time.sleep(self.max_delay)
+
+    def _row(self, content):
+        '''Returns the row of a queued post, or None (the post is logged and
+        dropped) if it cannot be sanitized.'''
+        try:
+            return content, Sanitize(content)
+        except Exception:
+            log.exception("Post writer: dropping a post that cannot be"
+                          " sanitized: %r", content[:100])
+            with self.lock:
+                self.counters['dropped'] += 1
+            return None
+
+    def flush(self, batch):
+        '''Writes a batch; returns False (and keeps it) on failure.
+
+        When the database rejects the batch because of its data, the rows
+        are inserted one by one and the ones still rejected are dropped.
+        '''
+        start = time.time()
+        DB = None
+        try:
+            DB = Connect()
+            c = DB.cursor()
+            try:
+                psycopg2.extras.execute_values(c, INSERT_POSTS, batch)
+                dropped = 0
+            except (psycopg2.DataError, psycopg2.IntegrityError, ValueError):
+                DB.rollback()
+                dropped = self._insertEach(c, batch)
+            _NotifyPosts(c)
+            DB.commit()
+        except psycopg2.Error:
+            log.warning("Post writer: cannot write a batch of %d posts",
+                        len(batch), exc_info=True)
+            with self.lock:
+                self.counters['errors'] += 1
+            return False
+        finally:
+            if DB is not None:
+                Release(DB)
+        _BumpVersion()
+        elapsed = (time.time() - start) * 1000.0
+        with self.lock:
+            self.counters['written'] += len(batch) - dropped
+            self.counters['dropped'] += dropped
+            self.counters['batches'] += 1
+            self.counters['flush_ms_total'] += elapsed
+            self.counters['flush_ms_last'] = elapsed
+            self.counters['flush_ms_max'] = max(elapsed,
+                                                self.counters['flush_ms_max'])
+        return True
+
+    def _insertEach(self, c, batch):
+        '''Inserts the rows of a batch one by one, each behind a savepoint;
+        returns the number of rows the database rejected.'''
+        dropped = 0
+        for row in batch:
+            c.execute("SAVEPOINT post")
+            try:
+                c.execute(INSERT_POSTS % "(%s, %s)", row)
+            except (psycopg2.DataError, psycopg2.IntegrityError,
+                    ValueError):
+                c.execute("ROLLBACK TO SAVEPOINT post")
+                log.error("Post writer: dropping a post the database"
+                          " rejects: %r", row[0][:100], exc_info=True)
+                dropped += 1
+            else:
+                c.execute("RELEASE SAVEPOINT post")
+        return dropped
+
+    def stop(self, timeout=30):
+        '''Writes out everything queued, waiting at most timeout seconds.
+
+        Returns the number of posts still queued (0 if all were written).
+        '''
+        self.stopping.set()
+        self.thread.join(timeout)
+        return self.stats()['queue_depth']
+
+    def stats(self):
+        '''Returns the queue depth, counters and flush latencies (ms).'''
+        with self.lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = (stats['queued'] - stats['written'] -
+                                stats['dropped'])
+        stats['flush_ms_avg'] = (stats['flush_ms_total'] / stats['batches']
+                                 if stats['batches'] else 0.0)
+        return stats
+
+_writer = None
+
+def EnableWriteBehind(max_batch=100, max_delay=0.5, max_queue=10000):
+    '''Makes AddPost queue the posts for a background PostWriter.
+
+    New posts show up on the forum after at most max_delay seconds.  The
+    queue is written out when the process exits (or on StopWriteBehind).
+    '''
+    global _writer
+    if _writer is None:
+        _writer = PostWriter(max_batch, max_delay, max_queue)
+        atexit.register(StopWriteBehind)
+    return _writer
+
+def StopWriteBehind(timeout=30):
+    '''Flushes the queued posts and goes back to writing them directly.'''
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        return writer.stop(timeout)
+    return 0
+
+def WriteBehindStats():
+    '''Returns the PostWriter metrics, or None if write-behind is off.'''
+    writer = _writer
+    if writer is None:
+        return None
+    return writer.stats()
     
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# bench_indexes.py -- query plans and timings of the hot tournament.py
+# queries without and with the indexes of migrations/001_indexes.sql
+#
+# A synthetic history (100 tournaments x 256 players x 8 rounds, about 100k
+# matches, by default) is seeded inside a transaction that is rolled back at
+# the end, so the benchmark can run against any up-to-date tournament
+# database without leaving anything behind.
+#
+# Usage: python bench_indexes.py [--dsn "dbname=tournament"]
+#            [--tournaments 100] [--players 256] [--rounds 8] [--repeat 50]
+#
+
+import argparse
+import random
+import timeit
+
+import psycopg2
+import psycopg2.extras
+
+import tournament
+
+
+# The indexes added by migrations/001_indexes.sql, dropped for the "before"
+# measurement.  The primary key stays: it replaced an equivalent unique
+# constraint.
+INDEXES = ['tournaments_players_player_idx',
+           'matches_tournament_winner_idx',
+           'matches_tournament_loser_idx',
+           'matches_byes_idx']
+
+# The statements tournament.py runs, taken from the module itself, and how
+# to draw their arguments from a tournament t and two of its players p1 and
+# p2.
+QUERIES = [
+    ('countPlayers', tournament.COUNT_PLAYERS.query,
+     lambda t, p1, p2: (t,)),
+    ('playerStandings', tournament.PLAYER_STANDINGS.query,
+     lambda t, p1, p2: (t,)),
+    ('alreadyPlay', tournament.ALREADY_PLAY.query,
+     lambda t, p1, p2: (t, p1, p2, p2, p1)),
+    ('hasBye', tournament.HAS_BYE.query,
+     lambda t, p1, p2: (t, p1)),
+    ('loadRematchIndex', tournament.REMATCH_INDEX_QUERY,
+     lambda t, p1, p2: (t,)),
+    ('loadPairingState', tournament.PAIRING_STATE_QUERY,
+     lambda t, p1, p2: (t,)),
+]
+
+
+def seed(c, tournaments, players, rounds):
+    """Inserts a synthetic history and returns {tournament_id: [player_ids]}."""
+    c.execute("SET LOCAL tournament.bulk_round = 'on'")
+    field = {}
+    matches = 0
+    for n in range(tournaments):
+        c.execute("INSERT INTO tournaments (name) VALUES (%s) RETURNING id",
+                  ('Benchmark %d' % n,))
+        tournament_id = c.fetchone()[0]
+        c.execute("""INSERT INTO players (name)
+                     SELECT 'Player ' || g FROM generate_series(1, %s) g
+                     RETURNING id""", (players,))
+        ids = [row[0] for row in c.fetchall()]
+        psycopg2.extras.execute_values(
+            c, """INSERT INTO tournaments_players (tournament_id, player_id)
+                  VALUES %s""", [(tournament_id, p) for p in ids])
+        rows = []
+        for _ in range(rounds):
+            order = list(ids)
+            random.shuffle(order)
+            if len(order) % 2:
+                bye = order.pop()
+                rows.append((tournament_id, bye, bye, False, 1))
+            for i in range(0, len(order), 2):
+                rows.append((tournament_id, order[i], order[i + 1],
+                             random.random() < 0.1, 0))
+        psycopg2.extras.execute_values(
+            c, """INSERT INTO matches
+                  (tournament_id, winner_id, loser_id, draw, bye)
+                  VALUES %s""", rows, page_size=1000)
+        c.execute("SELECT standings_rebuild(%s)", (tournament_id,))
+        field[tournament_id] = ids
+        matches += len(rows)
+    return field, matches
+
+
+def measure(c, field, repeat):
+    """Returns {query: (plan, median_ms, p95_ms)} over random arguments."""
+    c.execute("ANALYZE")
+    tournament_ids = list(field)
+    results = {}
+    for name, query, makeArgs in QUERIES:
+        samples = []
+        for _ in range(repeat):
+            t = random.choice(tournament_ids)
+            p1, p2 = random.sample(field[t], 2)
+            args = makeArgs(t, p1, p2)
+            start = timeit.default_timer()
+            c.execute(query, args)
+            c.fetchall()
+            samples.append((timeit.default_timer() - start) * 1000.0)
+        c.execute("EXPLAIN (ANALYZE, COSTS OFF) " + query, args)
+        plan = '\n'.join(row[0] for row in c.fetchall())
+        samples.sort()
+        results[name] = (plan, samples[len(samples) // 2],
+                         samples[min(len(samples) - 1,
+                                     int(len(samples) * 0.95))])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the tournament queries with and without'
+                    ' the indexes of migration 001.')
+    parser.add_argument('--dsn', default=tournament.DSN)
+    parser.add_argument('--tournaments', type=int, default=100)
+    parser.add_argument('--players', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    DB = psycopg2.connect(args.dsn)
+    try:
+        c = DB.cursor()
+        field, matches = seed(c, args.tournaments, args.players, args.rounds)
+        print("Seeded %d tournaments, %d players, %d matches."
+              % (len(field), args.tournaments * args.players, matches))
+
+        c.execute("SAVEPOINT with_indexes")
+        for index in INDEXES:
+            c.execute("DROP INDEX %s" % index)
+        before = measure(c, field, args.repeat)
+        c.execute("ROLLBACK TO SAVEPOINT with_indexes")
+        after = measure(c, field, args.repeat)
+    finally:
+        DB.rollback()
+        DB.close()
+
+    for name, _, _ in QUERIES:
+        print("\n=== %s ===" % name)
+        print("-- without indexes:\n%s" % before[name][0])
+        print("-- with indexes:\n%s" % after[name][0])
+    print("\n%-18s %12s %12s %12s %12s" % ('query', 'before p50', 'after p50',
+                                           'before p95', 'after p95'))
+    for name, _, _ in QUERIES:
+        print("%-18s %10.3fms %10.3fms %10.3fms %10.3fms"
+              % (name, before[name][1], after[name][1],
+                 before[name][2], after[name][2]))
+
+
+if __name__ == '__main__':
+    main()
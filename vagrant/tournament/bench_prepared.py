@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# bench_prepared.py -- the hot tournament.py statements run as plain
+# queries and as prepared statements (see dbaccess.Statement)
+#
+# The same synthetic history as bench_indexes.py is seeded inside a
+# transaction that is rolled back at the end.  Each statement is then run
+# --calls times both ways with random arguments, and its planning time is
+# read from EXPLAIN ANALYZE: the difference is what preparing saves on
+# every call.
+#
+# Usage: python bench_prepared.py [--dsn "dbname=tournament"]
+#            [--tournaments 100] [--players 256] [--rounds 8]
+#            [--calls 10000] [--explain 50]
+#
+
+import argparse
+import random
+import timeit
+
+import tournament
+import dbaccess
+from bench_indexes import seed
+
+
+# The prepared statements of tournament.py and how to draw their arguments
+# from a tournament t and two of its players p1 and p2.
+STATEMENTS = [
+    ('countPlayers', tournament.COUNT_PLAYERS,
+     lambda t, p1, p2: (t,)),
+    ('playerStandings', tournament.PLAYER_STANDINGS,
+     lambda t, p1, p2: (t,)),
+    ('alreadyPlay', tournament.ALREADY_PLAY,
+     lambda t, p1, p2: (t, p1, p2, p2, p1)),
+    ('hasBye', tournament.HAS_BYE,
+     lambda t, p1, p2: (t, p1)),
+    ('reportMatch', tournament.REPORT_MATCH,
+     lambda t, p1, p2: (t, p1, p2, False)),
+]
+
+
+def randomArgs(field, makeArgs):
+    t = random.choice(list(field))
+    p1, p2 = random.sample(field[t], 2)
+    return makeArgs(t, p1, p2)
+
+
+def timeCalls(c, field, makeArgs, run, calls):
+    """Returns the mean milliseconds of calls runs of run(c, args)."""
+    total = 0.0
+    for _ in range(calls):
+        args = randomArgs(field, makeArgs)
+        start = timeit.default_timer()
+        run(c, args)
+        if c.description is not None:
+            c.fetchall()
+        total += timeit.default_timer() - start
+    return total * 1000.0 / calls
+
+
+def planningTime(c, field, makeArgs, explain, prepared, statement):
+    """Returns the median planning time (ms) reported by EXPLAIN ANALYZE."""
+    samples = []
+    for _ in range(explain):
+        args = randomArgs(field, makeArgs)
+        query = statement.executeQuery if prepared else statement.query
+        c.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, args)
+        samples.append(c.fetchone()[0][0]['Planning Time'])
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the hot tournament statements as plain'
+                    ' queries and as prepared statements.')
+    parser.add_argument('--dsn', default=tournament.DSN)
+    parser.add_argument('--tournaments', type=int, default=100)
+    parser.add_argument('--players', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--explain', type=int, default=50,
+                        help='EXPLAIN ANALYZE samples per statement')
+    args = parser.parse_args()
+
+    DB = dbaccess.connect(args.dsn)
+    results = []
+    try:
+        c = DB.cursor()
+        field, matches = seed(c, args.tournaments, args.players, args.rounds)
+        c.execute("ANALYZE")
+        print("Seeded %d tournaments, %d players, %d matches."
+              % (len(field), args.tournaments * args.players, matches))
+        for name, statement, makeArgs in STATEMENTS:
+            plain = timeCalls(c, field, makeArgs,
+                              lambda c, a: c.execute(statement.query, a),
+                              args.calls)
+            prepared = timeCalls(c, field, makeArgs, statement.execute,
+                                 args.calls)
+            planPlain = planningTime(c, field, makeArgs, args.explain,
+                                     False, statement)
+            planPrepared = planningTime(c, field, makeArgs, args.explain,
+                                        True, statement)
+            results.append((name, plain, prepared, planPlain, planPrepared))
+    finally:
+        DB.rollback()
+        DB.close()
+
+    print("\n%-16s %11s %11s %11s %11s %13s"
+          % ('statement', 'plain', 'prepared', 'plan plain',
+             'plan prep.', 'saved/%d' % args.calls))
+    for name, plain, prepared, planPlain, planPrepared in results:
+        print("%-16s %9.3fms %9.3fms %9.3fms %9.3fms %11.1fms"
+              % (name, plain, prepared, planPlain, planPrepared,
+                 (plain - prepared) * args.calls))
+
+
+if __name__ == '__main__':
+    main()
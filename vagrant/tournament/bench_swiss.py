@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# bench_swiss.py -- Swiss tournament simulator and load benchmark
+#
+# Registers --tournaments events of --players players each and plays them to
+# the end (ceil(log2(players)) rounds, random winners and draws, one bye per
+# round when the field is odd) through the public functions of tournament.py.
+# For every function it records latency percentiles and the number of
+# queries it ran (counted by dbaccess), plus the connections the pool
+# opened, and writes the results as JSON so that two versions can be
+# compared with --compare.
+#
+# The tournaments and players it creates are deleted at the end (--keep to
+# leave them).
+#
+# Usage: python bench_swiss.py [--dsn "dbname=tournament"] [--players 64]
+#            [--tournaments 4] [--draws 0.1] [--batch] [--seed 1]
+#            [--output bench_swiss.json] [--compare old.json] [--keep]
+#
+
+import argparse
+import collections
+import json
+import math
+import random
+import time
+import timeit
+
+import tournament
+import dbaccess
+
+
+class Recorder(object):
+    """Times calls and counts their queries, per function name."""
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.queries = collections.defaultdict(int)
+
+    def call(self, function, *args):
+        before = dbaccess.queryCount()
+        start = timeit.default_timer()
+        result = function(*args)
+        elapsed = (timeit.default_timer() - start) * 1000.0
+        self.samples[function.__name__].append(elapsed)
+        self.queries[function.__name__] += dbaccess.queryCount() - before
+        return result
+
+    def report(self):
+        functions = {}
+        for name, samples in self.samples.items():
+            samples = sorted(samples)
+            functions[name] = {
+                'calls': len(samples),
+                'mean_ms': sum(samples) / len(samples),
+                'p50_ms': percentile(samples, 50),
+                'p90_ms': percentile(samples, 90),
+                'p99_ms': percentile(samples, 99),
+                'max_ms': samples[-1],
+                'queries': self.queries[name],
+                'queries_per_call': float(self.queries[name]) / len(samples),
+            }
+        return functions
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = int(math.ceil(p / 100.0 * len(samples)))
+    return samples[max(0, min(len(samples), rank) - 1)]
+
+
+def playTournament(recorder, rng, players, draws, batch):
+    """Registers and plays one Swiss tournament; returns its ids."""
+    t = recorder.call(tournament.registerTournament, 'Benchmark')
+    ids = recorder.call(tournament.registerPlayers,
+                        ['Player %d' % n for n in range(players)], t)
+    rounds = int(math.ceil(math.log(players, 2)))
+    for _ in range(rounds):
+        try:
+            pairs = recorder.call(tournament.swissPairings, t)
+        except tournament.PairingError:
+            break
+        results = []
+        for id1, name1, id2, name2 in pairs:
+            if rng.random() < 0.5:
+                id1, id2 = id2, id1
+            results.append((id1, id2, rng.random() < draws))
+        if batch:
+            recorder.call(tournament.reportMatches, t, results)
+        else:
+            for winner, loser, draw in results:
+                recorder.call(tournament.reportMatch, t, winner, loser, draw)
+        recorder.call(tournament.playerStandings, t)
+        recorder.call(tournament.countPlayers, t)
+    return t, ids
+
+
+def cleanUp(tournament_ids, player_ids):
+    """Deletes the tournaments and players the benchmark created."""
+    with tournament.getConnection() as DB:
+        c = DB.cursor()
+        c.execute("DELETE FROM tournaments WHERE id = ANY(%s)",
+                  (tournament_ids,))
+        c.execute("DELETE FROM players WHERE id = ANY(%s)", (player_ids,))
+        DB.commit()
+    tournament.invalidateTournament()
+
+
+def compare(old, new):
+    """Prints the p50 latency and queries per call of two reports."""
+    print("\n%-22s %12s %12s %8s %10s %10s" % (
+        'function', 'old p50', 'new p50', 'ratio', 'old q/call',
+        'new q/call'))
+    for name in sorted(set(old['functions']) | set(new['functions'])):
+        o = old['functions'].get(name)
+        n = new['functions'].get(name)
+        if o is None or n is None:
+            print("%-22s %s" % (name, 'only in the %s report'
+                                % ('new' if o is None else 'old')))
+            continue
+        ratio = n['p50_ms'] / o['p50_ms'] if o['p50_ms'] else float('nan')
+        print("%-22s %10.3fms %10.3fms %7.2fx %10.1f %10.1f" % (
+            name, o['p50_ms'], n['p50_ms'], ratio,
+            o['queries_per_call'], n['queries_per_call']))
+    print("%-22s %12d %12d" % ('connections opened',
+                               old['connections_opened'],
+                               new['connections_opened']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulates Swiss tournaments and benchmarks'
+                    ' tournament.py.')
+    parser.add_argument('--dsn', default=tournament.DSN)
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--tournaments', type=int, default=4)
+    parser.add_argument('--draws', type=float, default=0.1,
+                        help='probability of a draw')
+    parser.add_argument('--batch', action='store_true',
+                        help='report each round with reportMatches')
+    parser.add_argument('--pool-size', type=int,
+                        default=tournament.POOL_MAXCONN)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='',
+                        help='free text stored in the report')
+    parser.add_argument('--output', default='bench_swiss.json')
+    parser.add_argument('--compare', help='an earlier JSON report')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not delete the simulated tournaments')
+    args = parser.parse_args()
+
+    tournament.configurePool(minconn=1, maxconn=args.pool_size, dsn=args.dsn)
+    dbaccess.enableInstrumentation()
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    tournament_ids = []
+    player_ids = []
+    start = timeit.default_timer()
+    try:
+        for _ in range(args.tournaments):
+            t, ids = playTournament(recorder, rng, args.players, args.draws,
+                                    args.batch)
+            tournament_ids.append(t)
+            player_ids.extend(ids)
+        elapsed = timeit.default_timer() - start
+        pool = tournament.poolStats()
+    finally:
+        if not args.keep and tournament_ids:
+            cleanUp(tournament_ids, player_ids)
+        tournament.closePool()
+
+    report = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'players': args.players,
+                   'tournaments': args.tournaments,
+                   'draws': args.draws,
+                   'batch': args.batch,
+                   'pool_size': args.pool_size,
+                   'seed': args.seed},
+        'elapsed_s': elapsed,
+        'queries': sum(recorder.queries.values()),
+        'connections_opened': pool['opened'],
+        'pool': pool,
+        'functions': recorder.report(),
+        'queries_by_caller': dbaccess.queryStats(),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print("%d tournaments of %d players in %.2fs, %d queries, %d connections"
+          % (args.tournaments, args.players, elapsed, report['queries'],
+             report['connections_opened']))
+    print("%-22s %6s %10s %10s %10s %8s" % ('function', 'calls', 'p50',
+                                           'p90', 'p99', 'q/call'))
+    for name, f in sorted(report['functions'].items()):
+        print("%-22s %6d %8.3fms %8.3fms %8.3fms %8.1f" % (
+            name, f['calls'], f['p50_ms'], f['p90_ms'], f['p99_ms'],
+            f['queries_per_call']))
+    print("Report written to %s" % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
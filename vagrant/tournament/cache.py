@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# cache.py -- in-process LRU cache for the read functions of tournament.py
+#
+# Entries are keyed by (function name, tournament id, generation, version).
+# Writing to a tournament bumps its version (clearing everything bumps the
+# generation), so a value computed before a write can never be served after
+# it, even when the write lands while the value is being computed.
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TournamentCache(object):
+    """A thread-safe LRU cache with an optional time-to-live.
+
+    Args:
+      maxsize: maximum number of entries kept.
+      ttl: seconds an entry stays valid (None = until invalidated).
+      clock: function returning the current time, for tests.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, clock=time.time):
+        if maxsize < 1:
+            raise ValueError("The cache needs room for at least one entry.")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0,
+                          'expirations': 0, 'invalidations': 0}
+
+    def key(self, name, tournament_id):
+        """Returns the cache key of a call made now.
+
+        Take the key before reading the database: if a write lands while
+        the value is being computed, the value is stored under the old
+        version and is never served.
+        """
+        with self._lock:
+            return (name, tournament_id, self._generation,
+                    self._versions.get(tournament_id, 0))
+
+    def get(self, key):
+        """Returns (True, value) on a hit and (False, None) on a miss."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                storedAt, value = entry
+                if self.ttl is None or self._clock() - storedAt < self.ttl:
+                    self._entries[key] = entry
+                    self._counters['hits'] += 1
+                    return True, value
+                self._counters['expirations'] += 1
+            self._counters['misses'] += 1
+            return False, None
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entries."""
+        with self._lock:
+            if key[2:] != (self._generation,
+                           self._versions.get(key[1], 0)):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (self._clock(), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, tournament_id):
+        """Forgets every entry of a tournament."""
+        with self._lock:
+            self._versions[tournament_id] = (
+                self._versions.get(tournament_id, 0) + 1)
+            self._counters['invalidations'] += 1
+            for key in [k for k in self._entries if k[1] == tournament_id]:
+                del self._entries[key]
+
+    def clear(self):
+        """Forgets every entry of every tournament."""
+        with self._lock:
+            self._generation += 1
+            self._versions.clear()
+            self._entries.clear()
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size."""
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats['hits'] + stats['misses']
+            stats.update({'size': len(self._entries),
+                          'maxsize': self.maxsize,
+                          'ttl': self.ttl,
+                          'hit_ratio': (float(stats['hits']) / lookups
+                                        if lookups else 0.0)})
+        return stats
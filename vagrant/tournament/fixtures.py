@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# fixtures.py -- seeds large synthetic tournaments through COPY
+#
+# Every tournament gets its own players, registrations and a few played
+# rounds without rematches (circle method; one bye per round when the
+# field is odd).  All the rows are streamed with COPY, the standings
+# trigger is skipped and the standings are rebuilt once per tournament, so
+# millions of matches load in seconds rather than hours.
+#
+# Usage: python fixtures.py [--dsn "dbname=tournament"] [--tournaments 10]
+#            [--players 1000] [--rounds 10] [--draws 0.1] [--seed 1]
+#            [--reset]
+#
+
+import argparse
+import io
+import random
+import timeit
+
+import tournament
+
+
+def _reserveIds(c, sequence, count):
+    """Returns count fresh values of a sequence, with one query."""
+    c.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+              (sequence, count))
+    return [row[0] for row in c.fetchall()]
+
+
+def _copy(c, table, columns, rows):
+    """Loads rows into table with one COPY ... FROM STDIN."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write(u'\t'.join(
+            (u't' if value else u'f') if isinstance(value, bool)
+            else u'%s' % value for value in row))
+        buf.write(u'\n')
+    buf.seek(0)
+    c.copy_from(buf, table, columns=columns)
+
+
+def circleRounds(player_ids, rounds):
+    """Yields the pairings of the first rounds of a round robin.
+
+    Args:
+      player_ids: the players; with an odd number of them one sits out
+        each round.
+      rounds: how many rounds to yield (at most len(player_ids) - 1, or
+        len(player_ids) when odd, are rematch-free).
+
+    Yields:
+      For each round, a tuple (pairs, bye_id); bye_id is None when the
+      number of players is even.
+    """
+    seats = list(player_ids)
+    if len(seats) % 2:
+        seats.append(None)
+    half = len(seats) // 2
+    for _ in range(rounds):
+        pairs = []
+        bye = None
+        for i in range(half):
+            a, b = seats[i], seats[-1 - i]
+            if a is None or b is None:
+                bye = a if b is None else b
+            else:
+                pairs.append((a, b))
+        yield pairs, bye
+        # keep the first seat, rotate the others
+        seats.insert(1, seats.pop())
+
+
+def loadFixture(tournaments=10, players=1000, rounds=10, draws=0.1,
+                seed=None):
+    """Creates synthetic tournaments with COPY, in one transaction.
+
+    Args:
+      tournaments: how many tournaments to create.
+      players: players per tournament (new players for each one).
+      rounds: rounds played in each tournament.
+      draws: probability that a match is a draw.
+      seed: seed of the random results, for repeatable fixtures.
+
+    Returns:
+      A dict mapping each new tournament id to its list of player ids.
+    """
+    if rounds > players - 1 + players % 2:
+        raise ValueError("%d players cannot play %d rounds without a rematch."
+                         % (players, rounds))
+    rng = random.Random(seed)
+    with tournament.getConnection() as DB:
+        c = DB.cursor()
+        c.execute("SET LOCAL tournament.bulk_round = 'on'")
+        tournament_ids = _reserveIds(c, 'tournaments_id_seq', tournaments)
+        player_ids = _reserveIds(c, 'players_id_seq', tournaments * players)
+        field = {}
+        for n, t in enumerate(tournament_ids):
+            field[t] = player_ids[n * players:(n + 1) * players]
+        _copy(c, 'tournaments', ('id', 'name'),
+              ((t, u'Fixture %d' % t) for t in tournament_ids))
+        _copy(c, 'players', ('id', 'name'),
+              ((p, u'Player %d' % p) for p in player_ids))
+        _copy(c, 'tournaments_players', ('tournament_id', 'player_id'),
+              ((t, p) for t in tournament_ids for p in field[t]))
+
+        def matches():
+            for t in tournament_ids:
+                for pairs, bye in circleRounds(field[t], rounds):
+                    for a, b in pairs:
+                        if rng.random() < 0.5:
+                            a, b = b, a
+                        yield (t, a, b, rng.random() < draws, 0)
+                    if bye is not None:
+                        yield (t, bye, bye, False, 1)
+        _copy(c, 'matches',
+              ('tournament_id', 'winner_id', 'loser_id', 'draw', 'bye'),
+              matches())
+        c.execute("SELECT standings_rebuild(t) FROM unnest(%s::int[]) t",
+                  (tournament_ids,))
+        DB.commit()
+    tournament.invalidateTournament()
+    return field
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Loads synthetic tournaments with COPY.')
+    parser.add_argument('--dsn', default=tournament.DSN)
+    parser.add_argument('--tournaments', type=int, default=10)
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--draws', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reset', action='store_true',
+                        help='empty the database first (resetAll)')
+    args = parser.parse_args()
+    tournament.configurePool(dsn=args.dsn)
+    if args.reset:
+        tournament.resetAll()
+    start = timeit.default_timer()
+    field = loadFixture(args.tournaments, args.players, args.rounds,
+                        args.draws, args.seed)
+    print("Loaded %d tournaments of %d players (%d rounds) in %.1fs."
+          % (len(field), args.players, args.rounds,
+             timeit.default_timer() - start))
+    tournament.closePool()
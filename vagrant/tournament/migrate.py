@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# migrate.py -- upgrades an existing tournament database
+#
+# Applies, in order, the files of migrations/ whose version is not yet
+# recorded in schema_migrations.  Each file runs in its own transaction and
+# records its own version.  A database created from tournament.sql already
+# has every migration.
+#
+# Usage: python migrate.py [--dsn "dbname=tournament"] [--list]
+#
+
+import argparse
+import os
+import re
+
+import psycopg2
+
+import tournament
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+def availableMigrations():
+    """Returns the migration files as (version, name, path), sorted."""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), filename[:-4],
+                               os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+    return migrations
+
+
+def appliedVersions(c):
+    """Returns the set of versions recorded in schema_migrations."""
+    c.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name VARCHAR(100) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )""")
+    c.execute("SELECT version FROM schema_migrations")
+    return set(row[0] for row in c.fetchall())
+
+
+def migrate(dsn=None):
+    """Applies every pending migration to the database.
+
+    Args:
+      dsn: the connection string, defaults to tournament.DSN.
+
+    Returns:
+      The names of the migrations applied, in order.
+    """
+    DB = psycopg2.connect(dsn or tournament.DSN)
+    applied = []
+    try:
+        c = DB.cursor()
+        done = appliedVersions(c)
+        DB.commit()
+        for version, name, path in availableMigrations():
+            if version in done:
+                continue
+            with open(path) as f:
+                c.execute(f.read())
+            c.execute("SELECT 1 FROM schema_migrations WHERE version = %s",
+                      (version,))
+            if c.fetchone() is None:
+                raise ValueError(
+                    "Migration %s did not record its version." % name)
+            DB.commit()
+            applied.append(name)
+    finally:
+        DB.close()
+    return applied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Upgrades an existing tournament database.')
+    parser.add_argument('--dsn', default=tournament.DSN,
+                        help='connection string of the database to upgrade')
+    parser.add_argument('--list', action='store_true',
+                        help='only list the migrations and their state')
+    args = parser.parse_args()
+    if args.list:
+        DB = psycopg2.connect(args.dsn)
+        done = appliedVersions(DB.cursor())
+        DB.rollback()
+        DB.close()
+        for version, name, path in availableMigrations():
+            state = 'applied' if version in done else 'pending'
+            print("%-40s %s" % (name, state))
+    else:
+        names = migrate(args.dsn)
+        print("Applied %d migration(s): %s" % (len(names),
+                                               ', '.join(names) or '-'))
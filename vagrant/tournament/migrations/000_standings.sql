@@ -0,0 +1,196 @@
+-- Migration 000: standings kept in tournaments_players.
+--
+-- The wins, draws, matches, byes and omw columns are the player's standing
+-- in the tournament.  They are kept up to date by the matches_standings
+-- trigger, so they must not be written by hand.  A player can only be
+-- registered once on each tournament (registerPlayers relies on that).
+--
+-- Every statement can run again on a database that already has them, so
+-- databases created before this migration was numbered upgrade too.
+
+ALTER TABLE tournaments_players
+  ADD COLUMN IF NOT EXISTS wins INT NOT NULL DEFAULT 0,
+  ADD COLUMN IF NOT EXISTS draws INT NOT NULL DEFAULT 0,
+  ADD COLUMN IF NOT EXISTS matches INT NOT NULL DEFAULT 0,
+  ADD COLUMN IF NOT EXISTS byes INT NOT NULL DEFAULT 0,
+  ADD COLUMN IF NOT EXISTS omw INT NOT NULL DEFAULT 0;
+
+-- Unless migration 001 already made (tournament_id, player_id) the primary
+-- key: drop repeated registrations, then make them impossible.
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                  WHERE conrelid = 'tournaments_players'::regclass
+                    AND contype IN ('p', 'u')) THEN
+    DELETE FROM tournaments_players a
+     USING tournaments_players b
+     WHERE a.tournament_id = b.tournament_id
+       AND a.player_id = b.player_id
+       AND a.ctid > b.ctid;
+    ALTER TABLE tournaments_players
+      ADD CONSTRAINT tournaments_players_tournament_id_player_id_key
+      UNIQUE (tournament_id, player_id);
+  END IF;
+END;
+$$;
+
+-- In the order of playerStandings.  Dropped first: older databases have it
+-- with the OMW ascending.
+DROP INDEX IF EXISTS tournaments_players_standings_idx;
+CREATE INDEX tournaments_players_standings_idx
+  ON tournaments_players (tournament_id, wins DESC, omw DESC);
+
+CREATE OR REPLACE VIEW standings AS
+  SELECT tp.tournament_id, p.id, p.name,
+         tp.wins, tp.draws, tp.matches, tp.byes, tp.omw
+    FROM tournaments_players tp JOIN players p ON (p.id = tp.player_id);
+
+-- STANDINGS MAINTENANCE
+-- Every insert, update or delete on matches adjusts the aggregate columns of
+-- tournaments_players. A bye counts as a win and a match for its player.
+-- OMW (Opponent Match Wins) is the sum of the wins, inside the tournament, of
+-- every opponent a player met (byes are not opponents).
+--
+-- A match updates its two players and every earlier opponent of the
+-- winner, so two matches of a tournament reported at once would lock the
+-- same rows in different orders (and read each other's wins half done).
+-- The standings of a tournament are therefore changed by one transaction at
+-- a time: standings_lock waits for the others until the end of the current
+-- one.
+
+CREATE OR REPLACE FUNCTION standings_lock(t INT) RETURNS VOID AS $$
+  SELECT pg_advisory_xact_lock(hashtext('tournament.standings'), t);
+$$ LANGUAGE sql;
+
+-- Adds (sign = 1) or removes (sign = -1) the OMW the two players of a match
+-- give each other.
+CREATE OR REPLACE FUNCTION standings_link(m matches, sign INT)
+RETURNS VOID AS $$
+BEGIN
+  UPDATE tournaments_players tp
+     SET omw = tp.omw + sign * o.wins
+    FROM tournaments_players o
+   WHERE tp.tournament_id = m.tournament_id
+     AND o.tournament_id = m.tournament_id
+     AND ((tp.player_id = m.winner_id AND o.player_id = m.loser_id)
+       OR (tp.player_id = m.loser_id AND o.player_id = m.winner_id));
+END;
+$$ LANGUAGE plpgsql;
+
+-- Applies (sign = 1) or reverts (sign = -1) one match on the standings.
+CREATE OR REPLACE FUNCTION standings_apply(m matches, sign INT)
+RETURNS VOID AS $$
+DECLARE
+  won INT := CASE WHEN m.draw THEN 0 ELSE 1 END;
+BEGIN
+  PERFORM standings_lock(m.tournament_id);
+
+  -- Unlink the opponents while the wins still include this match.
+  IF sign < 0 AND m.bye = 0 THEN
+    PERFORM standings_link(m, sign);
+  END IF;
+
+  UPDATE tournaments_players
+     SET wins = wins + sign * won,
+         draws = draws + sign * (1 - won),
+         matches = matches + sign,
+         byes = byes + sign * (CASE WHEN m.bye <> 0 THEN 1 ELSE 0 END)
+   WHERE tournament_id = m.tournament_id AND player_id = m.winner_id;
+  IF m.bye = 0 THEN
+    UPDATE tournaments_players
+       SET draws = draws + sign * (1 - won),
+           matches = matches + sign
+     WHERE tournament_id = m.tournament_id AND player_id = m.loser_id;
+  END IF;
+
+  -- Every earlier opponent of the winner gains (or loses) one opponent win.
+  IF won = 1 THEN
+    UPDATE tournaments_players tp
+       SET omw = tp.omw + sign * o.n
+      FROM (SELECT CASE WHEN x.winner_id = m.winner_id
+                        THEN x.loser_id ELSE x.winner_id END AS player_id,
+                   COUNT(*) AS n
+              FROM matches x
+             WHERE x.tournament_id = m.tournament_id
+               AND x.bye = 0
+               AND x.id <> m.id
+               AND (x.winner_id = m.winner_id OR x.loser_id = m.winner_id)
+             GROUP BY 1) o
+     WHERE tp.tournament_id = m.tournament_id AND tp.player_id = o.player_id;
+  END IF;
+
+  IF sign > 0 AND m.bye = 0 THEN
+    PERFORM standings_link(m, sign);
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- reportMatches sets tournament.bulk_round for its transaction: it writes a
+-- whole round and then calls standings_rebuild once instead.  On a
+-- partitioned database the rows come from a partition, whose row type is
+-- not matches: they are converted first.
+CREATE OR REPLACE FUNCTION standings_on_match() RETURNS TRIGGER AS $$
+BEGIN
+  IF current_setting('tournament.bulk_round', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    PERFORM standings_apply(ROW(OLD.*)::matches, -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM standings_apply(ROW(NEW.*)::matches, 1);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS matches_standings ON matches;
+CREATE TRIGGER matches_standings
+  AFTER INSERT OR UPDATE OR DELETE ON matches
+  FOR EACH ROW EXECUTE PROCEDURE standings_on_match();
+
+-- Recomputes the standings of a whole tournament from its matches, in three
+-- set-based statements. Useful to repair the aggregates or to load matches
+-- in bulk.
+CREATE OR REPLACE FUNCTION standings_rebuild(t INT) RETURNS VOID AS $$
+BEGIN
+  PERFORM standings_lock(t);
+
+  UPDATE tournaments_players
+     SET wins = 0, draws = 0, matches = 0, byes = 0, omw = 0
+   WHERE tournament_id = t;
+
+  UPDATE tournaments_players tp
+     SET wins = s.wins, draws = s.draws, matches = s.matches, byes = s.byes
+    FROM (SELECT r.player_id, SUM(r.won) AS wins, SUM(r.drawn) AS draws,
+                 COUNT(*) AS matches, SUM(r.bye) AS byes
+            FROM (SELECT winner_id AS player_id,
+                         CASE WHEN draw THEN 0 ELSE 1 END AS won,
+                         CASE WHEN draw THEN 1 ELSE 0 END AS drawn,
+                         CASE WHEN bye <> 0 THEN 1 ELSE 0 END AS bye
+                    FROM matches WHERE tournament_id = t
+                  UNION ALL
+                  SELECT loser_id, 0, CASE WHEN draw THEN 1 ELSE 0 END, 0
+                    FROM matches WHERE tournament_id = t AND bye = 0) r
+           GROUP BY r.player_id) s
+   WHERE tp.tournament_id = t AND tp.player_id = s.player_id;
+
+  UPDATE tournaments_players tp
+     SET omw = s.omw
+    FROM (SELECT r.player_id, SUM(o.wins) AS omw
+            FROM (SELECT winner_id AS player_id, loser_id AS opponent_id
+                    FROM matches WHERE tournament_id = t AND bye = 0
+                  UNION ALL
+                  SELECT loser_id, winner_id
+                    FROM matches WHERE tournament_id = t AND bye = 0) r
+            JOIN tournaments_players o
+              ON (o.tournament_id = t AND o.player_id = r.opponent_id)
+           GROUP BY r.player_id) s
+   WHERE tp.tournament_id = t AND tp.player_id = s.player_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The standings of the matches already played.
+SELECT standings_rebuild(id) FROM tournaments;
+
+INSERT INTO schema_migrations (version, name) VALUES (0, '000_standings');
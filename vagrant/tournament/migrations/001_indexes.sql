@@ -0,0 +1,29 @@
+-- Migration 001: indexes and constraints for the per-tournament lookups.
+--
+-- Every query in tournament.py filters matches on tournament_id plus
+-- winner_id and/or loser_id, and tournaments_players on tournament_id.
+
+-- A registration is identified by its tournament and player. The primary key
+-- replaces the plain unique constraint of migration 000 (and makes both
+-- columns NOT NULL).
+ALTER TABLE tournaments_players
+  DROP CONSTRAINT IF EXISTS tournaments_players_tournament_id_player_id_key;
+ALTER TABLE tournaments_players
+  ADD PRIMARY KEY (tournament_id, player_id);
+
+-- Deleting a player cascades into tournaments_players by player_id.
+CREATE INDEX tournaments_players_player_idx
+  ON tournaments_players (player_id);
+
+-- alreadyPlay, loadRematchIndex and the standings trigger.
+CREATE INDEX matches_tournament_winner_idx
+  ON matches (tournament_id, winner_id);
+CREATE INDEX matches_tournament_loser_idx
+  ON matches (tournament_id, loser_id);
+
+-- Byes are a small fraction of the matches: keep them in their own index,
+-- which hasBye (a bye is stored with the player as winner) reads alone.
+CREATE INDEX matches_byes_idx
+  ON matches (tournament_id, winner_id) WHERE bye <> 0;
+
+INSERT INTO schema_migrations (version, name) VALUES (1, '001_indexes');
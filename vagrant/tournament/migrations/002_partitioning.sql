@@ -0,0 +1,108 @@
+-- Migration 002: per-tournament partitions, archiving and purging.
+--
+-- On a database created with psql -v partitioned=1 (see tournament.sql),
+-- matches and tournaments_players are partitioned by LIST (tournament_id):
+-- every tournament gets its own partition of each when it is inserted, and
+-- archiving or purging a tournament detaches or drops them instead of
+-- deleting its rows.  On a regular database the same functions fall back to
+-- indexed bulk deletes.
+
+-- Detached (archived) tournaments are kept in this schema.
+CREATE SCHEMA IF NOT EXISTS archive;
+
+CREATE FUNCTION tournament_partitioned() RETURNS BOOLEAN AS $$
+  SELECT EXISTS (SELECT 1 FROM pg_partitioned_table
+                  WHERE partrelid = 'matches'::regclass);
+$$ LANGUAGE sql STABLE;
+
+-- Creates the partitions of tournament t (no-op on a regular database).
+CREATE FUNCTION tournament_partitions_create(t INT) RETURNS VOID AS $$
+BEGIN
+  IF tournament_partitioned() THEN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF matches'
+                   ' FOR VALUES IN (%s)', 'matches_t' || t, t);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I'
+                   ' PARTITION OF tournaments_players FOR VALUES IN (%s)',
+                   'tournaments_players_t' || t, t);
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION tournaments_partitions_on_insert() RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM tournament_partitions_create(NEW.id);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournaments_partitions
+  AFTER INSERT ON tournaments
+  FOR EACH ROW EXECUTE PROCEDURE tournaments_partitions_on_insert();
+
+-- Removes tournament t, its registrations and its matches.  With keep, they
+-- are moved to archive.matches_t<t> and archive.tournaments_players_t<t>
+-- (without their foreign keys) instead of being thrown away.  Partitions
+-- are detached or dropped, which costs the same for any number of rows.
+-- Returns false if the tournament does not exist.
+CREATE FUNCTION tournament_archive(t INT, keep BOOLEAN) RETURNS BOOLEAN AS $$
+DECLARE
+  tbl TEXT;
+  fk TEXT;
+BEGIN
+  PERFORM 1 FROM tournaments WHERE id = t FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN false;
+  END IF;
+  FOREACH tbl IN ARRAY ARRAY['matches', 'tournaments_players'] LOOP
+    IF tournament_partitioned() THEN
+      IF to_regclass(format('%I', tbl || '_t' || t)) IS NOT NULL THEN
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I',
+                       tbl, tbl || '_t' || t);
+        IF keep THEN
+          FOR fk IN SELECT conname FROM pg_constraint
+                     WHERE conrelid = format('%I', tbl || '_t' || t)::regclass
+                       AND contype = 'f' LOOP
+            EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I',
+                           tbl || '_t' || t, fk);
+          END LOOP;
+          EXECUTE format('ALTER TABLE %I SET SCHEMA archive',
+                         tbl || '_t' || t);
+        ELSE
+          EXECUTE format('DROP TABLE %I', tbl || '_t' || t);
+        END IF;
+      END IF;
+    ELSE
+      IF keep THEN
+        EXECUTE format('CREATE TABLE archive.%I AS'
+                       ' SELECT * FROM %I WHERE tournament_id = %s',
+                       tbl || '_t' || t, tbl, t);
+      END IF;
+      -- The registrations go too: the standings need no maintenance.
+      PERFORM set_config('tournament.bulk_round', 'on', true);
+      EXECUTE format('DELETE FROM %I WHERE tournament_id = %s', tbl, t);
+      PERFORM set_config('tournament.bulk_round', 'off', true);
+    END IF;
+  END LOOP;
+  DELETE FROM tournaments WHERE id = t;
+  RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drops every per-tournament partition (resetAll and deleteTournaments
+-- leave them empty).
+CREATE FUNCTION tournament_partitions_drop() RETURNS VOID AS $$
+DECLARE
+  part REGCLASS;
+BEGIN
+  FOR part IN SELECT inhrelid::regclass FROM pg_inherits
+               WHERE inhparent IN ('matches'::regclass,
+                                   'tournaments_players'::regclass) LOOP
+    EXECUTE format('DROP TABLE %s', part);
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Tournaments created before this migration on a partitioned database.
+SELECT tournament_partitions_create(id) FROM tournaments;
+
+INSERT INTO schema_migrations (version, name) VALUES (2, '002_partitioning');
@@ -0,0 +1,11 @@
+-- Migration 003: the tiebreaks of each tournament.
+--
+-- Read by state.TournamentState.ranking() (see tiebreaks.py) and changed
+-- with tournament.setTiebreaks().  The order of the array is the order in
+-- which they are applied.
+
+ALTER TABLE tournaments
+  ADD COLUMN tiebreaks TEXT[] NOT NULL DEFAULT '{omw}'
+  CHECK (tiebreaks <@ ARRAY['omw', 'omw_pct', 'sos', 'head_to_head']);
+
+INSERT INTO schema_migrations (version, name) VALUES (3, '003_tiebreaks');
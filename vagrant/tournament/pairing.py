@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# pairing.py -- in-memory Swiss pairing engine used by tournament.py
+#
+# Nothing in here touches the database: tournament.py loads the standings
+# and the whole match history once and hands them to pairRound().
+#
+
+
+class PairingError(Exception):
+    """Raised when a round cannot be paired without a rematch."""
+
+
+class RematchIndex(object):
+    """The set of pairs that already met, plus the players that had a bye.
+
+    Pairs are stored as frozensets of player ids, so lookups are O(1) and
+    do not depend on who won.
+    """
+
+    __slots__ = ('_pairs', '_byes')
+
+    def __init__(self):
+        self._pairs = set()
+        self._byes = set()
+
+    @classmethod
+    def fromMatches(cls, rows):
+        """Builds the index from (winner_id, loser_id, bye) match rows."""
+        index = cls()
+        for winner_id, loser_id, bye in rows:
+            if bye:
+                index.addBye(winner_id)
+            else:
+                index.add(winner_id, loser_id)
+        return index
+
+    @classmethod
+    def fromOpponents(cls, rows):
+        """Builds the index from (player_id, opponent_ids, has_bye) rows."""
+        index = cls()
+        for player_id, opponent_ids, has_bye in rows:
+            for opponent_id in opponent_ids:
+                index.add(player_id, opponent_id)
+            if has_bye:
+                index.addBye(player_id)
+        return index
+
+    def add(self, player_id1, player_id2):
+        """Records that two players have played each other."""
+        self._pairs.add(frozenset((player_id1, player_id2)))
+
+    def addBye(self, player_id):
+        """Records that a player has received a bye."""
+        self._byes.add(player_id)
+
+    def played(self, player_id1, player_id2):
+        """True if the two players already met."""
+        return frozenset((player_id1, player_id2)) in self._pairs
+
+    def hadBye(self, player_id):
+        """True if the player already received a bye."""
+        return player_id in self._byes
+
+    def __len__(self):
+        return len(self._pairs)
+
+
+def pairPlayers(player_ids, index, maxSteps=100000):
+    """Pairs every player in player_ids without repeating a match.
+
+    player_ids must be sorted by standing.  Each player is paired with the
+    closest-ranked opponent still free, so players stay inside their score
+    group and only float down when the group cannot be paired.  When a
+    choice leads to a dead end the engine backtracks and tries the next
+    opponent, so it finds a rematch-free pairing whenever one exists.
+
+    Args:
+      player_ids: an even-length list of player ids, best standing first.
+      index: the RematchIndex of the tournament.
+      maxSteps: number of search steps before giving up.
+
+    Returns:
+      A list of (id1, id2) tuples in standings order.
+
+    Raises:
+      PairingError: if no rematch-free pairing exists (or none was found
+        within maxSteps).
+    """
+    n = len(player_ids)
+    if n % 2 != 0:
+        raise ValueError("pairPlayers needs an even number of players.")
+    used = [False] * n
+    chosen = []
+    i = 0
+    start = None
+    steps = 0
+    while True:
+        while i < n and used[i]:
+            i += 1
+        if i == n:
+            return [(player_ids[a], player_ids[b]) for a, b in chosen]
+        steps += 1
+        if steps > maxSteps:
+            raise PairingError(
+                "Gave up pairing after %d search steps." % maxSteps)
+        used[i] = True
+        j = i + 1 if start is None else start
+        while j < n and (used[j] or
+                         index.played(player_ids[i], player_ids[j])):
+            j += 1
+        if j < n:
+            used[j] = True
+            chosen.append((i, j))
+            i += 1
+            start = None
+        else:
+            used[i] = False
+            if not chosen:
+                raise PairingError(
+                    "Every possible pairing contains a rematch.")
+            i, j = chosen.pop()
+            used[i] = used[j] = False
+            start = j + 1
+
+
+def pairRound(player_ids, index, maxSteps=100000):
+    """Computes the pairings of the next round, choosing a bye if needed.
+
+    With an odd number of players the lowest-ranked player without a
+    previous bye sits out; if the others cannot be paired around that
+    player, the next candidate up the standings is tried.
+
+    Args:
+      player_ids: the player ids sorted by standing, best first.
+      index: the RematchIndex of the tournament.
+      maxSteps: search budget for each attempt.
+
+    Returns:
+      A tuple (pairs, bye_id).  pairs is a list of (id1, id2) tuples and
+      bye_id is the player receiving the bye, or None for an even field.
+    """
+    player_ids = list(player_ids)
+    if len(player_ids) % 2 == 0:
+        return pairPlayers(player_ids, index, maxSteps), None
+    candidates = [p for p in reversed(player_ids) if not index.hadBye(p)]
+    if not candidates:
+        # Everybody already had a bye: fall back to the last player.
+        candidates = [player_ids[-1]]
+    for bye_id in candidates:
+        rest = [p for p in player_ids if p != bye_id]
+        try:
+            return pairPlayers(rest, index, maxSteps), bye_id
+        except PairingError:
+            continue
+    raise PairingError("No bye candidate leaves a rematch-free pairing.")
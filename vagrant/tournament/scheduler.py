@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# scheduler.py -- pairs the next round of many tournaments at once
+#
+# The state of every tournament (standings, byes and previous opponents) is
+# read with one query, the pairings are computed in a pool of worker
+# processes (pairing is CPU-bound and does not need the database) and the
+# byes of every tournament are recorded with one INSERT.
+#
+
+import argparse
+import multiprocessing
+import timeit
+
+import psycopg2.extras
+
+import tournament
+from pairing import PairingError, RematchIndex, pairRound
+
+
+# tournament.PAIRING_STATE_QUERY for a list of tournaments at once.
+PAIRING_STATES_QUERY = """
+    SELECT s.tournament_id, s.id, s.name, s.byes > 0 AS has_bye,
+        ARRAY(SELECT CASE WHEN m.winner_id = s.id
+                          THEN m.loser_id
+                          ELSE m.winner_id END
+              FROM matches m
+              WHERE m.tournament_id = s.tournament_id
+                  AND m.bye = 0
+                  AND (m.winner_id = s.id OR m.loser_id = s.id)
+        ) AS opponents
+    FROM standings s
+    WHERE s.tournament_id = ANY(%s)
+    ORDER BY s.tournament_id, s.wins DESC, s.omw DESC, s.id"""
+
+# Below this many tournaments the pairings are computed in this process:
+# starting workers would cost more than it saves.
+MIN_PARALLEL = 4
+
+
+def loadPairingStates(tournament_ids):
+    """Loads the pairing state of many tournaments with a single query.
+
+    Returns:
+      A dict mapping each tournament id to its list of (id, name, has_bye,
+      opponents) rows in pairing order.  Tournaments without players map
+      to an empty list.
+    """
+    tournament_ids = list(tournament_ids)
+    states = dict((t, []) for t in tournament_ids)
+    with tournament.getConnection() as DB:
+        c = DB.cursor()
+        c.execute(PAIRING_STATES_QUERY, (tournament_ids,))
+        for row in c.fetchall():
+            states[row[0]].append(row[1:])
+    return states
+
+
+def _pairTournament(job):
+    """Pairs one tournament; runs in a worker process.
+
+    Args:
+      job: a (tournament_id, [(player_id, has_bye, opponents)], maxSteps)
+        tuple, players in pairing order.
+
+    Returns:
+      A (tournament_id, pairs, bye_id, error, elapsed_ms) tuple; error is
+      the PairingError message, or None.
+    """
+    tournament_id, players, maxSteps = job
+    start = timeit.default_timer()
+    index = RematchIndex.fromOpponents(
+        (player_id, opponents, has_bye)
+        for player_id, has_bye, opponents in players)
+    try:
+        pairs, byePlayer = pairRound([p[0] for p in players], index,
+                                     maxSteps)
+        error = None
+    except PairingError as e:
+        pairs, byePlayer, error = [], None, str(e)
+    elapsed = (timeit.default_timer() - start) * 1000.0
+    return tournament_id, pairs, byePlayer, error, elapsed
+
+
+def pairTournaments(tournament_ids, processes=None, maxSteps=100000):
+    """Computes the next round of many tournaments.
+
+    Each tournament is paired with the rules of tournament.swissPairings,
+    and with an odd number of players its bye is recorded.  A tournament
+    that cannot be paired does not stop the others: its entry carries the
+    error instead.
+
+    Args:
+      tournament_ids: the ids of the tournaments to pair.
+      processes: the number of worker processes (default: one per CPU);
+        0 computes every pairing in this process.
+      maxSteps: the search budget of each tournament (see pairing.py).
+
+    Returns:
+      A dict mapping each tournament id to a dict with the keys
+        pairings: a list of (id1, name1, id2, name2) tuples,
+        bye: the id of the player who got a bye, or None,
+        error: None, or why the tournament could not be paired,
+        pair_ms: the time spent computing its pairings.
+    """
+    states = loadPairingStates(tournament_ids)
+    jobs = [(t, [(row[0], row[2], row[3]) for row in rows], maxSteps)
+            for t, rows in states.items()]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 2 or len(jobs) < MIN_PARALLEL:
+        results = [_pairTournament(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            results = pool.map(_pairTournament, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    rounds = {}
+    byes = []
+    for t, pairs, byePlayer, error, elapsed in results:
+        names = dict((row[0], row[1]) for row in states[t])
+        rounds[t] = {'pairings': [(id1, names[id1], id2, names[id2])
+                                  for id1, id2 in pairs],
+                     'bye': byePlayer,
+                     'error': error,
+                     'pair_ms': elapsed}
+        if byePlayer is not None:
+            byes.append((t, byePlayer, byePlayer, False, 1))
+    if byes:
+        with tournament.getConnection() as DB:
+            c = DB.cursor()
+            query = """INSERT INTO matches
+                        (tournament_id, winner_id, loser_id, draw, bye)
+                        VALUES %s"""
+            psycopg2.extras.execute_values(c, query, byes, page_size=1000)
+            DB.commit()
+        for row in byes:
+            tournament.invalidateTournament(row[0])
+    return rounds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pairs the next round of several tournaments.')
+    parser.add_argument('tournament_ids', type=int, nargs='+')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    for t, plan in sorted(pairTournaments(args.tournament_ids,
+                                          args.processes).items()):
+        if plan['error']:
+            print("Tournament %d: %s" % (t, plan['error']))
+            continue
+        print("Tournament %d (%.1f ms)" % (t, plan['pair_ms']))
+        for id1, name1, id2, name2 in plan['pairings']:
+            print("  %s vs %s" % (name1, name2))
+        if plan['bye'] is not None:
+            print("  bye: %d" % plan['bye'])
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# state.py -- a tournament held in memory between database writes
+#
+# TournamentState.load() reads a tournament with one query.  From then on
+# results are applied to the in-memory standings (the same wins, draws,
+# matches, byes and OMW that the matches_standings trigger maintains) and
+# queued; flush() writes the queue with one INSERT.  Reads never touch the
+# database.  The tiebreaks of ranking() (see tiebreaks.py) are kept up to
+# date the same way.
+#
+
+from array import array
+
+import psycopg2.extras
+
+import tournament
+from pairing import pairRound
+from tiebreaks import DEFAULT_TIEBREAKS, checkTiebreaks, matchWinPct, rankSlots
+
+
+# Every player of a tournament with his or her standing, the ids of the
+# opponents met, one entry per match, and the points (two for a win, one
+# for a draw) scored in each of those matches.
+STATE_QUERY = """
+    SELECT s.id, s.name, s.wins, s.draws, s.matches, s.byes, s.omw,
+        r.opponents, r.points
+    FROM standings s
+    CROSS JOIN LATERAL (
+        SELECT ARRAY_AGG(CASE WHEN m.winner_id = s.id
+                              THEN m.loser_id
+                              ELSE m.winner_id END ORDER BY m.id)
+                   AS opponents,
+               ARRAY_AGG(CASE WHEN m.draw THEN 1
+                              WHEN m.winner_id = s.id THEN 2
+                              ELSE 0 END ORDER BY m.id) AS points
+        FROM matches m
+        WHERE m.tournament_id = s.tournament_id
+            AND m.bye = 0
+            AND (m.winner_id = s.id OR m.loser_id = s.id)
+    ) r
+    WHERE s.tournament_id = %s
+    ORDER BY s.id"""
+
+TIEBREAKS_QUERY = "SELECT tiebreaks FROM tournaments WHERE id = %s"
+
+
+class TournamentState(object):
+    """The players, standings and match graph of one tournament.
+
+    Players are numbered by slot; the standing columns are arrays indexed
+    by slot, each player's opponents are an array of slots (one entry per
+    match) and the pairs that already met are a set of integers, so
+    hasBye and alreadyPlay are O(1) and standings is a sort of the arrays.
+
+    The tiebreaks are totals kept per slot as well: sos (the opponents'
+    scores, in half points), oppPct (the sum of the opponents' match-win
+    percentages) and h2h (the half points scored by one slot against
+    another).  A result updates them for the two players and their
+    previous opponents only.
+
+    Also usable as the index argument of pairing.pairRound (see played
+    and hadBye).
+    """
+
+    __slots__ = ('tournament_id', 'tiebreaks', 'ids', 'names', '_slots',
+                 'wins', 'draws', 'matches', 'byes', 'omw', 'opponents',
+                 'sos', 'oppPct', 'h2h', '_met', '_pending')
+
+    def __init__(self, tournament_id, players=(), tiebreaks=DEFAULT_TIEBREAKS):
+        """Builds the state from (id, name, wins, draws, matches, byes,
+        omw, opponent_ids, points) rows; see load()."""
+        players = list(players)
+        self.tournament_id = tournament_id
+        self.tiebreaks = checkTiebreaks(tiebreaks)
+        self.ids = array('i', [row[0] for row in players])
+        self.names = [row[1] for row in players]
+        self._slots = dict((player_id, slot)
+                           for slot, player_id in enumerate(self.ids))
+        self.wins = array('i', [row[2] for row in players])
+        self.draws = array('i', [row[3] for row in players])
+        self.matches = array('i', [row[4] for row in players])
+        self.byes = array('i', [row[5] for row in players])
+        self.omw = array('i', [row[6] for row in players])
+        self.opponents = [array('i', [self._slots[o] for o in row[7] or ()])
+                          for row in players]
+        self._met = set()
+        self.h2h = {}
+        for slot, opponents in enumerate(self.opponents):
+            for other, points in zip(opponents, players[slot][8] or ()):
+                self._met.add(self._pairKey(slot, other))
+                self.h2h[slot, other] = self.h2h.get((slot, other), 0) + points
+        # one pass over the match graph for the opponents' totals
+        pct = [self._pct(slot) for slot in range(len(self.ids))]
+        self.sos = array('i', [sum(self.score(o) for o in opponents)
+                               for opponents in self.opponents])
+        self.oppPct = array('d', [sum(pct[o] for o in opponents)
+                                  for opponents in self.opponents])
+        self._pending = []
+
+    @classmethod
+    def load(cls, tournament_id):
+        """Reads a tournament and its tiebreaks from the database."""
+        with tournament.getConnection() as DB:
+            c = DB.cursor()
+            c.execute(STATE_QUERY, (tournament_id,))
+            rows = c.fetchall()
+            c.execute(TIEBREAKS_QUERY, (tournament_id,))
+            row = c.fetchone()
+        return cls(tournament_id, rows, row[0] if row else DEFAULT_TIEBREAKS)
+
+    def _pairKey(self, slot1, slot2):
+        if slot1 > slot2:
+            slot1, slot2 = slot2, slot1
+        return slot1 * len(self.ids) + slot2
+
+    def _slot(self, player_id):
+        try:
+            return self._slots[player_id]
+        except KeyError:
+            raise ValueError("Player %s is not registered in tournament %s."
+                             % (player_id, self.tournament_id))
+
+    def score(self, slot):
+        """A player's score in half points: two per win, one per draw."""
+        return 2 * self.wins[slot] + self.draws[slot]
+
+    def _pct(self, slot):
+        return matchWinPct(self.score(slot), self.matches[slot])
+
+    def countPlayers(self):
+        """Returns the number of players in the tournament."""
+        return len(self.ids)
+
+    def hasBye(self, player_id):
+        """True if the player already had a bye."""
+        return self.byes[self._slot(player_id)] > 0
+
+    def alreadyPlay(self, player_id1, player_id2):
+        """True if the two players already met."""
+        return self._pairKey(self._slot(player_id1),
+                             self._slot(player_id2)) in self._met
+
+    # The names pairing.RematchIndex uses.
+    hadBye = hasBye
+    played = alreadyPlay
+
+    def standings(self):
+        """Returns the (id, name, wins, matches, omw) rows of
+        tournament.playerStandings, best first."""
+        order = sorted(range(len(self.ids)),
+                       key=lambda s: (-self.wins[s], -self.omw[s],
+                                      self.ids[s]))
+        return [(self.ids[s], self.names[s], self.wins[s], self.matches[s],
+                 self.omw[s]) for s in order]
+
+    def ranking(self, tiebreaks=None):
+        """Returns the final standings, ranked by score and tiebreaks.
+
+        Args:
+          tiebreaks: the tiebreaks to apply (see tiebreaks.py); by default
+            the ones of the tournament.
+
+        Returns:
+          A list of (id, name, points, matches, values) tuples, best first;
+          points counts half a point per draw and values holds the value of
+          each tiebreak, in order.
+        """
+        if tiebreaks is None:
+            tiebreaks = self.tiebreaks
+        return [(self.ids[s], self.names[s], self.score(s) / 2.0,
+                 self.matches[s], values)
+                for s, values in rankSlots(self, tiebreaks)]
+
+    def _record(self, slot, won, drawn):
+        """Adds a match to a player's record: each earlier match against him
+        or her passes the new win, points and percentage on to the
+        opponent's OMW, sos and oppPct."""
+        pct = self._pct(slot)
+        self.wins[slot] += won
+        self.draws[slot] += drawn
+        self.matches[slot] += 1
+        points = 2 * won + drawn
+        pct = self._pct(slot) - pct
+        for other in self.opponents[slot]:
+            self.omw[other] += won
+            self.sos[other] += points
+            self.oppPct[other] += pct
+
+    def reportMatch(self, winner, loser, draw=False):
+        """Applies the result of a match and queues it for flush()."""
+        w, l = self._slot(winner), self._slot(loser)
+        if w == l:
+            raise ValueError("Player %s cannot be his or her own opponent."
+                             % winner)
+        if draw:
+            self._record(w, 0, 1)
+            self._record(l, 0, 1)
+        else:
+            self._record(w, 1, 0)
+            self._record(l, 0, 0)
+        self.opponents[w].append(l)
+        self.opponents[l].append(w)
+        self.omw[w] += self.wins[l]
+        self.omw[l] += self.wins[w]
+        self.sos[w] += self.score(l)
+        self.sos[l] += self.score(w)
+        self.oppPct[w] += self._pct(l)
+        self.oppPct[l] += self._pct(w)
+        self.h2h[w, l] = self.h2h.get((w, l), 0) + (1 if draw else 2)
+        self.h2h[l, w] = self.h2h.get((l, w), 0) + (1 if draw else 0)
+        self._met.add(self._pairKey(w, l))
+        self._pending.append((self.tournament_id, winner, loser,
+                              bool(draw), 0))
+
+    def doBye(self, player_id):
+        """Gives a player a bye (a free win) and queues it for flush()."""
+        slot = self._slot(player_id)
+        self._record(slot, 1, 0)
+        self.byes[slot] += 1
+        self._pending.append((self.tournament_id, player_id, player_id,
+                              False, 1))
+
+    def swissPairings(self, maxSteps=100000):
+        """Pairs the next round from memory; a bye is applied and queued.
+
+        Returns:
+          The (id1, name1, id2, name2) tuples of tournament.swissPairings.
+        """
+        standings = self.standings()
+        pairs, byePlayer = pairRound([row[0] for row in standings], self,
+                                     maxSteps)
+        if byePlayer is not None:
+            self.doBye(byePlayer)
+        return [(id1, self.names[self._slots[id1]],
+                 id2, self.names[self._slots[id2]]) for id1, id2 in pairs]
+
+    def pending(self):
+        """Returns the number of results not written yet."""
+        return len(self._pending)
+
+    def flush(self):
+        """Writes every queued result in one transaction.
+
+        The rows go in with one multi-row INSERT and the standings are
+        recomputed once (see tournament.reportMatches); they match the
+        in-memory ones.
+
+        Returns:
+          The number of results written.
+        """
+        rows = self._pending
+        if not rows:
+            return 0
+        with tournament.getConnection() as DB:
+            c = DB.cursor()
+            c.execute("SET LOCAL tournament.bulk_round = 'on'")
+            query = """INSERT INTO matches
+                        (tournament_id, winner_id, loser_id, draw, bye)
+                        VALUES %s"""
+            psycopg2.extras.execute_values(c, query, rows, page_size=1000)
+            c.execute("SELECT standings_rebuild(%s)", (self.tournament_id,))
+            DB.commit()
+        self._pending = []
+        tournament.invalidateTournament(self.tournament_id)
+        return len(rows)
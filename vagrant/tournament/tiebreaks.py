@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# tiebreaks.py -- ranks the players of a tournament by score and tiebreaks
+#
+# Nothing in here touches the database: state.TournamentState keeps the
+# tiebreak totals up to date as results arrive and rankSlots() only sorts
+# them.  The tiebreaks of a tournament are chosen with
+# tournament.setTiebreaks().
+#
+
+# The tiebreaks a tournament can use, in any order:
+#   omw: the wins of the opponents met (the omw column of the standings),
+#   omw_pct: the average match-win percentage of the opponents met, each
+#     one counted as at least MIN_PCT; a draw is half a win,
+#   sos: the sum of the scores of the opponents met (Buchholz), one point
+#     per win and half a point per draw,
+#   head_to_head: the points scored in the matches between the players
+#     still tied.
+TIEBREAKS = ('omw', 'omw_pct', 'sos', 'head_to_head')
+
+DEFAULT_TIEBREAKS = ('omw',)
+
+# Beating a player who lost every match is not worth nothing.
+MIN_PCT = 1.0 / 3
+
+
+def checkTiebreaks(tiebreaks):
+    """Returns tiebreaks as a tuple, or raises ValueError for an unknown one
+    or a repeated one."""
+    tiebreaks = tuple(tiebreaks)
+    for name in tiebreaks:
+        if name not in TIEBREAKS:
+            raise ValueError("Unknown tiebreak %r (expected one of %s)."
+                             % (name, ', '.join(TIEBREAKS)))
+    if len(set(tiebreaks)) != len(tiebreaks):
+        raise ValueError("Repeated tiebreak in %r." % (tiebreaks,))
+    return tiebreaks
+
+
+def matchWinPct(points, matches):
+    """The match-win percentage of a record of points (in half points: two
+    per win, one per draw) over matches, never below MIN_PCT."""
+    if not matches:
+        return MIN_PCT
+    return max(points / (2.0 * matches), MIN_PCT)
+
+
+def tiebreakValue(state, name, slot):
+    """The value of the tiebreak name (but head_to_head) for one player of
+    a TournamentState; higher is better."""
+    if name == 'omw':
+        return state.omw[slot]
+    if name == 'sos':
+        return state.sos[slot] / 2.0
+    if name == 'omw_pct':
+        met = len(state.opponents[slot])
+        # rounded so that equal averages compare equal
+        return round(state.oppPct[slot] / met, 9) if met else 0.0
+    raise ValueError("%r is not a per-player tiebreak." % name)
+
+
+def _headToHead(state, group):
+    """The points (in half points) each player of a tied group scored in
+    the matches against the rest of the group."""
+    return dict((a, sum(state.h2h.get((a, b), 0) for b in group if b != a))
+                for a in group)
+
+
+def _split(groups, value):
+    """Sorts every group by value, best first, and splits it where the value
+    changes."""
+    result = []
+    for group in groups:
+        if len(group) < 2:
+            result.append(group)
+            continue
+        group = sorted(group, key=value, reverse=True)
+        current = [group[0]]
+        for slot in group[1:]:
+            if value(slot) == value(current[0]):
+                current.append(slot)
+            else:
+                result.append(current)
+                current = [slot]
+        result.append(current)
+    return result
+
+
+def rankSlots(state, tiebreaks):
+    """Ranks the players of a TournamentState.
+
+    The players are sorted by score (two half points per win, one per
+    draw), then by each tiebreak in turn, then by id.  Head-to-head only
+    counts the matches between the players still tied when its turn comes,
+    so its place in the list matters.
+
+    Returns:
+      A list of (slot, values) tuples, best first; values holds the value
+      of each tiebreak, in the order of tiebreaks.
+    """
+    tiebreaks = checkTiebreaks(tiebreaks)
+    groups = _split([list(range(len(state.ids)))], state.score)
+    h2h = {}
+    for name in tiebreaks:
+        if name == 'head_to_head':
+            for group in groups:
+                h2h.update(_headToHead(state, group))
+            groups = _split(groups, h2h.get)
+        else:
+            groups = _split(groups, lambda slot: tiebreakValue(state, name,
+                                                               slot))
+    ranking = []
+    for group in groups:
+        for slot in sorted(group, key=lambda s: state.ids[s]):
+            values = tuple(h2h[slot] / 2.0 if name == 'head_to_head'
+                           else tiebreakValue(state, name, slot)
+                           for name in tiebreaks)
+            ranking.append((slot, values))
+    return ranking
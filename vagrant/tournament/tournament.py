@@ -3,76 +3,481 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import functools
+import numbers
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extras
+
+# dbaccess.py, shared with the forum, lives in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import dbaccess
+from cache import TournamentCache
+from dbaccess import ConnectionPool, PooledConnection, PoolTimeout, ReplicaSet
+from pairing import PairingError, RematchIndex, pairRound
+from tiebreaks import checkTiebreaks
+
+
+DSN = "dbname=tournament"
+POOL_MINCONN = 1
+POOL_MAXCONN = 10
+POOL_TIMEOUT = 30
+REPLICA_STICKINESS = 5
+
+
+_pool = None
+_replicas = None
+_poolLock = threading.Lock()
+
+
+def configurePool(minconn=POOL_MINCONN, maxconn=POOL_MAXCONN,
+                  timeout=POOL_TIMEOUT, dsn=None, cursor_factory=None):
+    """(Re)creates the connection pool shared by every function here.
+
+    Idle connections of the previous pool are closed; connections still
+    checked out from it are closed when they are returned.
+
+    Args:
+      minconn: connections kept open even when idle.
+      maxconn: maximum number of simultaneous connections.
+      timeout: seconds to wait for a free connection before PoolTimeout.
+      dsn: the connection string, defaults to DSN.
+      cursor_factory: a dbaccess.InstrumentedCursor subclass to use for
+        every connection.
+    """
+    global _pool
+    with _poolLock:
+        old = _pool
+        _pool = ConnectionPool(dsn or DSN, minconn, maxconn, timeout,
+                               cursor_factory)
+    if old is not None:
+        old.closeall()
+    return _pool
+
+
+def _getPool():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ConnectionPool(DSN, POOL_MINCONN, POOL_MAXCONN,
+                                   POOL_TIMEOUT)
+        return _pool
+
+
+def configureReplicas(dsns, stickiness=REPLICA_STICKINESS,
+                      minconn=POOL_MINCONN, maxconn=POOL_MAXCONN,
+                      timeout=POOL_TIMEOUT):
+    """Sends the read-only functions to read replicas of the database.
+
+    playerStandings, countPlayers, hasBye and alreadyPlay read from the
+    replicas, round robin, with a pool per replica; everything else keeps
+    using the primary (configurePool).  After a write to a tournament its
+    reads go to the primary for stickiness seconds, so this process always
+    sees its own writes; other processes may see them late.
+
+    Args:
+      dsns: the connection strings of the replicas; empty to stop using
+        replicas.
+      stickiness: seconds during which a written tournament is read from
+        the primary.
+      minconn, maxconn, timeout: the size of each replica's pool (see
+        configurePool).
+    """
+    global _replicas
+    pools = [ConnectionPool(dsn, minconn, maxconn, timeout)
+             for dsn in dsns]
+    with _poolLock:
+        old, _replicas = _replicas, ReplicaSet(pools, stickiness)
+    if old is not None:
+        for pool in old.replicas:
+            pool.closeall()
+    return _replicas
+
+
+def replicaStats():
+    """Returns the read routing counters: replica_reads, primary_reads,
+    sticky_reads (reads sent to the primary after a write), writes and
+    replicas.  None if no replicas are configured."""
+    replicas = _replicas
+    if replicas is None:
+        return None
+    return replicas.stats()
+
+
+def closePool():
+    """Closes every pooled connection, e.g. before the process exits.
+
+    The replica pools are closed too and the replicas forgotten.
+    """
+    global _pool, _replicas
+    with _poolLock:
+        old, _pool = _pool, None
+        replicas, _replicas = _replicas, None
+    if old is not None:
+        old.closeall()
+    if replicas is not None:
+        for pool in replicas.replicas:
+            pool.closeall()
+
+
+def poolStats():
+    """Returns the pool's usage counters as a dict, suitable for scraping.
+
+    Keys: minconn, maxconn, size, idle, in_use, peak_in_use, opened, closed,
+    checkouts, returns, waits, timeouts, discarded.
+    """
+    return _getPool().stats()
 
 
 def connect():
-    """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    """Connect to the PostgreSQL database.  Returns a database connection.
+
+    The connection comes from the shared pool; calling close() on it
+    returns it to the pool instead of closing it.
+    """
+    pool = _getPool()
+    return PooledConnection(pool, pool.getconn())
+
+
+@contextmanager
+@dbaccess.helper
+def getConnection():
+    """Checks a connection out of the pool for the duration of a with block.
+
+    The connection is always returned to the pool, and any transaction left
+    open (for instance after an exception) is rolled back.
+    """
+    pool = _getPool()
+    DB = pool.getconn()
+    try:
+        yield DB
+    finally:
+        pool.putconn(DB)
+
+
+@contextmanager
+@dbaccess.helper
+def getReadConnection(tournament_id):
+    """Like getConnection, for statements that only read tournament_id.
+
+    The connection comes from a replica (see configureReplicas), unless
+    there is none, the tournament was written recently or the replica
+    cannot be reached: then it comes from the primary.
+    """
+    replicas = _replicas
+    pool = replicas.route(tournament_id) if replicas is not None else None
+    DB = None
+    if pool is not None:
+        try:
+            DB = pool.getconn()
+        except psycopg2.OperationalError:
+            pool = None
+    if pool is None:
+        pool = _getPool()
+        DB = pool.getconn()
+    try:
+        yield DB
+    finally:
+        pool.putconn(DB)
+
+
+_cache = None
+
+
+def configureCache(maxsize=128, ttl=60):
+    """Turns on the in-process cache of playerStandings and countPlayers.
+
+    Results are cached per tournament until a function of this module
+    writes to that tournament.  Writes made by other processes are only
+    seen once the entries expire, so keep ttl short when several processes
+    share the database.
+
+    Args:
+      maxsize: maximum number of cached results.
+      ttl: seconds a result stays valid (None = until invalidated).
+    """
+    global _cache
+    _cache = TournamentCache(maxsize, ttl)
+    return _cache
+
+
+def disableCache():
+    """Turns off (and empties) the in-process cache."""
+    global _cache
+    _cache = None
+
+
+def cacheStats():
+    """Returns the cache hit/miss counters, or None if the cache is off."""
+    cache = _cache
+    if cache is None:
+        return None
+    return cache.stats()
+
+
+def invalidateTournament(tournament_id=None):
+    """Drops the cached results of a tournament (of all of them if None).
+
+    Every function that writes calls it, so it also sends the reads of the
+    tournament to the primary for a while (see configureReplicas).
+    """
+    replicas = _replicas
+    if replicas is not None:
+        replicas.markWrite(tournament_id)
+    cache = _cache
+    if cache is None:
+        return
+    if tournament_id is None:
+        cache.clear()
+    else:
+        cache.invalidate(tournament_id)
+
+
+def _cached(function):
+    """Serves function(tournament_id) from the cache when it is on."""
+    @functools.wraps(function)
+    def wrapper(tournament_id):
+        cache = _cache
+        if cache is None:
+            return function(tournament_id)
+        key = cache.key(function.__name__, tournament_id)
+        hit, value = cache.get(key)
+        if not hit:
+            value = function(tournament_id)
+            cache.put(key, value)
+        if isinstance(value, list):
+            return list(value)
+        return value
+    return wrapper
 
 
 def deleteMatches():
-    """Remove all the match records from the database."""
-    DB = connect()
-    c = DB.cursor()
-    query = "DELETE FROM matches"
-    c.execute(query)
-    DB.commit()
-    DB.close
+    """Remove all the match records from the database.
+
+    The table is truncated (no per-row trigger or cascade) and every
+    standing is zeroed with a single UPDATE.
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("TRUNCATE matches")
+        c.execute("""UPDATE tournaments_players
+                        SET wins = 0, draws = 0, matches = 0, byes = 0, omw = 0""")
+        DB.commit()
+    invalidateTournament()
 
 
 def deletePlayers():
-    """Remove all the player records from the database."""
-    DB = connect()
-    c = DB.cursor()
-    query = "DELETE FROM players"
-    c.execute(query)
-    DB.commit()
-    DB.close
+    """Remove all the player records from the database.
+
+    Their registrations and matches go too (TRUNCATE ... CASCADE).
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("TRUNCATE players CASCADE")
+        DB.commit()
+    invalidateTournament()
 
 
 def deleteTournaments():
-    """Remove all the tournaments records from the database."""
-    DB = connect()
-    c = DB.cursor()
-    query = "DELETE FROM tournaments"
-    c.execute(query)
-    DB.commit()
-    DB.close
+    """Remove all the tournaments records from the database.
+
+    Their registrations and matches go too (TRUNCATE ... CASCADE).
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("TRUNCATE tournaments CASCADE")
+        c.execute("SELECT tournament_partitions_drop()")
+        DB.commit()
+    invalidateTournament()
+
+
+def resetAll():
+    """Empties every table (but schema_migrations) and restarts the ids.
+
+    Archived tournaments (see archiveTournament) are dropped as well.
+
+    One TRUNCATE ... RESTART IDENTITY CASCADE, so it takes the same time
+    whatever the amount of data.  It locks the tables exclusively while it
+    runs: do not call it while a tournament is being played.
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("""TRUNCATE matches, tournaments_players, tournaments,
+                        players RESTART IDENTITY CASCADE""")
+        c.execute("SELECT tournament_partitions_drop()")
+        # The ids will be reused: the archived tournaments go too.
+        c.execute("DROP SCHEMA archive CASCADE; CREATE SCHEMA archive")
+        DB.commit()
+    invalidateTournament()
+
+
+def purgeTournament(tournament_id):
+    """Deletes a tournament with its registrations and matches.
+
+    On a partitioned database (see tournament.sql) the tournament's
+    partitions are dropped; otherwise its matches and registrations are
+    deleted through their tournament_id indexes, without firing the
+    standings trigger for every match.  The players are kept.
+
+    Returns:
+      True if the tournament existed.
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("SELECT tournament_archive(%s, false)", (tournament_id,))
+        existed = c.fetchone()[0]
+        DB.commit()
+    invalidateTournament(tournament_id)
+    return existed
+
+
+def archiveTournament(tournament_id):
+    """Moves a finished tournament out of the live tables.
+
+    Its matches and registrations end up in archive.matches_t<id> and
+    archive.tournaments_players_t<id>, and the tournament row is deleted.
+    On a partitioned database this detaches the tournament's partitions,
+    which takes the same time whatever their size.
+
+    Returns:
+      True if the tournament existed.
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("SELECT tournament_archive(%s, true)", (tournament_id,))
+        existed = c.fetchone()[0]
+        DB.commit()
+    invalidateTournament(tournament_id)
+    return existed
 
 
 def registerTournament(name):
     """Adds a tournament to tournament database.
         The function returns the ID of the tournament added
     The database assigns a unique serial id number for the tournament.
+    On a partitioned database its partitions are created with it.
 
     Args:
       name: the tournament's name (need not be unique).
     """
-    DB = connect()
-    c = DB.cursor()
-    query = "INSERT INTO tournaments (name) VALUES (%s) RETURNING id"
-    c.execute(query, (name,))
-    lastTournamentAdded = c.fetchone()[0]
-    DB.commit()
-    DB.close()
+    with getConnection() as DB:
+        c = DB.cursor()
+        query = "INSERT INTO tournaments (name) VALUES (%s) RETURNING id"
+        c.execute(query, (name,))
+        lastTournamentAdded = c.fetchone()[0]
+        DB.commit()
+    invalidateTournament(lastTournamentAdded)
     return lastTournamentAdded
 
 
+def setTiebreaks(tournament_id, tiebreaks):
+    """Chooses how the final standings of a tournament break ties.
+
+    Args:
+      tournament_id: the tournament.
+      tiebreaks: the names of the tiebreaks, applied in order after the
+        score: 'omw', 'omw_pct', 'sos' and/or 'head_to_head' (see
+        tiebreaks.py).
+
+    Raises:
+      ValueError: for an unknown or repeated tiebreak, or an unknown
+        tournament.
+    """
+    tiebreaks = list(checkTiebreaks(tiebreaks))
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("UPDATE tournaments SET tiebreaks = %s WHERE id = %s",
+                  (tiebreaks, tournament_id))
+        if c.rowcount == 0:
+            raise ValueError("Tournament %s does not exist." % tournament_id)
+        DB.commit()
+    invalidateTournament(tournament_id)
+
+
+# The hot statements run as prepared statements, parsed and planned once
+# per pooled connection (see dbaccess.Statement).
+COUNT_PLAYERS = dbaccess.Statement('tournament_count_players', """
+    SELECT count(player_id) as cp
+    FROM tournaments_players
+    WHERE tournament_id = %s""")
+
+PLAYER_STANDINGS = dbaccess.Statement('tournament_player_standings', """
+    SELECT id, name, wins, matches, omw
+    FROM standings
+    WHERE tournament_id = %s
+    ORDER BY wins DESC, omw DESC, id""")
+
+REPORT_MATCH = dbaccess.Statement('tournament_report_match', """
+    INSERT INTO matches (tournament_id, winner_id, loser_id, draw)
+    VALUES (%s, %s, %s, %s)""")
+
+HAS_BYE = dbaccess.Statement('tournament_has_bye', """
+    SELECT 1 FROM matches
+    WHERE tournament_id = %s AND winner_id = %s AND bye <> 0
+    LIMIT 1""")
+
+ALREADY_PLAY = dbaccess.Statement('tournament_already_play', """
+    SELECT id FROM matches
+    WHERE tournament_id = %s
+        AND ((winner_id = %s and loser_id = %s)
+            OR (winner_id = %s and loser_id = %s))""")
+
+
+@_cached
 def countPlayers(tournament_id):
     """Returns the number of players currently registered
         on an specific tournament."""
-    DB = connect()
-    c = DB.cursor()
-    query = """SELECT count(player_id) as cp
-                FROM tournaments_players
-                WHERE tournament_id = %s"""
-    c.execute(query, (tournament_id,))
-    countP = c.fetchone()[0]
-    DB.close()
+    with getReadConnection(tournament_id) as DB:
+        c = DB.cursor()
+        COUNT_PLAYERS.execute(c, (tournament_id,))
+        countP = c.fetchone()[0]
     return countP
 
 
+@dbaccess.helper
+def _asociatePlayers(c, tournament_id, player_ids):
+    """Registers existing players into a tournament with a single INSERT.
+
+    Players already registered are skipped by the unique constraint on
+    tournaments_players.  Runs on the caller's cursor and does not commit.
+
+    Returns:
+      The number of players that were newly registered.
+    """
+    query = """INSERT INTO tournaments_players (tournament_id, player_id)
+                SELECT %s, unnest(%s::int[])
+                ON CONFLICT (tournament_id, player_id) DO NOTHING"""
+    try:
+        c.execute(query, (tournament_id, list(player_ids)))
+    except psycopg2.IntegrityError as e:
+        error = _registrationError(e)
+        if error is None:
+            raise
+        raise error
+    return c.rowcount
+
+
+def _registrationError(e):
+    """Returns the ValueError matching a failed registration, or None."""
+    # On a partitioned database an unknown tournament has no partition of
+    # tournaments_players to hold the row, which is a check violation.
+    if (e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION
+            and e.diag.constraint_name is None):
+        return ValueError("The tournament does not exist on database.")
+    if e.pgcode != psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
+        return None
+    if e.diag.constraint_name == 'tournaments_players_tournament_id_fkey':
+        return ValueError("The tournament does not exist on database.")
+    return ValueError("The player does not exist on database.")
+
+
 def registerPlayer(name, tournament_id):
     """Adds a player into a tournament to tournament database.
      The database assigns a unique serial id number for the player.  (This
@@ -81,15 +486,53 @@ def registerPlayer(name, tournament_id):
     Args:
       name: the player's full name (need not be unique).
       tournament_id: the tournament's ID where to register the player
+
+    Returns:
+      The id of the new player.
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        query = "INSERT INTO players (name) VALUES (%s) RETURNING id"
+        c.execute(query, (name,))
+        lastPlayerAdded = c.fetchone()[0]
+        _asociatePlayers(c, tournament_id, [lastPlayerAdded])
+        DB.commit()
+    invalidateTournament(tournament_id)
+    return lastPlayerAdded
+
+
+def registerPlayers(players, tournament_id):
+    """Registers many players into a tournament in one transaction.
+
+    New players are created with a single multi-row INSERT ... RETURNING
+    and every registration is written with a single INSERT, so the cost
+    does not grow with round-trips per player.
+
+    Args:
+      players: an iterable of player names (new players) and/or ids of
+        players already stored on database, in any mix.
+      tournament_id: the tournament's ID where to register the players
+
+    Returns:
+      The list of player ids, in the same order as players.
     """
-    DB = connect()
-    c = DB.cursor()
-    query = "INSERT INTO players (name) VALUES (%s) RETURNING id"
-    c.execute(query, (name,))
-    lastPlayerAdded = c.fetchone()[0]
-    DB.commit()
-    DB.close()
-    asociatePlayerIntoTournament(lastPlayerAdded, tournament_id)
+    players = list(players)
+    names = [p for p in players if not isinstance(p, numbers.Integral)]
+    with getConnection() as DB:
+        c = DB.cursor()
+        newIds = []
+        if names:
+            query = """INSERT INTO players (name)
+                        SELECT unnest(%s::varchar[]) RETURNING id"""
+            c.execute(query, (names,))
+            newIds = [row[0] for row in c.fetchall()]
+        newIds.reverse()
+        ids = [p if isinstance(p, numbers.Integral) else newIds.pop()
+               for p in players]
+        _asociatePlayers(c, tournament_id, ids)
+        DB.commit()
+    invalidateTournament(tournament_id)
+    return ids
 
 
 def asociatePlayerIntoTournament(player_id, tournament_id):
@@ -102,103 +545,87 @@ def asociatePlayerIntoTournament(player_id, tournament_id):
             tournament_id: the id of the tournament.
     """
 
-    DB = connect()
-    c = DB.cursor()
-    query = "SELECT * FROM players WHERE id = %s"
-    c.execute(query, (player_id,))
-    exist = c.fetchall()
-    if exist == []:
-        raise ValueError("The player does not exist on database.")
-    query = "SELECT * FROM tournaments WHERE id = %s"
-    c.execute(query, (tournament_id,))
-    exist = c.fetchall()
-    if exist == []:
-        raise ValueError("The tournament does not exist on database.")
-
-    query = """SELECT * FROM tournaments_players
-                WHERE tournament_id = %s AND player_id = %s"""
-    c.execute(query, (tournament_id, player_id,))
-    exist = c.fetchall()
-    if exist == []:
-        query = """INSERT INTO tournaments_players
-                (tournament_id, player_id) VALUES (%s, %s)"""
-        c.execute(query, (tournament_id, player_id))
+    with getConnection() as DB:
+        c = DB.cursor()
+        added = _asociatePlayers(c, tournament_id, [player_id])
         DB.commit()
-        print "The player was successfully asociated to the tournament"
+    invalidateTournament(tournament_id)
+    if added:
+        print("The player was successfully asociated to the tournament")
     else:
-        print "The player is already asociated to the tournament"
-    DB.close()
+        print("The player is already asociated to the tournament")
 
 
+@_cached
 def playerStandings(tournament_id):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place,
     or a player tied for first place if there is currently a tie.
 
+    The standings are read from the aggregate columns of
+    tournaments_players, which the database keeps up to date every time a
+    match is recorded, so this is a single indexed scan.  Players with the
+    same wins are ordered by OMW, highest first, and then by id;
+    finalStandings applies the tournament's tiebreaks instead.
+
     Args:
       tournament_id: the tournament ID for the standings.
 
     Returns:
-      A list of tuples, each of which contains (id, name, wins, matches):
+      A list of tuples, each of which contains (id, name, wins, matches, omw):
         id: the player's unique id (assigned by the database)
         name: the player's full name (as registered)
         wins: the number of matches the player has won
         matches: the number of matches the player has played
+        omw: the number of wins of the player's opponents
     """
-    DB = connect()
-    c = DB.cursor()
-    query = """ SELECT  p.id,
-                        p.name,
-                        (SELECT COUNT(*) FROM matches m
-                            WHERE m.winner_id = p.id
-                                AND m.draw = False
-                                AND m.tournament_id = %s) AS wins,
-                        (SELECT COUNT(*) FROM matches m
-                            WHERE m.tournament_id = %s
-                                AND (m.winner_id = p.id OR m.loser_id = p.id))
-                                    AS matches,
-                        (SELECT COUNT(*) FROM matches momw
-                            WHERE momw.draw = False
-                            AND (momw.winner_id IN
-                                (SELECT loser_id
-                                    FROM matches m
-                                    WHERE m.winner_id = p.id and m.bye = 0
-                                    AND m.tournament_id = %s)
-                            OR momw.winner_id IN
-                                (SELECT winner_id
-                                    FROM matches m
-                                    WHERE m.loser_id = p.id
-                                        AND m.bye = 0
-                                        AND m.tournament_id = %s))) AS omw
-                        FROM players p LEFT JOIN tournaments_players tp
-                            on (p.id = tp.player_id)
-                        WHERE tp.tournament_id = %s
-                        ORDER BY wins DESC, omw ASC"""
-
-    c.execute(query, (tournament_id, tournament_id, tournament_id, tournament_id, tournament_id,))
-    standings = []
-    standings = c.fetchall()
-    DB.close()
+    with getReadConnection(tournament_id) as DB:
+        c = DB.cursor()
+        PLAYER_STANDINGS.execute(c, (tournament_id,))
+        standings = c.fetchall()
     return standings
 
 
+@_cached
+def finalStandings(tournament_id):
+    """Returns the final standings, ranked by the tournament's tiebreaks.
+
+    playerStandings orders by wins and OMW (the default tiebreak), which is
+    what the pairings need; this applies the tiebreaks chosen with
+    setTiebreaks and counts a draw as half a point.  The ranking is cached
+    like playerStandings, until the tournament (or its tiebreaks) changes.
+
+    Args:
+      tournament_id: the tournament ID for the standings.
+
+    Returns:
+      A list of (id, name, points, matches, values) tuples, best first;
+      values holds the value of each tiebreak, in order (see
+      state.TournamentState.ranking).
+    """
+    # state imports this module.
+    from state import TournamentState
+    return TournamentState.load(tournament_id).ranking()
+
+
 def reportMatch(tournament_id, winner, loser, draw):
     """Records the outcome of a single match between two players.
 
+    The matches_standings trigger updates both players' standings (and the
+    OMW of their previous opponents) in the same transaction.
+
     Args:
       tournament_id: the ID of the current tournament
       winner:  the id number of the player who won
       loser:  the id number of the player who lost
       draw: true or false as appropiate
     """
-    DB = connect()
-    c = DB.cursor()
-    query = """INSERT INTO matches (tournament_id, winner_id, loser_id, draw)
-                VALUES (%s,%s,%s,%s)"""
-    c.execute(query, (tournament_id, winner, loser, draw))
-    DB.commit()
-    DB.close()
+    with getConnection() as DB:
+        c = DB.cursor()
+        REPORT_MATCH.execute(c, (tournament_id, winner, loser, draw))
+        DB.commit()
+    invalidateTournament(tournament_id)
 
 
 def doBye(tournament_id, player_id):
@@ -207,16 +634,70 @@ def doBye(tournament_id, player_id):
     Args:
         tournament_id: the ID of the current tournament
     """
-    DB = connect()
-    c = DB.cursor()
-    query = """INSERT INTO matches (tournament_id, winner_id, loser_id, draw, bye)
-                VALUES (%s,%s,%s,%s,%s)"""
-    c.execute(query, (tournament_id, player_id, player_id, False, 1,))
-    DB.commit()
-    DB.close()
+    with getConnection() as DB:
+        c = DB.cursor()
+        query = """INSERT INTO matches (tournament_id, winner_id, loser_id, draw, bye)
+                    VALUES (%s,%s,%s,%s,%s)"""
+        c.execute(query, (tournament_id, player_id, player_id, False, 1,))
+        DB.commit()
+    invalidateTournament(tournament_id)
     return True
 
 
+def reportMatches(tournament_id, results, byes=()):
+    """Records a whole round in a single transaction.
+
+    Every match and bye is written with one multi-row INSERT and the
+    standings are recomputed once for the round (standings_rebuild) rather
+    than once per match.
+
+    Args:
+      tournament_id: the ID of the current tournament
+      results: an iterable of (winner, loser, draw) tuples, one per table
+      byes: the ids of the players that get a bye this round
+
+    Raises:
+      ValueError: if a player appears more than once in the round, or
+        is his or her own opponent.
+    """
+    rows = _roundRows(tournament_id, results, byes)
+    if not rows:
+        return
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("SET LOCAL tournament.bulk_round = 'on'")
+        query = """INSERT INTO matches
+                    (tournament_id, winner_id, loser_id, draw, bye)
+                    VALUES %s"""
+        psycopg2.extras.execute_values(c, query, rows, page_size=1000)
+        c.execute("SELECT standings_rebuild(%s)", (tournament_id,))
+        DB.commit()
+    invalidateTournament(tournament_id)
+
+
+def _roundRows(tournament_id, results, byes):
+    """Validates a round and returns its matches rows (see reportMatches).
+
+    Returns:
+      A list of (tournament_id, winner_id, loser_id, draw, bye) tuples.
+    """
+    rows = []
+    seen = set()
+    for winner, loser, draw in results:
+        if winner == loser:
+            raise ValueError("Player %s cannot be his or her own opponent." % winner)
+        rows.append((tournament_id, winner, loser, bool(draw), 0))
+    for player_id in byes:
+        rows.append((tournament_id, player_id, player_id, False, 1))
+    for row in rows:
+        for player_id in set(row[1:3]):
+            if player_id in seen:
+                raise ValueError(
+                    "Player %s appears more than once in the round." % player_id)
+            seen.add(player_id)
+    return rows
+
+
 def hasBye(tournament_id, player_id):
     """
     -- THIS IS OPTIONAL --
@@ -232,18 +713,11 @@ def hasBye(tournament_id, player_id):
         False if not
     """
 
-    DB = connect()
-    c = DB.cursor()
-    query = """SELECT bye FROM matches
-                WHERE tournament_id = %s
-                    AND (winner_id = %s OR loser_id = %s)"""
-    c.execute(query, (tournament_id, player_id, player_id,))
-    playerBye = c.fetchone()[0]
-    DB.close()
-    if playerBye == 0:
-        return False
-    else:
-        return True
+    with getReadConnection(tournament_id) as DB:
+        c = DB.cursor()
+        HAS_BYE.execute(c, (tournament_id, player_id))
+        row = c.fetchone()
+    return row is not None
 
 
 def alreadyPlay(tournament_id, player_id1, player_id2):
@@ -258,28 +732,100 @@ def alreadyPlay(tournament_id, player_id1, player_id2):
         True if the players already played before
         False if not
     """
-    DB = connect()
-    c = DB.cursor()
-    query = """SELECT id FROM matches
-                WHERE tournament_id = %s
-                    AND ((winner_id = %s and loser_id = %s)
-                        OR (winner_id = %s and loser_id = %s))"""
-    c.execute(query, (tournament_id, player_id1, player_id2, player_id2, player_id1,))
-    theyPlayed = c.fetchall()
-    DB.close()
+    with getReadConnection(tournament_id) as DB:
+        c = DB.cursor()
+        ALREADY_PLAY.execute(c, (tournament_id, player_id1, player_id2,
+                                 player_id2, player_id1))
+        theyPlayed = c.fetchall()
     if theyPlayed != []:
         return True
     else:
         return False
 
 
+# The statement behind loadRematchIndex: every match of a tournament.
+REMATCH_INDEX_QUERY = """
+    SELECT winner_id, loser_id, bye FROM matches
+    WHERE tournament_id = %s"""
+
+
+def loadRematchIndex(tournament_id):
+    """Loads the whole match history of a tournament with a single query.
+
+    Args:
+      tournament_id: the ID of the tournament
+
+    Returns:
+      A pairing.RematchIndex with every pair that already played and
+      every player that already had a bye.
+    """
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute(REMATCH_INDEX_QUERY, (tournament_id,))
+        index = RematchIndex.fromMatches(c.fetchall())
+    return index
+
+
+# The single statement behind loadPairingState: the standings of a
+# tournament in pairing order, with the data needed to avoid rematches.
+PAIRING_STATE_QUERY = """
+    SELECT s.id, s.name, s.wins, s.omw, s.byes > 0 AS has_bye,
+        ROW_NUMBER() OVER (PARTITION BY s.wins
+                           ORDER BY s.omw DESC, s.id) AS group_rank,
+        ARRAY(SELECT CASE WHEN m.winner_id = s.id
+                          THEN m.loser_id
+                          ELSE m.winner_id END
+              FROM matches m
+              WHERE m.tournament_id = s.tournament_id
+                  AND m.bye = 0
+                  AND (m.winner_id = s.id OR m.loser_id = s.id)
+        ) AS opponents
+    FROM standings s
+    WHERE s.tournament_id = %s
+    ORDER BY s.wins DESC, group_rank"""
+
+
+def loadPairingState(tournament_id, c=None):
+    """Loads everything the next round's pairing needs with a single query.
+
+    Each standings row comes with the player's score-group rank (a window
+    function over the players with the same number of wins), a has_bye
+    flag and the ids of every opponent already met, so no further query is
+    needed to rule out rematches.
+
+    Args:
+      tournament_id: the ID of the tournament
+      c: an open cursor to run the query on (one is checked out if None).
+
+    Returns:
+      A list of tuples (id, name, wins, omw, has_bye, group_rank,
+      opponents), in pairing order: by wins and then by group_rank.
+    """
+    if c is not None:
+        c.execute(PAIRING_STATE_QUERY, (tournament_id,))
+        return c.fetchall()
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute(PAIRING_STATE_QUERY, (tournament_id,))
+        state = c.fetchall()
+    return state
+
+
 def swissPairings(tournament_id):
     """Returns a list of pairs of players for the next round of a match.
 
-    Assuming that there are an even number of players registered, each player
-    appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    Each player appears at most once in the pairings.  Each player is paired
+    with another player with an equal or nearly-equal win record, that is,
+    a player adjacent to him or her in the standings, and never with a
+    player he or she already met.  If there is an odd number of players the
+    lowest-ranked player without a previous bye gets one (recorded in the
+    same transaction) and is left out of the pairings.
+
+    The standings, byes and previous opponents are read with the single
+    query of loadPairingState, already in pairing order; pairing.pairRound
+    only has to step in where adjacent players would meet again.  A round
+    costs one connection checkout and at most two statements, whatever the
+    number of players.
 
     Args:
       tournament_id: the ID of the current tournament
@@ -290,34 +836,23 @@ def swissPairings(tournament_id):
         name1: the first player's name
         id2: the second player's unique id
         name2: the second player's name
+
+    Raises:
+      PairingError: if every possible pairing would contain a rematch.
     """
-    results = playerStandings(tournament_id)
-    pairs = []
-    numberOfPlayers = countPlayers(tournament_id)
-
-    """ Here is the BYE zone """
-    if numberOfPlayers % 2 != 0:
-        i = 0
-        byeDone = False
-        while not byeDone:
-            if results[i][5] == 0:
-                doBye(tournament_id, results[i][0])
-                results.pop(i)
-                byeDone = True
-            i += 1
-            pass
-    """ --------------------"""
-    i = 0
-    while len(results) >= 1:
-            b = 1
-            withOpponent = False
-            while not withOpponent:
-                if not alreadyPlay(tournament_id, results[i][0], results[b][0]):
-                    pairs.append((results[i][0], results[i][1], results[b][0], results[b][1]))
-                    results.pop(i)
-                    results.pop(b-1)
-                    withOpponent = True
-                b += 1
-                pass
-    pass
-    return pairs
+    with getConnection() as DB:
+        c = DB.cursor()
+        state = loadPairingState(tournament_id, c)
+        index = RematchIndex.fromOpponents(
+            (row[0], row[6], row[4]) for row in state)
+        pairs, byePlayer = pairRound([row[0] for row in state], index)
+        if byePlayer is not None:
+            query = """INSERT INTO matches
+                        (tournament_id, winner_id, loser_id, draw, bye)
+                        VALUES (%s,%s,%s,%s,%s)"""
+            c.execute(query, (tournament_id, byePlayer, byePlayer, False, 1))
+            DB.commit()
+    if byePlayer is not None:
+        invalidateTournament(tournament_id)
+    names = dict((row[0], row[1]) for row in state)
+    return [(id1, names[id1], id2, names[id2]) for id1, id2 in pairs]
@@ -6,11 +6,32 @@
 -- You can write comments in this file by starting them with two dashes, like
 -- these lines here.
 
+-- For very large deployments, create the database with
+--   psql -v partitioned=1 -f tournament.sql
+-- to make matches and tournaments_players partitioned by tournament (one
+-- partition per tournament, created with the tournament, see migration 002).
+-- PostgreSQL 12 or later.
+\if :{?partitioned}
+  \set partition_by 'PARTITION BY LIST (tournament_id)'
+  \set matches_key 'PRIMARY KEY (tournament_id, id)'
+\else
+  \set partition_by ''
+  \set matches_key 'PRIMARY KEY (id)'
+\endif
+
 DROP DATABASE IF EXISTS tournament;
 
 CREATE DATABASE tournament;
 \c tournament;
 
+-- Versions of the files in migrations/ already applied to this database.
+-- See migrate.py to upgrade an existing database.
+CREATE TABLE schema_migrations (
+  version INT PRIMARY KEY,
+  name VARCHAR(100) NOT NULL,
+  applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE players (
   id    SERIAL PRIMARY KEY,
   name  VARCHAR(50)
@@ -23,17 +44,30 @@ CREATE TABLE tournaments (
 
 -- THE NEXT TABLE IS USED TO STORE THE PLAYERS REGISTERED ON A TOURNAMENT
 -- PLAYERS CAN BE REGISTERED BUT WITHOUT MATCHES YET.
--- IT DOESN'T NEED A PRIMARY KEY
+-- Migration 000 adds the standing columns and the uniqueness of a
+-- registration, migration 001 its primary key.
 CREATE TABLE tournaments_players (
   player_id INT REFERENCES players (id) ON DELETE CASCADE,
   tournament_id INT REFERENCES tournaments (id) ON DELETE CASCADE
-);
+) :partition_by;
 
+-- A partitioned table's primary key must include the partition key: there
+-- it is (tournament_id, id), the ids still come from one sequence.
 CREATE TABLE matches (
-  id SERIAL PRIMARY KEY,
+  id SERIAL,
   tournament_id INT REFERENCES tournaments (id) ON DELETE CASCADE,
   winner_id INT REFERENCES players (id) ON DELETE CASCADE,
   loser_id INT REFERENCES players (id) ON DELETE CASCADE,
   draw BOOLEAN,
-  bye INT DEFAULT 0
-);
+  bye INT DEFAULT 0,
+  :matches_key
+) :partition_by;
+
+-- MIGRATIONS
+-- A new database gets every migration; keep this list in sync with the
+-- migrations/ directory.  The schema above is the original one: every
+-- later change is a migration, so migrate.py can upgrade any database.
+\ir migrations/000_standings.sql
+\ir migrations/001_indexes.sql
+\ir migrations/002_partitioning.sql
+\ir migrations/003_tiebreaks.sql
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio counterpart of the tournament.py API
+#
+# Every function of tournament.py that reads or writes tournaments has a
+# coroutine of the same name and arguments here, running the same SQL with
+# the same results and errors.  The connection, cache and replica plumbing
+# (connect, getReadConnection, configureCache, configureReplicas,
+# invalidateTournament...) stays in tournament.py; this module has its own
+# pool.  Queries go through psycopg2's asynchronous connections, whose
+# sockets are watched by the event loop, so a query never blocks it; each
+# call checks a connection out of an AsyncConnectionPool, so calls for
+# different tournaments run concurrently, up to the pool size.
+#
+# Requires Python 3.5 or later.  Writes made here also invalidate the
+# in-process cache of tournament.py.
+#
+
+import asyncio
+import numbers
+
+import psycopg2
+import psycopg2.extensions
+
+import tournament  # puts dbaccess (in the parent directory) on sys.path
+import dbaccess
+from dbaccess import PoolTimeout
+from pairing import PairingError, RematchIndex, pairRound
+from state import STATE_QUERY, TIEBREAKS_QUERY, TournamentState
+from tiebreaks import DEFAULT_TIEBREAKS, checkTiebreaks
+
+
+POOL_MAXCONN = tournament.POOL_MAXCONN
+POOL_TIMEOUT = tournament.POOL_TIMEOUT
+
+
+@dbaccess.helper
+async def _wait(conn):
+    """Waits, without blocking the event loop, until conn is ready."""
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("poll() returned %s" % state)
+        ready = loop.create_future()
+        fd = conn.fileno()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+class AsyncConnection(object):
+    """An asynchronous psycopg2 connection with awaitable queries.
+
+    The connection is in autocommit mode, as psycopg2 requires of
+    asynchronous connections: run "BEGIN" and "COMMIT" to group
+    statements in a transaction.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @dbaccess.helper
+    async def execute(self, query, args=None):
+        """Runs a statement and returns its cursor, ready to fetch."""
+        start = dbaccess.timer()
+        c = self.conn.cursor()
+        c.execute(query, args)
+        await _wait(self.conn)
+        dbaccess.recordQuery(query, start, c.rowcount)
+        return c
+
+    @dbaccess.helper
+    async def fetchall(self, query, args=None):
+        """Runs a query and returns all of its rows."""
+        return (await self.execute(query, args)).fetchall()
+
+    @dbaccess.helper
+    async def fetchone(self, query, args=None):
+        """Runs a query and returns its first row (None if there is none)."""
+        return (await self.execute(query, args)).fetchone()
+
+    @property
+    def closed(self):
+        return self.conn.closed
+
+    def close(self):
+        self.conn.close()
+
+
+async def connectAsync(dsn):
+    """Opens an asynchronous connection to the database."""
+    conn = psycopg2.connect(dsn, async_=1)
+    try:
+        await _wait(conn)
+    except BaseException:
+        conn.close()
+        raise
+    return AsyncConnection(conn)
+
+
+class AsyncConnectionPool(object):
+    """A pool of asynchronous connections for one event loop.
+
+    Connections are opened on demand, up to maxconn.  getconn() waits
+    (without blocking the loop) while every connection is checked out;
+    putconn() rolls back any open transaction, and closes connections that
+    are broken or were interrupted in the middle of a query.
+
+    Args:
+      dsn: the libpq connection string.
+      maxconn: upper bound on open connections.
+      timeout: seconds getconn() waits for a free connection (None = forever).
+    """
+
+    def __init__(self, dsn, maxconn=POOL_MAXCONN, timeout=POOL_TIMEOUT):
+        if maxconn < 1:
+            raise ValueError("The pool needs at least one connection.")
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(maxconn)
+        self._size = 0
+        self._closed = False
+        self._counters = {'opened': 0, 'closed': 0, 'checkouts': 0,
+                          'returns': 0, 'waits': 0, 'timeouts': 0,
+                          'discarded': 0, 'peak_in_use': 0}
+
+    @dbaccess.helper
+    async def getconn(self):
+        """Checks a connection out of the pool."""
+        if self._closed:
+            raise psycopg2.InterfaceError("The pool is closed.")
+        start = dbaccess.timer()
+        if self._slots.locked():
+            self._counters['waits'] += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._counters['timeouts'] += 1
+            raise PoolTimeout(
+                "No connection available after %ss." % self.timeout)
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    break
+                self._discard(conn)
+                self._counters['discarded'] += 1
+            else:
+                conn = await connectAsync(self.dsn)
+                self._size += 1
+                self._counters['opened'] += 1
+        except BaseException:
+            self._slots.release()
+            raise
+        self._counters['checkouts'] += 1
+        inUse = self._size - len(self._idle)
+        if inUse > self._counters['peak_in_use']:
+            self._counters['peak_in_use'] = inUse
+        dbaccess.recordAcquire(start)
+        return conn
+
+    async def putconn(self, conn):
+        """Returns a connection to the pool, resetting or dropping it."""
+        healthy = not conn.closed and not conn.conn.isexecuting()
+        if healthy and (conn.conn.get_transaction_status() !=
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            try:
+                await conn.execute("ROLLBACK")
+            except (psycopg2.Error, asyncio.CancelledError):
+                healthy = False
+        self._counters['returns'] += 1
+        if not healthy:
+            self._counters['discarded'] += 1
+            self._discard(conn)
+        elif self._closed:
+            self._discard(conn)
+        else:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def _discard(self, conn):
+        if not conn.closed:
+            conn.close()
+        self._size -= 1
+        self._counters['closed'] += 1
+
+    def closeall(self):
+        """Closes every idle connection and refuses further checkouts."""
+        self._closed = True
+        while self._idle:
+            self._discard(self._idle.pop())
+
+    def stats(self):
+        """Returns the pool's usage counters (see tournament.poolStats)."""
+        stats = dict(self._counters)
+        stats.update({'maxconn': self.maxconn,
+                      'size': self._size,
+                      'idle': len(self._idle),
+                      'in_use': self._size - len(self._idle)})
+        return stats
+
+
+class _Checkout(object):
+    """async with: a connection checked out for the duration of a block."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    @dbaccess.helper
+    async def __aenter__(self):
+        self.conn = await self.pool.getconn()
+        return self.conn
+
+    async def __aexit__(self, *exc_info):
+        await self.pool.putconn(self.conn)
+
+
+_pool = None
+
+
+def configurePool(maxconn=POOL_MAXCONN, timeout=POOL_TIMEOUT, dsn=None):
+    """(Re)creates the asynchronous pool used by every coroutine here.
+
+    Call it from the event loop that will use the pool.  Idle connections
+    of the previous pool are closed.
+
+    Args:
+      maxconn: maximum number of simultaneous connections.
+      timeout: seconds to wait for a free connection before PoolTimeout.
+      dsn: the connection string, defaults to tournament.DSN.
+    """
+    global _pool
+    old, _pool = _pool, AsyncConnectionPool(dsn or tournament.DSN, maxconn,
+                                            timeout)
+    if old is not None:
+        old.closeall()
+    return _pool
+
+
+def _getPool():
+    if _pool is None:
+        configurePool()
+    return _pool
+
+
+def closePool():
+    """Closes every pooled connection, e.g. before the loop stops."""
+    global _pool
+    old, _pool = _pool, None
+    if old is not None:
+        old.closeall()
+
+
+def poolStats():
+    """Returns the asynchronous pool's usage counters as a dict."""
+    return _getPool().stats()
+
+
+def getConnection():
+    """Checks a connection out of the pool for an async with block.
+
+    The connection is always returned to the pool, and any transaction left
+    open (for instance after an exception) is rolled back.
+    """
+    return _Checkout(_getPool())
+
+
+async def gatherTournaments(function, tournament_ids, *args):
+    """Runs function(tournament_id, *args) for many tournaments at once.
+
+    The calls share the pool, so at most its maxconn queries are in
+    flight; the others wait for a connection.
+
+    Returns:
+      A dict mapping every tournament id to its result.
+    """
+    tournament_ids = list(tournament_ids)
+    results = await asyncio.gather(*[function(t, *args)
+                                     for t in tournament_ids])
+    return dict(zip(tournament_ids, results))
+
+
+async def deleteMatches():
+    """Remove all the match records from the database."""
+    async with getConnection() as DB:
+        await DB.execute("BEGIN")
+        await DB.execute("TRUNCATE matches")
+        await DB.execute("""UPDATE tournaments_players
+                            SET wins = 0, draws = 0, matches = 0, byes = 0,
+                                omw = 0""")
+        await DB.execute("COMMIT")
+    tournament.invalidateTournament()
+
+
+async def deletePlayers():
+    """Remove all the player records from the database."""
+    async with getConnection() as DB:
+        await DB.execute("TRUNCATE players CASCADE")
+    tournament.invalidateTournament()
+
+
+async def deleteTournaments():
+    """Remove all the tournaments records from the database."""
+    async with getConnection() as DB:
+        await DB.execute("TRUNCATE tournaments CASCADE")
+        await DB.execute("SELECT tournament_partitions_drop()")
+    tournament.invalidateTournament()
+
+
+async def resetAll():
+    """Empties every table (but schema_migrations) and restarts the ids
+    (see tournament.py)."""
+    async with getConnection() as DB:
+        await DB.execute("BEGIN")
+        await DB.execute("""TRUNCATE matches, tournaments_players, tournaments,
+                            players RESTART IDENTITY CASCADE""")
+        await DB.execute("SELECT tournament_partitions_drop()")
+        await DB.execute("DROP SCHEMA archive CASCADE; CREATE SCHEMA archive")
+        await DB.execute("COMMIT")
+    tournament.invalidateTournament()
+
+
+async def purgeTournament(tournament_id):
+    """Deletes a tournament with its registrations and matches; True if it
+    existed (see tournament.py)."""
+    async with getConnection() as DB:
+        row = await DB.fetchone("SELECT tournament_archive(%s, false)",
+                                (tournament_id,))
+    tournament.invalidateTournament(tournament_id)
+    return row[0]
+
+
+async def archiveTournament(tournament_id):
+    """Moves a tournament to the archive schema; True if it existed (see
+    tournament.py)."""
+    async with getConnection() as DB:
+        row = await DB.fetchone("SELECT tournament_archive(%s, true)",
+                                (tournament_id,))
+    tournament.invalidateTournament(tournament_id)
+    return row[0]
+
+
+async def registerTournament(name):
+    """Adds a tournament and returns its id (see tournament.py)."""
+    async with getConnection() as DB:
+        row = await DB.fetchone(
+            "INSERT INTO tournaments (name) VALUES (%s) RETURNING id",
+            (name,))
+    tournament.invalidateTournament(row[0])
+    return row[0]
+
+
+async def setTiebreaks(tournament_id, tiebreaks):
+    """Chooses how the final standings of a tournament break ties.
+
+    Raises:
+      ValueError: for an unknown or repeated tiebreak, or an unknown
+        tournament.
+    """
+    tiebreaks = list(checkTiebreaks(tiebreaks))
+    async with getConnection() as DB:
+        c = await DB.execute("""UPDATE tournaments SET tiebreaks = %s
+                                 WHERE id = %s""", (tiebreaks, tournament_id))
+    if c.rowcount == 0:
+        raise ValueError("Tournament %s does not exist." % tournament_id)
+    tournament.invalidateTournament(tournament_id)
+
+
+async def countPlayers(tournament_id):
+    """Returns the number of players registered on a tournament."""
+    async with getConnection() as DB:
+        row = await DB.fetchone("""SELECT count(player_id) as cp
+                                    FROM tournaments_players
+                                    WHERE tournament_id = %s""",
+                                (tournament_id,))
+    return row[0]
+
+
+@dbaccess.helper
+async def _asociatePlayers(DB, tournament_id, player_ids):
+    """Registers existing players into a tournament (see tournament.py)."""
+    query = """INSERT INTO tournaments_players (tournament_id, player_id)
+                SELECT %s, unnest(%s::int[])
+                ON CONFLICT (tournament_id, player_id) DO NOTHING"""
+    try:
+        c = await DB.execute(query, (tournament_id, list(player_ids)))
+    except psycopg2.IntegrityError as e:
+        error = tournament._registrationError(e)
+        if error is None:
+            raise
+        raise error
+    return c.rowcount
+
+
+async def registerPlayer(name, tournament_id):
+    """Adds a new player into a tournament and returns the player's id."""
+    async with getConnection() as DB:
+        await DB.execute("BEGIN")
+        row = await DB.fetchone(
+            "INSERT INTO players (name) VALUES (%s) RETURNING id", (name,))
+        await _asociatePlayers(DB, tournament_id, [row[0]])
+        await DB.execute("COMMIT")
+    tournament.invalidateTournament(tournament_id)
+    return row[0]
+
+
+async def registerPlayers(players, tournament_id):
+    """Registers many new (names) and/or existing (ids) players in one
+    transaction and returns their ids in order (see tournament.py)."""
+    players = list(players)
+    names = [p for p in players if not isinstance(p, numbers.Integral)]
+    async with getConnection() as DB:
+        await DB.execute("BEGIN")
+        newIds = []
+        if names:
+            rows = await DB.fetchall("""INSERT INTO players (name)
+                                        SELECT unnest(%s::varchar[])
+                                        RETURNING id""", (names,))
+            newIds = [row[0] for row in rows]
+        newIds.reverse()
+        ids = [p if isinstance(p, numbers.Integral) else newIds.pop()
+               for p in players]
+        await _asociatePlayers(DB, tournament_id, ids)
+        await DB.execute("COMMIT")
+    tournament.invalidateTournament(tournament_id)
+    return ids
+
+
+async def asociatePlayerIntoTournament(player_id, tournament_id):
+    """Adds an existing player into a tournament.
+
+    Returns:
+      True if the player was added, False if he or she already was in.
+    """
+    async with getConnection() as DB:
+        added = await _asociatePlayers(DB, tournament_id, [player_id])
+    tournament.invalidateTournament(tournament_id)
+    return bool(added)
+
+
+async def playerStandings(tournament_id):
+    """Returns the (id, name, wins, matches, omw) standings, best first."""
+    async with getConnection() as DB:
+        standings = await DB.fetchall("""SELECT id, name, wins, matches, omw
+                                          FROM standings
+                                          WHERE tournament_id = %s
+                                          ORDER BY wins DESC, omw DESC, id""",
+                                      (tournament_id,))
+    return standings
+
+
+async def finalStandings(tournament_id):
+    """Returns the (id, name, points, matches, values) final standings,
+    ranked by the tournament's tiebreaks (see tournament.py)."""
+    async with getConnection() as DB:
+        rows = await DB.fetchall(STATE_QUERY, (tournament_id,))
+        row = await DB.fetchone(TIEBREAKS_QUERY, (tournament_id,))
+    state = TournamentState(tournament_id, rows,
+                            row[0] if row else DEFAULT_TIEBREAKS)
+    return state.ranking()
+
+
+async def reportMatch(tournament_id, winner, loser, draw):
+    """Records the outcome of a single match between two players."""
+    async with getConnection() as DB:
+        await DB.execute("""INSERT INTO matches
+                            (tournament_id, winner_id, loser_id, draw)
+                            VALUES (%s,%s,%s,%s)""",
+                         (tournament_id, winner, loser, draw))
+    tournament.invalidateTournament(tournament_id)
+
+
+async def doBye(tournament_id, player_id):
+    """Generate a bye on the tournament."""
+    async with getConnection() as DB:
+        await DB.execute("""INSERT INTO matches
+                            (tournament_id, winner_id, loser_id, draw, bye)
+                            VALUES (%s,%s,%s,%s,%s)""",
+                         (tournament_id, player_id, player_id, False, 1))
+    tournament.invalidateTournament(tournament_id)
+    return True
+
+
+async def reportMatches(tournament_id, results, byes=()):
+    """Records a whole round in a single transaction (see tournament.py).
+
+    Raises:
+      ValueError: if a player appears more than once in the round, or
+        is his or her own opponent.
+    """
+    rows = tournament._roundRows(tournament_id, results, byes)
+    if not rows:
+        return
+    columns = list(zip(*rows))
+    async with getConnection() as DB:
+        await DB.execute("BEGIN")
+        await DB.execute("SET LOCAL tournament.bulk_round = 'on'")
+        await DB.execute("""INSERT INTO matches
+                            (tournament_id, winner_id, loser_id, draw, bye)
+                            SELECT %s, * FROM unnest(%s::int[], %s::int[],
+                                                     %s::boolean[],
+                                                     %s::int[])""",
+                         (tournament_id, list(columns[1]), list(columns[2]),
+                          list(columns[3]), list(columns[4])))
+        await DB.execute("SELECT standings_rebuild(%s)", (tournament_id,))
+        await DB.execute("COMMIT")
+    tournament.invalidateTournament(tournament_id)
+
+
+async def hasBye(tournament_id, player_id):
+    """True if the player already had a bye in the tournament."""
+    async with getConnection() as DB:
+        row = await DB.fetchone(tournament.HAS_BYE.query,
+                                (tournament_id, player_id))
+    return row is not None
+
+
+async def alreadyPlay(tournament_id, player_id1, player_id2):
+    """True if the two players already played each other."""
+    async with getConnection() as DB:
+        row = await DB.fetchone("""SELECT id FROM matches
+                                    WHERE tournament_id = %s
+                                        AND ((winner_id = %s and loser_id = %s)
+                                            OR (winner_id = %s and loser_id = %s))
+                                    LIMIT 1""",
+                                (tournament_id, player_id1, player_id2,
+                                 player_id2, player_id1))
+    return row is not None
+
+
+async def loadRematchIndex(tournament_id):
+    """Loads the match history of a tournament into a RematchIndex."""
+    async with getConnection() as DB:
+        rows = await DB.fetchall(tournament.REMATCH_INDEX_QUERY,
+                                 (tournament_id,))
+    return RematchIndex.fromMatches(rows)
+
+
+async def loadPairingState(tournament_id, DB=None):
+    """Returns the rows of tournament.PAIRING_STATE_QUERY (see
+    tournament.loadPairingState), on DB or on a pooled connection."""
+    if DB is not None:
+        return await DB.fetchall(tournament.PAIRING_STATE_QUERY,
+                                 (tournament_id,))
+    async with getConnection() as DB:
+        state = await DB.fetchall(tournament.PAIRING_STATE_QUERY,
+                                  (tournament_id,))
+    return state
+
+
+async def swissPairings(tournament_id):
+    """Returns the (id1, name1, id2, name2) pairs of the next round.
+
+    Same rules as tournament.swissPairings: one query for the state, the
+    pairing in memory and, with an odd field, the bye recorded on the same
+    connection.
+
+    Raises:
+      PairingError: if every possible pairing would contain a rematch.
+    """
+    async with getConnection() as DB:
+        state = await loadPairingState(tournament_id, DB)
+        index = RematchIndex.fromOpponents(
+            (row[0], row[6], row[4]) for row in state)
+        pairs, byePlayer = pairRound([row[0] for row in state], index)
+        if byePlayer is not None:
+            await DB.execute("""INSERT INTO matches
+                                (tournament_id, winner_id, loser_id, draw, bye)
+                                VALUES (%s,%s,%s,%s,%s)""",
+                             (tournament_id, byePlayer, byePlayer, False, 1))
+    if byePlayer is not None:
+        tournament.invalidateTournament(tournament_id)
+    names = dict((row[0], row[1]) for row in state)
+    return [(id1, names[id1], id2, names[id2]) for id1, id2 in pairs]
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Test cases for tournament_async.py (Python 3.5 or later)
+# They check that the coroutines give the same results as the functions of
+# tournament.py, and that several tournaments can be served at once.
+
+import asyncio
+
+import tournament
+import tournament_async as ta
+
+
+async def testSameResultsAsSync():
+    """
+    Test that a round played through the coroutines leaves the same
+    standings as tournament.playerStandings reads.
+    """
+    await ta.deleteTournaments()
+    await ta.deletePlayers()
+    curT = await ta.registerTournament("MyTournament")
+    ids = await ta.registerPlayers(["Bruno Walton", "Boots O'Neal",
+                                    "Cathy Burton", "Diane Grant"], curT)
+    if await ta.countPlayers(curT) != 4:
+        raise ValueError("After four players register, countPlayers should be 4.")
+    pairings = await ta.swissPairings(curT)
+    if len(pairings) != 2:
+        raise ValueError(
+            "For four players, swissPairings should return 2 pairs. Got {p}".format(p=len(pairings)))
+    await ta.reportMatches(curT, [(p[0], p[2], False) for p in pairings])
+    standings = await ta.playerStandings(curT)
+    if standings != tournament.playerStandings(curT):
+        raise ValueError("The async standings should match the sync ones.")
+    if not await ta.alreadyPlay(curT, pairings[0][0], pairings[0][2]):
+        raise ValueError("alreadyPlay should see the reported match.")
+    if sorted(row[0] for row in standings) != sorted(ids):
+        raise ValueError("Every registered player should be in the standings.")
+    print("1. The coroutines give the same results as tournament.py.")
+
+
+async def testConcurrentTournaments():
+    """
+    Test that many tournaments can be paired at once with a small pool.
+    """
+    await ta.deleteTournaments()
+    await ta.deletePlayers()
+    tournaments = []
+    for n in range(6):
+        curT = await ta.registerTournament("Tournament %d" % n)
+        await ta.registerPlayers(["Player %d" % p for p in range(5)], curT)
+        tournaments.append(curT)
+    ta.configurePool(maxconn=2)
+    pairings = await ta.gatherTournaments(ta.swissPairings, tournaments)
+    if sorted(pairings) != sorted(tournaments):
+        raise ValueError("gatherTournaments should return every tournament.")
+    for curT, pairs in pairings.items():
+        state = await ta.loadPairingState(curT)
+        if len(pairs) != 2 or len([row for row in state if row[4]]) != 1:
+            raise ValueError("Each tournament of five should get two pairs and a bye.")
+    stats = ta.poolStats()
+    if stats['size'] > 2:
+        raise ValueError("The pool should not open more than maxconn connections.")
+    print("2. Several tournaments are paired concurrently.")
+
+
+async def testTournamentAdministration():
+    """
+    Test the tiebreak, archive, purge and reset coroutines against the
+    functions of tournament.py.
+    """
+    await ta.resetAll()
+    t1 = await ta.registerTournament("Archived Tournament")
+    t2 = await ta.registerTournament("Purged Tournament")
+    [id1, id2, id3] = await ta.registerPlayers(["Bruno Walton", "Boots O'Neal",
+                                                "Cathy Burton"], t1)
+    await ta.registerPlayers([id1, id2], t2)
+    await ta.reportMatches(t1, [(id1, id2, False)], byes=[id3])
+    await ta.setTiebreaks(t1, ['sos', 'head_to_head'])
+    if await ta.finalStandings(t1) != tournament.finalStandings(t1):
+        raise ValueError("The async final standings should match the sync ones.")
+    try:
+        await ta.setTiebreaks(t1, ['coin_toss'])
+        raise ValueError("setTiebreaks should reject an unknown tiebreak.")
+    except ValueError as e:
+        if "coin_toss" not in str(e):
+            raise
+    if not await ta.archiveTournament(t1) or await ta.archiveTournament(t1):
+        raise ValueError("archiveTournament should report whether the tournament existed.")
+    if not await ta.purgeTournament(t2) or await ta.purgeTournament(t2):
+        raise ValueError("purgeTournament should report whether the tournament existed.")
+    if await ta.countPlayers(t1) != 0 or await ta.countPlayers(t2) != 0:
+        raise ValueError("Archived and purged tournaments should leave the live tables.")
+    await ta.resetAll()
+    if await ta.registerTournament("MyTournament") != 1:
+        raise ValueError("resetAll should restart the ids.")
+    print("3. Tournaments are administered through the coroutines.")
+
+
+async def main():
+    try:
+        await testSameResultsAsSync()
+        await testConcurrentTournaments()
+        await testTournamentAdministration()
+    finally:
+        ta.closePool()
+        tournament.closePool()
+    print("Success!  All tests pass!")
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
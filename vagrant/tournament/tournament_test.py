@@ -6,7 +6,14 @@
 # If you do add any of the extra credit options, be sure to add/modify these test cases
 # as appropriate to account for your module's added functionality.
 
+import threading
+
 from tournament import *
+from pairing import RematchIndex, pairRound
+import dbaccess
+import scheduler
+from state import TournamentState
+from fixtures import loadFixture
 
 def testCount():
     """
@@ -151,10 +158,551 @@ def testPairings():
                 "After one match, players with one win should be paired.")
     print "10. After one match, players with one win are properly paired."
 
+def testConnectionPool():
+    """
+    Test that every call returns its connection to the shared pool and that
+    the pool never opens more than maxconn connections.
+    """
+    configurePool(minconn=1, maxconn=2)
+    resetAll()
+    curT = registerTournament("MyTournament")
+    for name in ("Ajani Goldmane", "Liliana Vess", "Garruk Wildspeaker"):
+        registerPlayer(name, curT)
+    playerStandings(curT)
+    countPlayers(curT)
+    stats = poolStats()
+    if stats['in_use'] != 0:
+        raise ValueError(
+            "Every connection should be back in the pool. In use: {n}".format(n=stats['in_use']))
+    if stats['opened'] > 2:
+        raise ValueError(
+            "The pool should open at most maxconn connections. Opened: {n}".format(n=stats['opened']))
+    with getConnection() as DB:
+        if poolStats()['in_use'] != 1:
+            raise ValueError("A checked out connection should count as in use.")
+    if poolStats()['checkouts'] != poolStats()['returns']:
+        raise ValueError("Every checkout should be matched by a return.")
+    closePool()
+    print "11. Connections are reused from the pool and always returned."
+
+def testPairingEngine():
+    """
+    Test that the in-memory pairing engine backtracks out of dead ends
+    instead of producing a rematch, and that byes go to the lowest-ranked
+    player who did not have one yet.
+    """
+    index = RematchIndex.fromMatches([(1, 2, 0), (3, 4, 0), (1, 3, 0)])
+    pairs, bye = pairRound([1, 2, 3, 4], index)
+    if set(map(frozenset, pairs)) != set([frozenset([1, 4]), frozenset([2, 3])]):
+        raise ValueError(
+            "The engine should backtrack to the only rematch-free pairing. Got {p}".format(p=pairs))
+    if bye is not None:
+        raise ValueError("An even field should not produce a bye.")
+    index = RematchIndex.fromMatches([(5, 5, 1)])
+    pairs, bye = pairRound([1, 2, 3, 4, 5], index)
+    if bye != 4 or len(pairs) != 2:
+        raise ValueError(
+            "The bye should go to the lowest-ranked player without one. Got {b}".format(b=bye))
+    print "12. The pairing engine avoids rematches and assigns byes correctly."
+
+def testBulkRegistration():
+    """
+    Test that registerPlayers registers new and existing players in one call,
+    returns their ids in order and never registers a player twice.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    otherT = registerTournament("OtherTournament")
+    veteran = registerPlayer("Nissa Revane", otherT)
+    ids = registerPlayers(["Gideon Jura", veteran, "Sorin Markov"], curT)
+    if len(ids) != 3 or ids[1] != veteran:
+        raise ValueError(
+            "registerPlayers should return one id per player, in order. Got {ids}".format(ids=ids))
+    registerPlayers([veteran, ids[0]], curT)
+    c = countPlayers(curT)
+    if c != 3:
+        raise ValueError(
+            "Registering a player twice should not duplicate it. Got {c}".format(c=c))
+    try:
+        registerPlayers(["Karn"], otherT + curT + 1)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Registering into a missing tournament should fail.")
+    print "13. registerPlayers registers many players at once without duplicates."
+
+def testReportRound():
+    """
+    Test that reportMatches records a whole round (matches and byes) with
+    the same standings as reporting each match, and rejects a round where
+    a player appears twice.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    [id1, id2, id3, id4, id5] = registerPlayers(
+        ["Elspeth Tirel", "Tezzeret", "Venser", "Koth", "Sarkhan Vol"], curT)
+    try:
+        reportMatches(curT, [(id1, id2, False), (id2, id3, False)])
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A player should not be accepted twice in a round.")
+    reportMatches(curT, [(id1, id2, False), (id3, id4, True)], byes=[id5])
+    standings = dict((row[0], row) for row in playerStandings(curT))
+    expected = {id1: (1, 1), id2: (0, 1), id3: (0, 1), id4: (0, 1), id5: (1, 1)}
+    for player_id, (wins, matches) in expected.items():
+        if standings[player_id][2:4] != (wins, matches):
+            raise ValueError(
+                "Round standings are wrong for player {p}: {s}".format(p=player_id, s=standings[player_id]))
+    if standings[id2][4] != 1:
+        raise ValueError("The loser of a match should count the winner's win as OMW.")
+    print "14. reportMatches records a whole round and its byes at once."
+
+def testStandingsCache():
+    """
+    Test that cached standings are served until a match is reported on the
+    tournament, and that the cache counts its hits and misses.
+    """
+    resetAll()
+    configureCache(maxsize=16, ttl=60)
+    try:
+        curT = registerTournament("MyTournament")
+        [id1, id2] = registerPlayers(["Chandra Nalaar", "Jace Beleren"], curT)
+        playerStandings(curT)
+        playerStandings(curT)
+        stats = cacheStats()
+        if stats['hits'] != 1 or stats['misses'] != 1:
+            raise ValueError(
+                "The second standings call should be a cache hit. Got {s}".format(s=stats))
+        reportMatch(curT, id1, id2, False)
+        standings = playerStandings(curT)
+        if standings[0][0] != id1 or standings[0][2] != 1:
+            raise ValueError("Reporting a match should invalidate the cached standings.")
+        final = finalStandings(curT)
+        hits = cacheStats()['hits']
+        if finalStandings(curT) != final or cacheStats()['hits'] != hits + 1:
+            raise ValueError("The second finalStandings call should be a cache hit.")
+        setTiebreaks(curT, ['sos', 'head_to_head'])
+        if len(finalStandings(curT)[0][4]) != 2:
+            raise ValueError("Changing the tiebreaks should invalidate the final standings.")
+    finally:
+        disableCache()
+    print "15. Standings are cached until the tournament changes."
+
+
+def testQueryInstrumentation():
+    """
+    Test that the queries of each public function are recorded under its name.
+    """
+    resetAll()
+    # fresh connections: the statements get prepared during the test
+    configurePool()
+    dbaccess.resetStats()
+    dbaccess.enableInstrumentation()
+    try:
+        curT = registerTournament("MyTournament")
+        registerPlayers(["Chandra Nalaar", "Jace Beleren"], curT)
+        countPlayers(curT)
+        countPlayers(curT)
+        stats = dbaccess.queryStats()
+    finally:
+        dbaccess.disableInstrumentation()
+        dbaccess.resetStats()
+    s = stats.get('tournament.countPlayers')
+    if s is None or s['queries'] != 2 or s['acquires'] != 2:
+        raise ValueError(
+            "Each countPlayers call should record one query. Got {s}".format(s=stats))
+    if 'tournament.registerPlayers' not in stats:
+        raise ValueError("Queries should be recorded under the public function.")
+    print "16. Queries are recorded per function."
+
+
+def testSingleQueryPairings():
+    """
+    Test that the pairing state comes from one query and that a round with a
+    bye costs two statements.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    [id1, id2, id3, id4, id5] = registerPlayers(
+        ["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant",
+         "Lucy Himmel"], curT)
+    reportMatches(curT, [(id1, id2, False), (id3, id4, False)], byes=[id5])
+    state = loadPairingState(curT)
+    byes = [row[0] for row in state if row[4]]
+    if byes != [id5]:
+        raise ValueError("Only the player with a bye should have has_bye set.")
+    ranks = [(row[2], row[5]) for row in state]
+    if ranks != [(1, 1), (1, 2), (1, 3), (0, 1), (0, 2)]:
+        raise ValueError(
+            "Players should be ranked inside their score group. Got {r}".format(r=ranks))
+    opponents = dict((row[0], sorted(row[6])) for row in state)
+    if opponents != {id1: [id2], id2: [id1], id3: [id4], id4: [id3], id5: []}:
+        raise ValueError("Each player should list the opponents he or she met.")
+    dbaccess.resetStats()
+    dbaccess.enableInstrumentation()
+    try:
+        pairings = swissPairings(curT)
+        stats = dbaccess.queryStats()
+    finally:
+        dbaccess.disableInstrumentation()
+        dbaccess.resetStats()
+    queries = sum(s['queries'] for s in stats.values())
+    if queries != 2:
+        raise ValueError(
+            "Pairing a round with a bye should take two queries. Got {q}".format(q=queries))
+    met = set([frozenset([id1, id2]), frozenset([id3, id4])])
+    for (pid1, pname1, pid2, pname2) in pairings:
+        if frozenset([pid1, pid2]) in met:
+            raise ValueError("swissPairings should not pair a rematch.")
+    if len(pairings) != 2 or id5 not in [p[0] for p in pairings] + [p[2] for p in pairings]:
+        raise ValueError("The player with a bye should not get a second one.")
+    print "17. Pairings are computed from a single query."
+
+
+def testScheduler():
+    """
+    Test that several tournaments are paired at once and their byes recorded.
+    """
+    resetAll()
+    t1 = registerTournament("Odd Tournament")
+    t2 = registerTournament("Even Tournament")
+    registerPlayers(["Twilight Sparkle", "Fluttershy", "Applejack"], t1)
+    registerPlayers(["Pinkie Pie", "Rarity", "Rainbow Dash", "Spike"], t2)
+    rounds = scheduler.pairTournaments([t1, t2], processes=0)
+    if sorted(rounds) != sorted([t1, t2]):
+        raise ValueError("pairTournaments should return every tournament.")
+    if len(rounds[t1]['pairings']) != 1 or rounds[t1]['bye'] is None:
+        raise ValueError("Three players should make one pair and one bye.")
+    if len(rounds[t2]['pairings']) != 2 or rounds[t2]['bye'] is not None:
+        raise ValueError("Four players should make two pairs and no bye.")
+    if rounds[t1]['error'] is not None or rounds[t1]['pair_ms'] < 0:
+        raise ValueError("Each tournament should report its pairing time.")
+    byes = [row[0] for row in loadPairingState(t1) if row[4]]
+    if byes != [rounds[t1]['bye']]:
+        raise ValueError("The bye should be recorded on the database.")
+    print "18. Several tournaments are paired at once."
+
+
+def testTournamentState():
+    """
+    Test that results applied in memory give the standings the database
+    computes once they are flushed.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    registerPlayers(["Bruno Walton", "Boots O'Neal", "Cathy Burton",
+                     "Diane Grant", "Lucy Himmel"], curT)
+    state = TournamentState.load(curT)
+    if state.countPlayers() != 5:
+        raise ValueError("The state should hold the five players.")
+    for _ in range(2):
+        for (id1, name1, id2, name2) in state.swissPairings():
+            state.reportMatch(id1, id2, False)
+    if state.pending() != 6:
+        raise ValueError(
+            "Two rounds of five players should queue six results. Got {n}".format(n=state.pending()))
+    if countPlayers(curT) != 5 or playerStandings(curT)[0][2] != 0:
+        raise ValueError("Nothing should be written before flush().")
+    id1, name1, id2, name2 = state.swissPairings()[0]
+    state.reportMatch(id1, id2, True)
+    state.flush()
+    if state.pending() != 0:
+        raise ValueError("flush() should empty the queue.")
+    if sorted(state.standings()) != sorted(playerStandings(curT)):
+        raise ValueError("The flushed standings should match the in-memory ones.")
+    if not state.alreadyPlay(id1, id2) or not alreadyPlay(curT, id1, id2):
+        raise ValueError("alreadyPlay should see the reported match.")
+    print "19. Tournament state is kept in memory and written in batches."
+
+
+def testResetAndPurge():
+    """
+    Test that purgeTournament only removes its own tournament, and that
+    resetAll empties everything and restarts the ids.
+    """
+    resetAll()
+    t1 = registerTournament("Kept Tournament")
+    t2 = registerTournament("Purged Tournament")
+    [id1, id2] = registerPlayers(["Bruno Walton", "Boots O'Neal"], t1)
+    registerPlayers([id1, id2], t2)
+    reportMatch(t1, id1, id2, False)
+    reportMatch(t2, id2, id1, False)
+    if not purgeTournament(t2) or purgeTournament(t2):
+        raise ValueError("purgeTournament should report whether the tournament existed.")
+    if countPlayers(t2) != 0 or loadPairingState(t2):
+        raise ValueError("A purged tournament should have no players left.")
+    if playerStandings(t1)[0][:3] != (id1, "Bruno Walton", 1):
+        raise ValueError("Purging a tournament should not touch the others.")
+    resetAll()
+    t = registerTournament("MyTournament")
+    if t != 1:
+        raise ValueError("resetAll should restart the ids. Got {t}".format(t=t))
+    print "20. Tournaments are purged and the database reset in bulk."
+
+
+def testFixtures():
+    """
+    Test that the COPY fixture loader gives consistent standings.
+    """
+    resetAll()
+    field = loadFixture(tournaments=2, players=5, rounds=3, seed=1)
+    if len(field) != 2:
+        raise ValueError("loadFixture should create two tournaments.")
+    for curT, ids in field.items():
+        if countPlayers(curT) != 5:
+            raise ValueError("Each fixture tournament should have five players.")
+        standings = playerStandings(curT)
+        if sum(row[3] for row in standings) != 3 * 5:
+            raise ValueError("Three rounds of five players count 15 results.")
+        state = TournamentState.load(curT)
+        if sorted(state.standings()) != sorted(standings):
+            raise ValueError("The rebuilt standings should match a recount.")
+        swissPairings(curT)
+    print "21. Fixtures are loaded with COPY."
+
+
+def testArchive():
+    """
+    Test that archiveTournament moves a tournament out of the live tables
+    and keeps its matches in the archive schema.
+    """
+    resetAll()
+    t1 = registerTournament("Live Tournament")
+    t2 = registerTournament("Archived Tournament")
+    [id1, id2] = registerPlayers(["Bruno Walton", "Boots O'Neal"], t1)
+    registerPlayers([id1, id2], t2)
+    reportMatch(t1, id1, id2, False)
+    reportMatch(t2, id2, id1, False)
+    if not archiveTournament(t2) or archiveTournament(t2):
+        raise ValueError("archiveTournament should report whether the tournament existed.")
+    if countPlayers(t2) != 0:
+        raise ValueError("An archived tournament should leave the live tables.")
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("SELECT winner_id, loser_id FROM archive.matches_t%d" % t2)
+        archived = c.fetchall()
+    if archived != [(id2, id1)]:
+        raise ValueError("The archived matches should be kept. Got {m}".format(m=archived))
+    if playerStandings(t1)[0][:3] != (id1, "Bruno Walton", 1):
+        raise ValueError("Archiving a tournament should not touch the others.")
+    try:
+        registerPlayers([id1], t2)
+        raise ValueError("Registering into an archived tournament should fail.")
+    except ValueError as e:
+        if "tournament does not exist" not in str(e):
+            raise
+    print "22. Tournaments are archived."
+
+
+def testTiebreaks():
+    """
+    Test that the final standings break ties with the tournament's
+    tiebreaks, also after results applied in memory.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    [id1, id2, id3, id4] = registerPlayers(["Bruno Walton", "Boots O'Neal",
+                                            "Cathy Burton", "Diane Grant"], curT)
+    reportMatch(curT, id1, id2, False)
+    reportMatch(curT, id3, id4, False)
+    reportMatch(curT, id2, id3, False)
+    reportMatch(curT, id4, id1, True)
+    try:
+        setTiebreaks(curT, ['omw', 'coin_toss'])
+        raise ValueError("setTiebreaks should reject an unknown tiebreak.")
+    except ValueError as e:
+        if "coin_toss" not in str(e):
+            raise
+    setTiebreaks(curT, ['head_to_head', 'sos'])
+    state = TournamentState.load(curT)
+    ranking = state.ranking()
+    # id2 and id3 both have one point, but id2 beat id3
+    if [row[0] for row in ranking] != [id1, id2, id3, id4]:
+        raise ValueError("Head-to-head should rank id2 before id3.")
+    if ranking[0][2] != 1.5 or ranking[1][4] != (1.0, 2.5):
+        raise ValueError("Unexpected tiebreak values: {r}".format(r=ranking))
+    state.reportMatch(id4, id3, False)
+    state.flush()
+    fresh = TournamentState.load(curT)
+    if state.ranking(['omw_pct', 'sos']) != fresh.ranking(['omw_pct', 'sos']):
+        raise ValueError("Incremental tiebreaks should match a full load.")
+    print "23. Final standings are ranked by tiebreaks."
+
+
+def testReplicaRouting():
+    """
+    Test that reads go to the replicas, and to the primary right after a
+    write.  The primary stands in for its own replica.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    otherT = registerTournament("Other Tournament")
+    [id1, id2] = registerPlayers(["Bruno Walton", "Boots O'Neal"], curT)
+    configureReplicas([DSN], stickiness=60)
+    try:
+        reportMatch(curT, id1, id2, False)
+        if playerStandings(curT)[0][:3] != (id1, "Bruno Walton", 1):
+            raise ValueError("Reads after a write should see the write.")
+        stats = replicaStats()
+        if stats['sticky_reads'] != 1 or stats['replica_reads'] != 0:
+            raise ValueError(
+                "A written tournament should be read from the primary. Got {s}".format(s=stats))
+        if countPlayers(otherT) != 0 or replicaStats()['replica_reads'] != 1:
+            raise ValueError("Other tournaments should be read from a replica.")
+        setTiebreaks(otherT, ['sos'])
+        newT = registerTournament("New Tournament")
+        countPlayers(otherT)
+        countPlayers(newT)
+        stats = replicaStats()
+        if stats['sticky_reads'] != 3 or stats['replica_reads'] != 1:
+            raise ValueError(
+                "Every write should send its tournament to the primary. Got {s}".format(s=stats))
+    finally:
+        configureReplicas([])
+    print "24. Reads are routed to the replicas."
+
+
+def testPreparedStatements():
+    """
+    Test that the hot statements are prepared once per connection.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    [id1, id2] = registerPlayers(["Bruno Walton", "Boots O'Neal"], curT)
+    configurePool(minconn=1, maxconn=1)
+    for _ in range(3):
+        playerStandings(curT)
+        alreadyPlay(curT, id1, id2)
+    with getConnection() as DB:
+        prepared = set(DB.prepared)
+        c = DB.cursor()
+        c.execute("SELECT name FROM pg_prepared_statements")
+        onServer = set(row[0] for row in c.fetchall())
+    if prepared != set([PLAYER_STANDINGS.name, ALREADY_PLAY.name]):
+        raise ValueError("Each statement should be prepared once. Got {p}".format(p=prepared))
+    if not prepared <= onServer:
+        raise ValueError("The prepared statements should exist on the server.")
+    reportMatch(curT, id1, id2, False)
+    if not alreadyPlay(curT, id1, id2) or playerStandings(curT)[0][2] != 1:
+        raise ValueError("Prepared statements should see the new match.")
+    configurePool()
+    print "25. Hot statements are prepared once per connection."
+
+
+def testConcurrentReports():
+    """
+    Test that matches of one tournament reported at the same time from
+    several connections neither deadlock nor lose standings updates.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    registerPlayers(["Player %d" % n for n in range(16)], curT)
+    configurePool(minconn=1, maxconn=8)
+    errors = []
+
+    def report(winner, loser):
+        try:
+            reportMatch(curT, winner, loser, False)
+        except Exception as e:
+            errors.append(e)
+
+    for _ in range(4):
+        threads = [threading.Thread(target=report, args=(pair[0], pair[2]))
+                   for pair in swissPairings(curT)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise ValueError("Concurrent reports failed: {e}".format(e=errors))
+    standings = sorted(playerStandings(curT))
+    with getConnection() as DB:
+        c = DB.cursor()
+        c.execute("SELECT standings_rebuild(%s)", (curT,))
+        DB.commit()
+    invalidateTournament(curT)
+    if sorted(playerStandings(curT)) != standings:
+        raise ValueError("Concurrent reports should keep the standings exact.")
+    configurePool()
+    print "26. Concurrent reports keep the standings exact."
+
+
+def testFinalStandings():
+    """
+    Test that finalStandings follows the tiebreaks of the tournament and
+    agrees with playerStandings under the default one (OMW, highest first).
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    ids = registerPlayers(["Player %d" % n for n in range(1, 7)], curT)
+    [id1, id2, id3, id4, id5, id6] = ids
+    for winner, loser in [(id2, id1), (id3, id4), (id5, id6), (id3, id2),
+                          (id1, id6), (id2, id5), (id6, id3)]:
+        reportMatch(curT, winner, loser, False)
+    expected = [id2, id3, id6, id1, id5, id4]
+    if [row[0] for row in playerStandings(curT)] != expected:
+        raise ValueError("Ties on wins should go to the highest OMW first.")
+    if [row[0] for row in finalStandings(curT)] != expected:
+        raise ValueError("The default tiebreak should rank as playerStandings.")
+    # id2 has the higher OMW, but id3 beat id2
+    setTiebreaks(curT, ['head_to_head', 'omw'])
+    final = finalStandings(curT)
+    if [row[0] for row in final[:2]] != [id3, id2]:
+        raise ValueError("finalStandings should apply the tournament's tiebreaks.")
+    if final != TournamentState.load(curT).ranking():
+        raise ValueError("finalStandings should match TournamentState.ranking.")
+    print "27. Final standings follow the tournament's tiebreaks."
+
+
+def testHasBye():
+    """
+    Test that hasBye only looks at byes: False for a player without
+    matches or with plain matches only, True after a bye, whatever the
+    order of the matches.
+    """
+    resetAll()
+    curT = registerTournament("MyTournament")
+    [id1, id2, id3] = registerPlayers(["Bruno Walton", "Boots O'Neal",
+                                       "Cathy Burton"], curT)
+    if hasBye(curT, id1):
+        raise ValueError("A player without matches has no bye.")
+    reportMatch(curT, id1, id2, False)
+    doBye(curT, id3)
+    if hasBye(curT, id1) or hasBye(curT, id2):
+        raise ValueError("A played match is not a bye.")
+    if not hasBye(curT, id3):
+        raise ValueError("hasBye should see the bye just given.")
+    doBye(curT, id2)
+    if not hasBye(curT, id2):
+        raise ValueError("hasBye should see a bye after a played match.")
+    state = TournamentState.load(curT)
+    if [state.hasBye(p) for p in (id1, id2, id3)] != [False, True, True]:
+        raise ValueError("TournamentState.hasBye should agree with hasBye.")
+    print "28. hasBye only counts byes."
+
 
 if __name__ == '__main__':
     testCount()
     testStandingsBeforeMatches()
     testReportMatches()
     testPairings()
+    testConnectionPool()
+    testPairingEngine()
+    testBulkRegistration()
+    testReportRound()
+    testStandingsCache()
+    testQueryInstrumentation()
+    testSingleQueryPairings()
+    testScheduler()
+    testTournamentState()
+    testResetAndPurge()
+    testFixtures()
+    testArchive()
+    testTiebreaks()
+    testReplicaRouting()
+    testPreparedStatements()
+    testConcurrentReports()
+    testFinalStandings()
+    testHasBye()
     print "Success!  All tests pass!"
\ No newline at end of file